@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+import argparse
+
+from roboclaw_driver import analytics
+
+# Offline analysis of captures made with ~record_file: tracking error, wheel slip, odometry drift and current per speed
+
+
+def print_efficiency(data, bins):
+    if 'currents' not in data:
+        return
+    for motor in (1, 2):
+        if 'speed%d' % motor not in data:
+            continue
+        edges, current, counts = analytics.current_per_speed(data, motor, bins)
+        print("M%d mean current per speed (ticks/s: A)" % motor)
+        for i in range(bins):
+            if counts[i]:
+                print("  %8.0f-%-8.0f %6.2f  (%d samples)" % (edges[i], edges[i + 1], current[i] / 100.0, counts[i]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize Roboclaw captures")
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--ticks-per-meter", type=float, default=4342.2)
+    parser.add_argument("--base-width", type=float, default=0.315)
+    parser.add_argument("--bins", type=int, default=10, help="speed bins of the current per speed table")
+    # The node's ~invert_motor_axes and ~flip_left_right_motors, the encoders are mapped the same way
+    parser.add_argument("--invert-motor-axes", dest="invert_motor_axes", action="store_true", default=True)
+    parser.add_argument("--no-invert-motor-axes", dest="invert_motor_axes", action="store_false")
+    parser.add_argument("--flip-left-right-motors", dest="flip_left_right_motors", action="store_true",
+                        default=False)
+    parser.add_argument("--no-flip-left-right-motors", dest="flip_left_right_motors", action="store_false")
+    args = parser.parse_args()
+
+    for path in args.captures:
+        data = analytics.load_capture(path)
+        print(path)
+        summary = analytics.summarize(data, args.ticks_per_meter, args.base_width, args.invert_motor_axes,
+                                      args.flip_left_right_motors)
+        for name in sorted(summary):
+            print("  %s: %.4f" % (name, summary[name]))
+        print_efficiency(data, args.bins)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import argparse
+import sys
+
+import roboclaw_driver.roboclaw_driver as roboclaw
+import yaml
+from roboclaw_driver import config
+
+# Dumps the controller configuration as a yaml profile, or brings a controller in line with one
+
+
+def snapshot(args):
+    data = config.read_snapshot(args.address)
+    yaml.safe_dump(data, sys.stdout, default_flow_style=False)
+
+
+def sync(args):
+    with open(args.profile) as f:
+        profile = yaml.safe_load(f) or {}
+    changes = config.diff(config.read_snapshot(args.address), profile)
+    if not changes:
+        print("Roboclaw already matches %s" % args.profile)
+        return 0
+    for name in sorted(changes):
+        print("%s: %s -> %s" % (name, changes[name][0], changes[name][1]))
+    if args.dry_run:
+        return 0
+    failed = config.apply(args.address, changes, not args.no_nvm)
+    if failed:
+        print("Failed to write: %s" % ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot or sync the Roboclaw configuration")
+    parser.add_argument("--dev", default="/dev/ttyACM0")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--transport", default="serial", help="serial, termios or socket (dev is then host:port)")
+    parser.add_argument("--address", type=int, default=128)
+    commands = parser.add_subparsers(dest="command")
+    # Subcommands are optional by default on python 3
+    commands.required = True
+    commands.add_parser("snapshot", help="print the current configuration as yaml")
+    sync_parser = commands.add_parser("sync", help="write the fields of a yaml profile that differ")
+    sync_parser.add_argument("profile")
+    sync_parser.add_argument("--dry-run", action="store_true", help="only show what would change")
+    sync_parser.add_argument("--no-nvm", action="store_true", help="do not save the changes to NVM")
+    args = parser.parse_args()
+
+    roboclaw.Open(args.dev, args.baud, transport=args.transport)
+    if args.command == "snapshot":
+        snapshot(args)
+    else:
+        sys.exit(sync(args))
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+import time
+
+import diagnostic_updater
+import roboclaw_driver.roboclaw_driver as roboclaw
+import rospy
+from diagnostic_msgs.msg import DiagnosticStatus
+from geometry_msgs.msg import Twist
+from roboclaw_driver.dispatcher import Dispatcher
+from roboclaw_driver.kinematics import Kinematics, advance
+from roboclaw_driver.node_common import RUNNING, STOPPED, STOPPING, OdomPublisher, decode_status, encoder_jumped
+from roboclaw_driver.node_common import cmd_timeout_param, run_watchdog, watchdog_period
+from roboclaw_driver.stats import clock
+from threading import Lock, Thread
+
+# Drives a robot whose wheels are spread over several Roboclaws, see the README for the ~controllers and ~wheels
+# parameters. Controllers on separate ports are talked to in parallel, controllers sharing a port in turn.
+
+
+class Controller:
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.wheels = {}  # motor number -> Wheel
+        self.enc1 = roboclaw.EncoderResult()
+        self.enc2 = roboclaw.EncoderResult()
+        self.read_errors = 0
+
+
+class Wheel:
+    def __init__(self, role, invert, ticks_per_meter):
+        self.role = role
+        self.SIGN = -1 if invert else 1
+        self.TICKS_PER_METER = ticks_per_meter
+        self.last_enc = None
+
+    def ticks(self, speed):
+        return int(self.SIGN * speed * self.TICKS_PER_METER)
+
+    def travel(self, enc):
+        # Meters moved since the last reading, None when the previous read failed or the encoder jumped
+        last = self.last_enc
+        self.last_enc = enc
+        if last is None or encoder_jumped(self.role, enc, last):
+            return None
+        return self.SIGN * (enc - last) / self.TICKS_PER_METER
+
+
+# The calls below run on a port's worker thread, for every controller on that port
+
+
+def send_speeds(controllers, speeds):
+    acked = []
+    for controller, (m1, m2) in zip(controllers, speeds):
+        # This is a hack way to keep a poorly tuned PID from making noise at speed 0
+        if m1 == 0 and m2 == 0:
+            ok1 = roboclaw.ForwardM1(controller.address, 0)
+            ok2 = roboclaw.ForwardM2(controller.address, 0)
+            acked.append(ok1 and ok2)
+        else:
+            acked.append(roboclaw.SpeedM1M2(controller.address, m1, m2))
+    return acked
+
+
+def stop_motors(controllers):
+    return send_speeds(controllers, [(0, 0)] * len(controllers))
+
+
+def read_encoders(controllers):
+    read = []
+    for controller in controllers:
+        ok1 = roboclaw.ReadEncM1(controller.address, controller.enc1).ok
+        ok2 = roboclaw.ReadEncM2(controller.address, controller.enc2).ok
+        if not (ok1 and ok2):
+            controller.read_errors += 1
+            # A bad crc is often the tail of an earlier reply, which would garble the following ones too
+            if roboclaw.LastError() in (roboclaw.CrcMismatch, roboclaw.Desync):
+                roboclaw.Resync()
+        read.append((ok1, ok2))
+    return read
+
+
+def handshake(controllers, serial_timeout):
+    for controller in controllers:
+        version = roboclaw.ReadVersion(controller.address)
+        if not version[0]:
+            rospy.logwarn("Could not get version from roboclaw %s", controller.name)
+        roboclaw.SpeedM1M2(controller.address, 0, 0)
+        roboclaw.ResetEncoders(controller.address)
+        # Backstop for when the node itself stalls, the Roboclaw stops on its own once the link goes quiet
+        if serial_timeout and not roboclaw.SetSerialTimeout(controller.address, serial_timeout):
+            rospy.logwarn("Roboclaw %s did not accept serial timeout", controller.name)
+
+
+def read_vitals(controllers):
+    return [(roboclaw.ReadError(controller.address), roboclaw.ReadMainBatteryVoltage(controller.address))
+            for controller in controllers]
+
+
+class Node:
+    def __init__(self):
+        self.state = RUNNING
+        self.lock = Lock()
+        self.subscribers = []
+
+        rospy.init_node("roboclaw_multi_node")
+        rospy.on_shutdown(self.shutdown)
+
+        self.DRIVE = rospy.get_param("~drive", "skid")
+        self.MAX_SPEED = float(rospy.get_param("~max_speed", "2.0"))
+        self.TICKS_PER_METER = float(rospy.get_param("~ticks_per_meter", "4342.2"))
+        self.BASE_WIDTH = float(rospy.get_param("~base_width", "0.315"))
+        self.WHEEL_BASE = float(rospy.get_param("~wheel_base", "0.0"))
+        self.CMD_TIMEOUT = cmd_timeout_param()
+        self.CONTROLLER_TIMEOUT = float(rospy.get_param("~controller_timeout", "2.0"))
+        self.SHUTDOWN_TIMEOUT = float(rospy.get_param("~shutdown_timeout", "1.0"))
+        self.SYNC_TIMEOUT = float(rospy.get_param("~sync_timeout", "0.02"))
+        self.kinematics = Kinematics(self.DRIVE, self.BASE_WIDTH, self.WHEEL_BASE)
+
+        # Controllers on the same port share its link and are driven one after the other
+        controllers = {}
+        ports = {}
+        self.ports = []
+        for config in rospy.get_param("~controllers"):
+            controller = Controller(config["name"], int(config.get("address", 128)))
+            controllers[controller.name] = controller
+            dev = config["dev"]
+            if dev not in ports:
+                ports[dev] = (dev, int(config.get("baud", 115200)), config.get("transport", "serial"), [])
+                self.ports.append(ports[dev])
+            ports[dev][3].append(controller)
+
+        roles = set()
+        for config in rospy.get_param("~wheels"):
+            controller = controllers[config["controller"]]
+            motor = int(config["motor"])
+            if config["role"] not in self.kinematics.roles:
+                raise ValueError("Wheel role %s does not exist on a %s drive" % (config["role"], self.DRIVE))
+            controller.wheels[motor] = Wheel(config["role"], bool(config.get("invert", False)),
+                                             float(config.get("ticks_per_meter", self.TICKS_PER_METER)))
+            roles.add(config["role"])
+        missing = set(self.kinematics.roles) - roles
+        if missing:
+            raise ValueError("No wheel for %s" % ", ".join(sorted(missing)))
+
+        self.links = [roboclaw.Link() for port in self.ports]
+        self.dispatcher = Dispatcher(self.links, barrier_timeout=self.SYNC_TIMEOUT)
+        rospy.loginfo("Connecting to %d roboclaws on %d ports", len(controllers), len(self.ports))
+        results = self.dispatcher.run([(roboclaw.Open, (dev, baud, 0.1, transport))
+                                       for dev, baud, transport, port_controllers in self.ports])
+        for (dev, baud, transport, port_controllers), result in zip(self.ports, results):
+            if isinstance(result, Exception):
+                rospy.logfatal("Could not connect to Roboclaw on %s", dev)
+                rospy.logdebug(result)
+                rospy.signal_shutdown("Could not connect to Roboclaw")
+
+        serial_timeout = min(255, int(self.CONTROLLER_TIMEOUT * 10))
+        results = self.dispatcher.run([(handshake, (port[3], serial_timeout)) for port in self.ports])
+        for (dev, baud, transport, port_controllers), result in zip(self.ports, results):
+            if isinstance(result, Exception):
+                rospy.logwarn("Handshake on %s failed: %s", dev, result)
+
+        self.updater = diagnostic_updater.Updater()
+        self.updater.setHardwareID("Roboclaw")
+        self.updater.add(diagnostic_updater.FunctionDiagnosticTask("Vitals", self.check_vitals))
+
+        self.odom = OdomPublisher()
+        self.pose = (0.0, 0.0, 0.0)
+        self.last_odom_time = rospy.Time.now()
+        self.last_cmd = clock()
+        self.stopped_cmd = None
+        self.watchdog = Thread(target=run_watchdog, args=(self.watch_commands,), name="roboclaw_watchdog")
+        self.watchdog.daemon = True
+
+        self.subscribers.append(rospy.Subscriber("cmd_vel", Twist, self.cmd_vel_callback))
+
+        rospy.logdebug("drive %s", self.DRIVE)
+        for dev, baud, transport, port_controllers in self.ports:
+            rospy.logdebug("port %s baud %d transport %s: %s", dev, baud, transport,
+                           ", ".join("%s at %d" % (c.name, c.address) for c in port_controllers))
+        rospy.logdebug("max_speed %f", self.MAX_SPEED)
+        rospy.logdebug("ticks_per_meter %f", self.TICKS_PER_METER)
+        rospy.logdebug("base_width %f", self.BASE_WIDTH)
+        rospy.logdebug("wheel_base %f", self.WHEEL_BASE)
+        rospy.logdebug("cmd_timeout %f", self.CMD_TIMEOUT)
+        rospy.logdebug("controller_timeout %f", self.CONTROLLER_TIMEOUT)
+        rospy.logdebug("shutdown_timeout %f", self.SHUTDOWN_TIMEOUT)
+        rospy.logdebug("sync_timeout %f", self.SYNC_TIMEOUT)
+
+    def run(self):
+        rospy.loginfo("Starting motor drive")
+        r_time = rospy.Rate(10)
+        self.watchdog.start()
+        while not rospy.is_shutdown():
+            # The reads go out on every port at the same moment, so all wheels are sampled together
+            results = self.dispatcher.gather(read_encoders, [(port[3],) for port in self.ports])
+            current_time = rospy.Time.now()
+
+            travel = {}
+            for (dev, baud, transport, port_controllers), result in zip(self.ports, results):
+                if result is None or isinstance(result, Exception):
+                    rospy.logwarn("Encoder read on %s failed: %s", dev, result)
+                    result = [(False, False)] * len(port_controllers)
+                for controller, (ok1, ok2) in zip(port_controllers, result):
+                    for motor, ok, record in ((1, ok1, controller.enc1), (2, ok2, controller.enc2)):
+                        wheel = controller.wheels.get(motor)
+                        if wheel is None:
+                            continue
+                        # A wheel missing a reading sits out until it has two good ones in a row again
+                        if not ok:
+                            wheel.last_enc = None
+                            continue
+                        distance = wheel.travel(record.value)
+                        if distance is not None:
+                            travel.setdefault(wheel.role, []).append(distance)
+
+            self.update_odom(travel, current_time)
+            self.updater.update()
+            r_time.sleep()
+
+    def update_odom(self, travel, current_time):
+        motion = self.kinematics.forward(travel)
+        d_time = (current_time - self.last_odom_time).to_sec()
+        self.last_odom_time = current_time
+        if motion is None:
+            rospy.logdebug("Not every wheel role was read, skipping odometry")
+            return
+        dx, dy, d_theta = motion
+        self.pose = advance(self.pose, dx, dy, d_theta)
+        if abs(d_time) < 0.000001:
+            vel_x = vel_y = vel_theta = 0.0
+        else:
+            vel_x, vel_y, vel_theta = dx / d_time, dy / d_time, d_theta / d_time
+        self.odom.publish(current_time, self.pose, vel_x, vel_y, vel_theta)
+
+    def clamp(self, speed):
+        return max(-self.MAX_SPEED, min(self.MAX_SPEED, speed))
+
+    def cmd_vel_callback(self, twist):
+        self.last_cmd = clock()
+        speeds = self.kinematics.inverse(self.clamp(twist.linear.x), self.clamp(twist.linear.y), twist.angular.z)
+        with self.lock:
+            if self.state == RUNNING:
+                self.send(speeds)
+
+    # Sends {role: m/s} to every controller at once
+    def send(self, speeds):
+        calls = []
+        for dev, baud, transport, port_controllers in self.ports:
+            ticks = []
+            for controller in port_controllers:
+                ticks.append(tuple(controller.wheels[motor].ticks(speeds[controller.wheels[motor].role])
+                                   if motor in controller.wheels else 0 for motor in (1, 2)))
+            calls.append((send_speeds, (port_controllers, ticks)))
+        rospy.logdebug("wheel speeds %s", ", ".join("%s %.3f" % item for item in sorted(speeds.items())))
+        # All wheels start together instead of one round trip apart per controller
+        acked = self.check_acks("SpeedM1M2", self.dispatcher.run(calls, synchronized=True))
+        rospy.logdebug("issue skew %.0f us", self.dispatcher.skew.last * 1000000)
+        return acked
+
+    # The stop does not wait behind the reads queued on the ports, each port takes it after its transaction in flight
+    def stop(self):
+        return self.check_acks("Stop", self.dispatcher.run([(stop_motors, (port[3],)) for port in self.ports],
+                                                           priority=True))
+
+    def check_acks(self, name, results):
+        acked = True
+        for (dev, baud, transport, port_controllers), result in zip(self.ports, results):
+            if result is None or isinstance(result, Exception):
+                rospy.logwarn("%s on %s failed: %s", name, dev, result)
+                acked = False
+                continue
+            for controller, ok in zip(port_controllers, result):
+                if not ok:
+                    rospy.logwarn("%s not acknowledged by %s", name, controller.name)
+                    acked = False
+        return acked
+
+    # Stops all motors when no command arrived for CMD_TIMEOUT seconds
+    def watch_commands(self):
+        period = watchdog_period(self.CMD_TIMEOUT)
+        while not rospy.is_shutdown():
+            time.sleep(period)
+            last_cmd = self.last_cmd
+            if last_cmd == self.stopped_cmd or clock() - last_cmd < self.CMD_TIMEOUT:
+                continue
+            rospy.logdebug("Did not get comand for %.2f seconds, stopping", self.CMD_TIMEOUT)
+            with self.lock:
+                if self.state == RUNNING and self.stop():
+                    self.stopped_cmd = last_cmd
+
+    def check_vitals(self, stat):
+        results = self.dispatcher.gather(read_vitals, [(port[3],) for port in self.ports])
+        worst = DiagnosticStatus.OK
+        messages = []
+        for (dev, baud, transport, port_controllers), result in zip(self.ports, results):
+            if result is None or isinstance(result, Exception):
+                worst = DiagnosticStatus.ERROR
+                messages.append("%s not responding" % dev)
+                continue
+            for controller, (error, battery) in zip(port_controllers, result):
+                if error[0]:
+                    level, message = decode_status(error[1])
+                    worst = max(worst, level)
+                    if level != DiagnosticStatus.OK:
+                        messages.append("%s %s" % (controller.name, message))
+                else:
+                    worst = max(worst, DiagnosticStatus.WARN)
+                    messages.append("Could not read the error status of %s" % controller.name)
+                if battery[0]:
+                    stat.add("%s Main Batt V:" % controller.name, battery[1] / 10.0)
+                stat.add("%s encoder read errors" % controller.name, controller.read_errors)
+        skew = self.dispatcher.skew
+        if skew.count:
+            stat.add("Issue skew p50/p99/max us", "%.0f/%.0f/%.0f" % (skew.percentile(50) * 1000000,
+                                                                     skew.percentile(99) * 1000000,
+                                                                     skew.max * 1000000))
+        stat.summary(worst, ", ".join(messages) or "Normal")
+        return stat
+
+    # Stops taking commands, then repeats the stop until every controller acknowledged it
+    def shutdown(self):
+        rospy.loginfo("Shutting down")
+        for subscriber in self.subscribers:
+            subscriber.unregister()
+        deadline = clock() + self.SHUTDOWN_TIMEOUT
+        with self.lock:
+            self.state = STOPPING
+            while self.state == STOPPING and clock() < deadline:
+                if self.stop():
+                    self.state = STOPPED
+        if self.state != STOPPED:
+            rospy.logerr("Could not shutdown motors!!!!")
+        self.dispatcher.close()
+
+
+if __name__ == "__main__":
+    try:
+        node = Node()
+        node.run()
+    except rospy.ROSInterruptException:
+        pass
+    rospy.loginfo("Exiting")
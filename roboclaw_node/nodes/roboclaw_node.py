@@ -1,33 +1,88 @@
 #!/usr/bin/env python
-from math import pi, cos, sin
+from math import cos, pi, sin
 
-import diagnostic_msgs
-import diagnostic_updater
+import importlib
+import os
+import sys
+import time
+
+from diagnostic_msgs.msg import DiagnosticStatus, KeyValue
 import roboclaw_driver.roboclaw_driver as roboclaw
 import rospy
-import tf
-from geometry_msgs.msg import Quaternion, Twist
-from nav_msgs.msg import Odometry
+from roboclaw_driver import node_common
+from roboclaw_driver.discovery import discover
+from roboclaw_driver.node_common import RUNNING, STOPPED, STOPPING, OdomPublisher, decode_status
+from roboclaw_driver.node_common import cmd_timeout_param, encoder_jumped, load_odom_modules, run_watchdog
+from roboclaw_driver.node_common import watchdog_period
+from roboclaw_driver.profiling import Profiler
+from roboclaw_driver.ramp import RampGenerator
+from roboclaw_driver.stats import bucket_percentile, clock
+from geometry_msgs.msg import Twist, TwistStamped
+from threading import Lock, Thread
+from trajectory_msgs.msg import JointTrajectory
 
 __author__ = "bwbazemore@uga.edu (Brad Bazemore)"
 
 g_invert_motor_axes = True
 g_flip_left_right_motors = False # By default M1=right motor M2=left motor
 
+# Loaded by load_heavy_modules, importing them takes a large part of the start up time
+diagnostic_updater = None
+
+
+def load_heavy_modules():
+    global diagnostic_updater
+    if diagnostic_updater is None:
+        import diagnostic_updater
+        load_odom_modules()
+
+
+# Loaded only when ~profile or ~shm_path turn on the feature that needs them
+Trigger = None
+TriggerResponse = None
+TelemetrySampler = None
+TelemetryWriter = None
+
+
+def load_profile_modules():
+    global Trigger, TriggerResponse
+    if Trigger is None:
+        from std_srvs.srv import Trigger, TriggerResponse
+
+
+def load_shm_modules():
+    global TelemetrySampler, TelemetryWriter
+    if TelemetrySampler is None:
+        from roboclaw_driver.shm import TelemetrySampler, TelemetryWriter
+
+
+# This script shadows the roboclaw_node python package the generated messages live in, so its directory is left out
+def load_messages():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    path = sys.path[:]
+    sys.path[:] = [p for p in path if os.path.abspath(p or os.curdir) != script_dir]
+    try:
+        return importlib.import_module("roboclaw_node.msg")
+    finally:
+        sys.path[:] = path
+
 
 # TODO need to find some better was of handling OSerror 11 or preventing it, any ideas?
 
 class EncoderOdom:
-    def __init__(self, ticks_per_meter, base_width):
+    # start_time and the current_time passed to update let odometry run off recorded time, e.g. when replaying
+    def __init__(self, ticks_per_meter, base_width, start_time=None, publish=True):
+        load_odom_modules()
         self.TICKS_PER_METER = ticks_per_meter
         self.BASE_WIDTH = base_width
-        self.odom_pub = rospy.Publisher('/odom', Odometry, queue_size=10)
+        if publish:
+            self.odom_pub = OdomPublisher()
         self.cur_x = 0
         self.cur_y = 0
         self.cur_theta = 0.0
         self.last_enc_left = 0
         self.last_enc_right = 0
-        self.last_enc_time = rospy.Time.now()
+        self.last_enc_time = start_time if start_time is not None else rospy.Time.now()
 
     @staticmethod
     def normalize_angle(angle):
@@ -37,7 +92,8 @@ class EncoderOdom:
             angle += 2.0 * pi
         return angle
 
-    def update(self, enc_left, enc_right):
+    # One sample is plain float math, building arrays for it costs more than the step, update_batch is the batched form
+    def update(self, enc_left, enc_right, current_time=None):
         left_ticks = enc_left - self.last_enc_left
         right_ticks = enc_right - self.last_enc_right
         self.last_enc_left = enc_left
@@ -47,7 +103,8 @@ class EncoderOdom:
         dist_right = right_ticks / self.TICKS_PER_METER
         dist = (dist_right + dist_left) / 2.0
 
-        current_time = rospy.Time.now()
+        if current_time is None:
+            current_time = rospy.Time.now()
         d_time = (current_time - self.last_enc_time).to_sec()
         self.last_enc_time = current_time
 
@@ -72,191 +129,799 @@ class EncoderOdom:
 
         return vel_x, vel_theta
 
+    def update_batch(self, enc_left, enc_right, stamps):
+        # Integrates arrays of readings with their stamps in seconds at once, as if update was called for each.
+        # Returns arrays x, y, theta, vel_x, vel_theta with the pose after each sample.
+        if not len(stamps):
+            return node_common.integrate([], [], [], self.TICKS_PER_METER, self.BASE_WIDTH)
+        # The sample times relative to last_enc_time, so the stamps keep their precision
+        offsets = node_common.np.asarray(stamps, dtype=node_common.np.float64) - self.last_enc_time.to_sec()
+        x, y, theta, vel_x, vel_theta = node_common.integrate(enc_left, enc_right, offsets, self.TICKS_PER_METER,
+                                                              self.BASE_WIDTH, (self.cur_x, self.cur_y, self.cur_theta),
+                                                              (self.last_enc_left, self.last_enc_right), 0.0)
+        self.last_enc_time = rospy.Time.from_sec(stamps[-1])
+        self.last_enc_left = int(enc_left[-1])
+        self.last_enc_right = int(enc_right[-1])
+        self.cur_x = float(x[-1])
+        self.cur_y = float(y[-1])
+        self.cur_theta = float(theta[-1])
+        return x, y, theta, vel_x, vel_theta
+
+    def valid(self, enc_left, enc_right):
+        return not (encoder_jumped("left", enc_left, self.last_enc_left) or
+                    encoder_jumped("right", enc_right, self.last_enc_right))
+
     def update_publish(self, enc_left, enc_right):
-        # 2106 per 0.1 seconds is max speed, error in the 16th bit is 32768
-        # TODO lets find a better way to deal with this error
-        if abs(enc_left - self.last_enc_left) > 20000:
-            rospy.logerr("Ignoring left encoder jump: cur %d, last %d" % (enc_left, self.last_enc_left))
-        elif abs(enc_right - self.last_enc_right) > 20000:
-            rospy.logerr("Ignoring right encoder jump: cur %d, last %d" % (enc_right, self.last_enc_right))
-        else:
+        if self.valid(enc_left, enc_right):
             vel_x, vel_theta = self.update(enc_left, enc_right)
             self.publish_odom(self.cur_x, self.cur_y, self.cur_theta, vel_x, vel_theta)
 
     def publish_odom(self, cur_x, cur_y, cur_theta, vx, vth):
-        quat = tf.transformations.quaternion_from_euler(0, 0, cur_theta)
-        current_time = rospy.Time.now()
+        self.odom_pub.publish(rospy.Time.now(), (cur_x, cur_y, cur_theta), vx, 0.0, vth)
 
-        br = tf.TransformBroadcaster()
-        br.sendTransform((cur_x, cur_y, 0),
-                         tf.transformations.quaternion_from_euler(0, 0, cur_theta),
-                         current_time,
-                         "base_footprint",
-                         "odom")
 
-        odom = Odometry()
-        odom.header.stamp = current_time
-        odom.header.frame_id = 'odom'
+class LinkMonitor:
+    def __init__(self, period):
+        self.PERIOD = period
+        self.stats_pub = rospy.Publisher('~link_stats', DiagnosticStatus, queue_size=1)
+        self.last_stats = roboclaw.GetStats()
+        self.last_time = clock()
+        self.loops = 0
+        self.values = []
+
+    def tick(self):
+        self.loops += 1
+        if clock() - self.last_time < self.PERIOD:
+            return
+        self.last_time = clock()
+        stats = roboclaw.GetStats()
+        last = self.last_stats
+        self.last_stats = stats
+        d_time = stats['elapsed'] - last['elapsed']
+
+        values = [("Loop rate Hz", "%.1f" % (self.loops / d_time)),
+                  ("Bytes/s", "%.0f" % ((stats['bytes_written'] + stats['bytes_read']
+                                         - last['bytes_written'] - last['bytes_read']) / d_time)),
+                  ("Retries/s", "%.2f" % ((stats['retries'] - last['retries']) / d_time)),
+                  ("Timeouts", "%d" % stats['timeouts']),
+                  ("CRC errors", "%d" % stats['crc_errors'])]
+        self.loops = 0
+        try:
+            values.append(("Queue depth", "%d" % roboclaw.GetInputQueueDepth()))
+        except (OSError, IOError) as e:
+            rospy.logdebug(e)
 
-        odom.pose.pose.position.x = cur_x
-        odom.pose.pose.position.y = cur_y
-        odom.pose.pose.position.z = 0.0
-        odom.pose.pose.orientation = Quaternion(*quat)
+        # Percentiles over this period only, from the difference of the cumulative histograms
+        for name in sorted(stats['commands']):
+            buckets = stats['commands'][name]['buckets']
+            if name in last['commands']:
+                buckets = [a - b for a, b in zip(buckets, last['commands'][name]['buckets'])]
+            if not sum(buckets):
+                continue
+            values.append(("%s p50/p99 ms" % name, "%.1f/%.1f" % (bucket_percentile(buckets, 50) * 1000,
+                                                                  bucket_percentile(buckets, 99) * 1000)))
+        self.values = values
 
-        odom.pose.covariance[0] = 0.01
-        odom.pose.covariance[7] = 0.01
-        odom.pose.covariance[14] = 99999
-        odom.pose.covariance[21] = 99999
-        odom.pose.covariance[28] = 99999
-        odom.pose.covariance[35] = 0.01
+        msg = DiagnosticStatus()
+        msg.name = "Roboclaw link"
+        msg.hardware_id = "Roboclaw"
+        msg.level = DiagnosticStatus.WARN if stats['crc_errors'] > last['crc_errors'] else DiagnosticStatus.OK
+        msg.values = [KeyValue(key, value) for key, value in values]
+        self.stats_pub.publish(msg)
 
-        odom.child_frame_id = 'base_footprint'
-        odom.twist.twist.linear.x = vx
-        odom.twist.twist.linear.y = 0
-        odom.twist.twist.angular.z = vth
-        odom.twist.covariance = odom.pose.covariance
 
-        self.odom_pub.publish(odom)
+class LatencyMonitor:
+    # End to end latency of the command path, cmd_vel to the controller's ACK, and of the odometry path, encoder read
+    # to /odom publish. Every PERIOD the distributions since the last report are logged and published on ~latency.
+    def __init__(self, period):
+        self.PERIOD = period
+        self.latency_pub = rospy.Publisher('~latency', DiagnosticStatus, queue_size=1)
+        self.lock = Lock()
+        self.samples = {}
+        self.last_time = clock()
+        self.values = []
+
+    def add(self, path, latency):
+        with self.lock:
+            self.samples.setdefault(path, []).append(latency)
+
+    # received is the clock() when the callback started, stamp the header stamp of a TwistStamped
+    def command_acked(self, received, stamp=None):
+        self.add("cmd_vel to ACK", clock() - received)
+        if stamp is not None and not stamp.is_zero():
+            self.add("stamp to ACK", (rospy.Time.now() - stamp).to_sec())
+
+    def odom_published(self, read_start):
+        self.add("encoder to odom", clock() - read_start)
+
+    def tick(self):
+        if clock() - self.last_time < self.PERIOD:
+            return
+        self.last_time = clock()
+        with self.lock:
+            samples, self.samples = self.samples, {}
+
+        values = []
+        for path in sorted(samples):
+            latencies = node_common.np.asarray(samples[path]) * 1000
+            p50, p90, p99 = node_common.np.percentile(latencies, (50, 90, 99))
+            values.append(("%s n/p50/p90/p99/max ms" % path, "%d/%.2f/%.2f/%.2f/%.2f" % (
+                len(latencies), p50, p90, p99, latencies.max())))
+        self.values = values
+        if not values:
+            return
+        rospy.loginfo("Latency: %s", ", ".join("%s %s" % value for value in values))
+
+        msg = DiagnosticStatus()
+        msg.name = "Roboclaw latency"
+        msg.hardware_id = "Roboclaw"
+        msg.level = DiagnosticStatus.OK
+        msg.values = [KeyValue(key, value) for key, value in values]
+        self.latency_pub.publish(msg)
+
+
+class TelemetryField:
+    # readers are (function, count) pairs, the first count values after the success flag of each go into the slots of
+    # the message in order, multiplied by scale
+    def __init__(self, name, readers, msg_class, slots, scale, rate, deadband):
+        self.name = name
+        self.readers = readers
+        self.msg_class = msg_class
+        self.slots = slots
+        self.scale = scale
+        self.PERIOD = 1.0 / rate
+        self.DEADBAND = deadband
+        self.delay = self.PERIOD
+        self.next_time = clock()
+        self.last = None
+        self.pub = rospy.Publisher('~' + name, msg_class, queue_size=1, latch=True)
+
+    def read(self, address):
+        values = []
+        for reader, count in self.readers:
+            result = reader(address)
+            if not result[0]:
+                return None
+            values += [value * self.scale for value in result[1:count + 1]]
+        return values
+
+    def changed(self, values):
+        return self.last is None or any(abs(a - b) > self.DEADBAND for a, b in zip(values, self.last))
+
+    def publish(self, values, stamp):
+        msg = self.msg_class()
+        msg.stamp = stamp
+        for slot, value in zip(self.slots, values):
+            setattr(msg, slot, value)
+        self.pub.publish(msg)
+
+
+class TelemetryPublisher:
+    # Samples each field at its own rate from its own thread. A value is only published when it moved by more than the
+    # field's deadband, the topics are latched so late subscribers still get the last one. Reads that keep finding the
+    # same value are spaced out up to BACKOFF times the period, a change or wake() brings a field back to full rate.
+    # Sampling ends once the node leaves RUNNING, the shutdown stop has the link to itself.
+    def __init__(self, node, fields, backoff):
+        self.node = node
+        self.address = node.address
+        self.fields = fields
+        self.BACKOFF = max(1.0, backoff)
+        self.thread = Thread(target=self.run, name="roboclaw_telemetry")
+        self.thread.daemon = True
+
+    def start(self):
+        if self.fields:
+            self.thread.start()
+
+    # New motion commands change currents and pwms right away, there is no point waiting out a backoff
+    def wake(self):
+        now = clock()
+        for field in self.fields:
+            if field.delay > field.PERIOD:
+                field.delay = field.PERIOD
+                field.next_time = min(field.next_time, now)
+
+    def run(self):
+        while not rospy.is_shutdown() and self.node.state == RUNNING:
+            field = min(self.fields, key=lambda f: f.next_time)
+            now = clock()
+            if field.next_time > now:
+                time.sleep(min(field.next_time - now, 0.05))
+                continue
+            self.sample(field, now)
+
+    def sample(self, field, now):
+        field.next_time = max(field.next_time + field.delay, now)
+        try:
+            # The state is checked with the link held, as for the motion commands
+            with roboclaw.Exclusive(False):
+                if self.node.state != RUNNING:
+                    return
+                values = field.read(self.address)
+        except OSError as e:
+            rospy.logwarn("Telemetry %s OSError: %d", field.name, e.errno)
+            rospy.logdebug(e)
+            return
+        if values is None:
+            return
+        if field.changed(values):
+            field.last = values
+            field.delay = field.PERIOD
+            field.publish(values, rospy.Time.now())
+        else:
+            field.delay = min(field.delay * 2.0, field.PERIOD * self.BACKOFF)
+
+
+class TrajectoryStreamer:
+    # Turns a timed sequence of wheel velocities into buffered SpeedAccelDistanceM1M2 commands so the controller
+    # keeps driving smoothly when the host stalls. Each segment is a distance so a segment where a wheel stands
+    # still finishes at once for that wheel, dwell times are not reproduced. A trajectory still running margin seconds
+    # after its last point, or whose progress could not be read MAX_FAILED_POLLS times in a row, is given up so it
+    # stops feeding the watchdog.
+    MAX_FAILED_POLLS = 5
+
+    def __init__(self, node, accel, depth, margin):
+        self.node = node
+        self.ACCEL = accel
+        self.DEPTH = depth
+        self.MARGIN = margin
+        self.lock = Lock()
+        self.segments = []
+        self.sent = 0
+        self.active = False
+        self.deadline = 0.0
+        self.failed_polls = 0
+
+    def set_trajectory(self, trajectory):
+        segments = []
+        last_time = 0.0
+        for point in trajectory.points:
+            t = point.time_from_start.to_sec()
+            d_time = t - last_time
+            last_time = t
+            if d_time <= 0 or len(point.velocities) < 2:
+                continue
+            vl = max(-self.node.MAX_SPEED, min(self.node.MAX_SPEED, point.velocities[0]))
+            vr = max(-self.node.MAX_SPEED, min(self.node.MAX_SPEED, point.velocities[1]))
+            m1_speed, m2_speed = self.node.motor_ticks(vr, vl)
+            segments.append((m1_speed, int(abs(m1_speed) * d_time), m2_speed, int(abs(m2_speed) * d_time)))
+        with self.lock:
+            self.segments = segments
+            self.sent = 0
+            self.active = bool(segments)
+            self.deadline = clock() + last_time + self.MARGIN
+            self.failed_polls = 0
+
+    # Returns True when a trajectory was running
+    def cancel(self):
+        with self.lock:
+            active = self.active
+            self.segments = []
+            self.active = False
+        return active
+
+    # Ends the trajectory unless a new one replaced it meanwhile
+    def finish(self, segments):
+        with self.lock:
+            if self.segments is segments:
+                self.active = False
+
+    # Called from the control loop, returns True while the trajectory is still running
+    def tick(self):
+        with self.lock:
+            if not self.active:
+                return False
+            segments = self.segments
+            sent = self.sent
+            deadline = self.deadline
+        accel = int(self.ACCEL * self.node.TICKS_PER_METER)
+        address = self.node.address
+
+        if clock() > deadline:
+            rospy.logwarn("Trajectory still running %.1f s after its end, giving up on it", self.MARGIN)
+            self.finish(segments)
+            return False
+
+        # The first segment replaces whatever is running, the following ones queue behind it
+        if sent == 0:
+            queued = 0
+        else:
+            buffers = roboclaw.ReadBuffers(address)
+            if not buffers[0]:
+                self.failed_polls += 1
+                if self.failed_polls < self.MAX_FAILED_POLLS:
+                    return True
+                rospy.logwarn("Could not read the trajectory progress %d times in a row, giving up on it",
+                              self.failed_polls)
+                self.finish(segments)
+                return False
+            self.failed_polls = 0
+            # 0x80 means the buffer is empty and the last command has finished
+            if sent == len(segments) and buffers[1] == 0x80 and buffers[2] == 0x80:
+                self.finish(segments)
+                return False
+            queued = max(buffers[1] & 0x7F, buffers[2] & 0x7F)
+
+        while queued < self.DEPTH and sent < len(segments):
+            m1_speed, m1_dist, m2_speed, m2_dist = segments[sent]
+            if not roboclaw.SpeedAccelDistanceM1M2(address, accel, m1_speed, m1_dist, m2_speed, m2_dist,
+                                                   1 if sent == 0 else 0):
+                break
+            sent += 1
+            queued += 1
+        with self.lock:
+            if self.segments is segments:
+                self.sent = sent
+        return True
+
+
+class Watchdog:
+    # Stops the motors when no command arrived for TIMEOUT seconds. Runs in its own thread and takes the link with
+    # priority so it only ever waits for the transaction in flight, however busy the control loop is. on_stop is
+    # called with the link still held once a stop went through.
+    def __init__(self, address, timeout, on_stop=None):
+        self.address = address
+        self.TIMEOUT = timeout
+        self.on_stop = on_stop
+        self.last_feed = clock()
+        self.stopped_feed = None
+        self.thread = Thread(target=run_watchdog, args=(self.run,), name="roboclaw_watchdog")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def feed(self):
+        self.last_feed = clock()
+
+    def run(self):
+        period = watchdog_period(self.TIMEOUT)
+        while not rospy.is_shutdown():
+            time.sleep(period)
+            last_feed = self.last_feed
+            if last_feed == self.stopped_feed or clock() - last_feed < self.TIMEOUT:
+                continue
+            rospy.logdebug("Did not get comand for %.2f seconds, stopping", self.TIMEOUT)
+            if not self.stop(last_feed):
+                rospy.logerr("Could not stop")
+
+    # Only counts as stopped once the controller acknowledged both writes. The stop is recorded before the link is
+    # released, otherwise the control loop could slip in and send the ramp toward the old target again.
+    def stop(self, last_feed):
+        with roboclaw.Exclusive():
+            for i in range(3):
+                try:
+                    if roboclaw.ForwardM1(self.address, 0) and roboclaw.ForwardM2(self.address, 0):
+                        self.stopped_feed = last_feed
+                        if self.on_stop is not None:
+                            self.on_stop()
+                        return True
+                except OSError as e:
+                    rospy.logdebug(e)
+        return False
 
 
 class Node:
     def __init__(self):
-
-        self.ERRORS = {0x0000: (diagnostic_msgs.msg.DiagnosticStatus.OK, "Normal"),
-                       0x0001: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "M1 over current"),
-                       0x0002: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "M2 over current"),
-                       0x0004: (diagnostic_msgs.msg.DiagnosticStatus.ERROR, "Emergency Stop"),
-                       0x0008: (diagnostic_msgs.msg.DiagnosticStatus.ERROR, "Temperature1"),
-                       0x0010: (diagnostic_msgs.msg.DiagnosticStatus.ERROR, "Temperature2"),
-                       0x0020: (diagnostic_msgs.msg.DiagnosticStatus.ERROR, "Main batt voltage high"),
-                       0x0040: (diagnostic_msgs.msg.DiagnosticStatus.ERROR, "Logic batt voltage high"),
-                       0x0080: (diagnostic_msgs.msg.DiagnosticStatus.ERROR, "Logic batt voltage low"),
-                       0x0100: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "M1 driver fault"),
-                       0x0200: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "M2 driver fault"),
-                       0x0400: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "Main batt voltage high"),
-                       0x0800: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "Main batt voltage low"),
-                       0x1000: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "Temperature1"),
-                       0x2000: (diagnostic_msgs.msg.DiagnosticStatus.WARN, "Temperature2"),
-                       0x4000: (diagnostic_msgs.msg.DiagnosticStatus.OK, "M1 home"),
-                       0x8000: (diagnostic_msgs.msg.DiagnosticStatus.OK, "M2 home")}
+        self.state = RUNNING
+        self.subscribers = []
 
         rospy.init_node("roboclaw_node")
         rospy.on_shutdown(self.shutdown)
         rospy.loginfo("Connecting to roboclaw")
         dev_name = rospy.get_param("~dev", "/dev/ttyACM0")
         baud_rate = int(rospy.get_param("~baud", "115200"))
+        transport = rospy.get_param("~transport", "serial")
+        self.LOW_LATENCY = bool(rospy.get_param("~low_latency", False))
 
         self.address = int(rospy.get_param("~address", "128"))
+        self.SHUTDOWN_TIMEOUT = float(rospy.get_param("~shutdown_timeout", "1.0"))
+        self.FAST_START = bool(rospy.get_param("~fast_start", False))
+        self.HANDSHAKE_TIMEOUT = float(rospy.get_param("~handshake_timeout", "2.0"))
+        self.phase_times = []
+        start_time = clock()
         if self.address > 0x87 or self.address < 0x80:
             rospy.logfatal("Address out of range")
             rospy.signal_shutdown("Address out of range")
 
-        # TODO need someway to check if address is correct
+        # Probes baud rates and addresses when the configured ones do not answer, results are cached per device
+        if rospy.get_param("~autodiscover", False):
+            try:
+                found = discover(dev_name, baud_rate, self.address, transport=transport)
+            except Exception as e:
+                found = None
+                rospy.logdebug(e)
+            if found is None:
+                rospy.logfatal("No Roboclaw found on %s", dev_name)
+                rospy.signal_shutdown("No Roboclaw found")
+            else:
+                baud_rate, self.address, version = found
+                rospy.loginfo("Found Roboclaw %s at baud %d address %d", version.strip(), baud_rate, self.address)
+            self.phase_times.append(("discovery", clock() - start_time))
+
+        phase_start = clock()
         try:
-            roboclaw.Open(dev_name, baud_rate)
+            tuning = roboclaw.Open(dev_name, baud_rate, transport=transport, low_latency=self.LOW_LATENCY)
+            if self.LOW_LATENCY:
+                self.log_tuning(dev_name, tuning)
         except Exception as e:
             rospy.logfatal("Could not connect to Roboclaw")
             rospy.logdebug(e)
             rospy.signal_shutdown("Could not connect to Roboclaw")
 
+        self.recorder = None
+        record_file = rospy.get_param("~record_file", "")
+        if record_file:
+            rospy.loginfo("Recording serial traffic to %s", record_file)
+            self.recorder = roboclaw.StartRecording(record_file)
+
+        self.phase_times.append(("open", clock() - phase_start))
+
+        # With fast_start the device handshake runs while the ROS side is being set up
+        self.handshake_thread = None
+        if self.FAST_START:
+            self.handshake_thread = Thread(target=self.handshake, name="roboclaw_handshake")
+            self.handshake_thread.start()
+        else:
+            self.handshake()
+
+        phase_start = clock()
+        load_heavy_modules()
         self.updater = diagnostic_updater.Updater()
         self.updater.setHardwareID("Roboclaw")
         self.updater.add(diagnostic_updater.
                          FunctionDiagnosticTask("Vitals", self.check_vitals))
 
-        try:
-            version = roboclaw.ReadVersion(self.address)
-        except Exception as e:
-            rospy.logwarn("Problem getting roboclaw version")
-            rospy.logdebug(e)
-            pass
-
-        if not version[0]:
-            rospy.logwarn("Could not get version from roboclaw")
-        else:
-            rospy.logdebug(repr(version[1]))
-
-        roboclaw.SpeedM1M2(self.address, 0, 0)
-        roboclaw.ResetEncoders(self.address)
+        # The motor mapping of a single differential drive controller, see roboclaw_multi_node.py for anything else
+        global g_invert_motor_axes, g_flip_left_right_motors
+        g_invert_motor_axes = bool(rospy.get_param("~invert_motor_axes", g_invert_motor_axes))
+        g_flip_left_right_motors = bool(rospy.get_param("~flip_left_right_motors", g_flip_left_right_motors))
 
         self.MAX_SPEED = float(rospy.get_param("~max_speed", "2.0"))
         self.TICKS_PER_METER = float(rospy.get_param("~ticks_per_meter", "4342.2"))
         self.BASE_WIDTH = float(rospy.get_param("~base_width", "0.315"))
 
+        self.STATS_RATE = float(rospy.get_param("~stats_rate", "1.0"))
+
         self.encodm = EncoderOdom(self.TICKS_PER_METER, self.BASE_WIDTH)
-        self.last_set_speed_time = rospy.get_rostime()
+        self.enc1 = roboclaw.EncoderResult()
+        self.enc2 = roboclaw.EncoderResult()
+        self.read_errors = {}
+        self.link_monitor = LinkMonitor(1.0 / self.STATS_RATE)
+
+        # Raw samples for co-located processes, see roboclaw_driver.shm.TelemetryReader
+        self.telemetry = None
+        shm_path = rospy.get_param("~shm_path", "")
+        if shm_path:
+            load_shm_modules()
+            self.telemetry = TelemetrySampler(TelemetryWriter(shm_path, int(rospy.get_param("~shm_slots", "1024"))),
+                                              self.address)
+        self.CMD_TIMEOUT = cmd_timeout_param()
+        self.CONTROLLER_TIMEOUT = float(rospy.get_param("~controller_timeout", "2.0"))
+        self.watchdog = Watchdog(self.address, self.CMD_TIMEOUT, self.watchdog_stopped)
+
+        # (name, readers, message, slots, scale, default deadband), a field is sampled when its ~<name>_rate is above 0
+        fields = (("currents", ((roboclaw.ReadCurrents, 2),), "MotorCurrents", ("m1", "m2"), 0.01, 0.05),
+                  ("pwms", ((roboclaw.ReadPWMs, 2),), "MotorPWMs", ("m1", "m2"), 1.0 / 32767, 0.01),
+                  ("temperatures", ((roboclaw.ReadTemp, 1), (roboclaw.ReadTemp2, 1)), "Temperatures",
+                   ("temp1", "temp2"), 0.1, 0.5),
+                  ("voltages", ((roboclaw.ReadMainBatteryVoltage, 1), (roboclaw.ReadLogicBatteryVoltage, 1)),
+                   "BatteryVoltages", ("main", "logic"), 0.1, 0.1))
+        self.telemetry_rates = {}
+        telemetry_fields = []
+        for name, readers, msg_name, slots, scale, deadband in fields:
+            rate = float(rospy.get_param("~%s_rate" % name, "0.0"))
+            deadband = float(rospy.get_param("~%s_deadband" % name, deadband))
+            self.telemetry_rates[name] = (rate, deadband)
+            if rate > 0:
+                msg_class = getattr(load_messages(), msg_name)
+                telemetry_fields.append(TelemetryField(name, readers, msg_class, slots, scale, rate, deadband))
+        self.TELEMETRY_BACKOFF = float(rospy.get_param("~telemetry_backoff", "8.0"))
+        self.telemetry_publisher = TelemetryPublisher(self, telemetry_fields, self.TELEMETRY_BACKOFF)
+
+        # Backstop for when the node itself stalls, the Roboclaw stops on its own once the link goes quiet
+        if self.CONTROLLER_TIMEOUT > 0:
+            try:
+                if not roboclaw.SetSerialTimeout(self.address, min(255, int(self.CONTROLLER_TIMEOUT * 10))):
+                    rospy.logwarn("Roboclaw did not accept serial timeout")
+            except OSError as e:
+                rospy.logwarn("SetSerialTimeout OSError: %d", e.errno)
+                rospy.logdebug(e)
+
+        # Acceleration limited command path, 0 keeps the plain SpeedM1M2 steps
+        self.ramp = None
+        max_accel = float(rospy.get_param("~max_accel", "0.0"))
+        if max_accel > 0.0:
+            self.ramp = RampGenerator(max_accel, float(rospy.get_param("~max_jerk", "0.0")))
+
+        self.trajectory = TrajectoryStreamer(self, float(rospy.get_param("~trajectory_accel", "1.0")),
+                                             int(rospy.get_param("~trajectory_buffer", "4")),
+                                             float(rospy.get_param("~trajectory_margin", "2.0")))
+
+        # Phase timings of the control loop and cmd_vel, ~dump_profile runs cProfile over both for a window
+        self.PROFILE = bool(rospy.get_param("~profile", False))
+        self.PROFILE_PERIOD = float(rospy.get_param("~profile_period", "10.0"))
+        self.PROFILE_WINDOW = float(rospy.get_param("~profile_window", "10.0"))
+        self.PROFILE_DIR = os.path.expanduser(rospy.get_param("~profile_dir", "~/.ros"))
+        self.profiler = Profiler(self.PROFILE)
+        self.profile_values = []
+        self.last_profile = clock()
+        if self.PROFILE:
+            load_profile_modules()
+            rospy.Service("~dump_profile", Trigger, self.dump_profile)
+
+        # Pipeline latency, TwistStamped commands on cmd_vel_stamped add the time from their stamp
+        self.MEASURE_LATENCY = bool(rospy.get_param("~measure_latency", False))
+        self.LATENCY_PERIOD = float(rospy.get_param("~latency_period", "10.0"))
+        self.latency = LatencyMonitor(self.LATENCY_PERIOD) if self.MEASURE_LATENCY else None
+
+        self.phase_times.append(("ros setup", clock() - phase_start))
+
+        if self.FAST_START:
+            phase_start = clock()
+            self.handshake_thread.join(self.HANDSHAKE_TIMEOUT)
+            if self.handshake_thread.is_alive():
+                rospy.logwarn("Roboclaw handshake did not finish within %.1f seconds, the control loop waits up to as "
+                              "long again for it", self.HANDSHAKE_TIMEOUT)
+            self.phase_times.append(("handshake wait", clock() - phase_start))
 
-        rospy.Subscriber("cmd_vel", Twist, self.cmd_vel_callback)
+        self.subscribers.append(rospy.Subscriber("cmd_vel", Twist, self.cmd_vel_callback))
+        self.subscribers.append(rospy.Subscriber("cmd_trajectory", JointTrajectory, self.trajectory_callback))
+        if self.MEASURE_LATENCY:
+            self.subscribers.append(rospy.Subscriber("cmd_vel_stamped", TwistStamped, self.cmd_vel_stamped_callback))
 
-        rospy.sleep(1)
+        if not self.FAST_START:
+            rospy.sleep(1)
+        rospy.loginfo("Startup took %.3f s: %s", clock() - start_time,
+                      ", ".join("%s %.3f s" % phase for phase in self.phase_times))
 
         rospy.logdebug("dev %s", dev_name)
         rospy.logdebug("baud %d", baud_rate)
+        rospy.logdebug("transport %s", transport)
+        rospy.logdebug("low_latency %s", self.LOW_LATENCY)
         rospy.logdebug("address %d", self.address)
+        rospy.logdebug("invert_motor_axes %s", g_invert_motor_axes)
+        rospy.logdebug("flip_left_right_motors %s", g_flip_left_right_motors)
         rospy.logdebug("max_speed %f", self.MAX_SPEED)
         rospy.logdebug("ticks_per_meter %f", self.TICKS_PER_METER)
         rospy.logdebug("base_width %f", self.BASE_WIDTH)
+        rospy.logdebug("stats_rate %f", self.STATS_RATE)
+        rospy.logdebug("cmd_timeout %f", self.CMD_TIMEOUT)
+        rospy.logdebug("controller_timeout %f", self.CONTROLLER_TIMEOUT)
+        rospy.logdebug("shutdown_timeout %f", self.SHUTDOWN_TIMEOUT)
+        rospy.logdebug("fast_start %s", self.FAST_START)
+        for name in sorted(self.telemetry_rates):
+            rospy.logdebug("%s_rate %f deadband %f", name, *self.telemetry_rates[name])
+        rospy.logdebug("telemetry_backoff %f", self.TELEMETRY_BACKOFF)
+        rospy.logdebug("profile %s period %f window %f dir %s", self.PROFILE, self.PROFILE_PERIOD, self.PROFILE_WINDOW,
+                       self.PROFILE_DIR)
+        rospy.logdebug("measure_latency %s period %f", self.MEASURE_LATENCY, self.LATENCY_PERIOD)
+
+    def log_tuning(self, dev_name, tuning):
+        if not tuning:
+            rospy.logwarn("%s is not a tty, low_latency has no effect", dev_name)
+            return
+        rospy.loginfo("Serial tuning: %s", ", ".join("%s %s" % item for item in sorted(tuning.items())))
+        if tuning.get('latency_timer') is not None and tuning['latency_timer'] > 1:
+            rospy.logwarn("FTDI latency timer is %d ms and could not be lowered, see the README for a udev rule",
+                          tuning['latency_timer'])
+        if not tuning.get('low_latency'):
+            rospy.logwarn("%s does not support ASYNC_LOW_LATENCY", dev_name)
+
+    def handshake(self):
+        phase_start = clock()
+        version = (0, 0)
+        try:
+            version = roboclaw.ReadVersion(self.address)
+        except Exception as e:
+            rospy.logwarn("Problem getting roboclaw version")
+            rospy.logdebug(e)
+
+        if not version[0]:
+            rospy.logwarn("Could not get version from roboclaw")
+        else:
+            rospy.logdebug(repr(version[1]))
+
+        try:
+            roboclaw.SpeedM1M2(self.address, 0, 0)
+            roboclaw.ResetEncoders(self.address)
+        except OSError as e:
+            rospy.logwarn("Handshake OSError: %d", e.errno)
+            rospy.logdebug(e)
+        self.phase_times.append(("handshake", clock() - phase_start))
 
     def run(self):
+        # The handshake resets the encoders, odometry started before that would jump when it happens
+        if self.handshake_thread is not None and self.handshake_thread.is_alive():
+            self.handshake_thread.join(self.HANDSHAKE_TIMEOUT)
+            if self.handshake_thread.is_alive():
+                rospy.logfatal("Roboclaw handshake did not finish, not starting the motor drive")
+                rospy.signal_shutdown("Roboclaw handshake did not finish")
+                return
+            rospy.loginfo("Roboclaw handshake finished")
         rospy.loginfo("Starting motor drive")
         r_time = rospy.Rate(10)
+        self.watchdog.start()
+        self.telemetry_publisher.start()
+        profiler = self.profiler
         while not rospy.is_shutdown():
+            with profiler.profiled(), profiler.phase("cycle"):
 
-            if (rospy.get_rostime() - self.last_set_speed_time).to_sec() > 1:
-                rospy.logdebug("Did not get comand for 1 second, stopping")
-                try:
-                    roboclaw.ForwardM1(self.address, 0)
-                    roboclaw.ForwardM2(self.address, 0)
-                except OSError as e:
-                    rospy.logerr("Could not stop")
-                    rospy.logdebug(e)
+                # Motion commands check the state while holding the link so none can slip in behind the shutdown stop
+                with profiler.phase("commands"), roboclaw.Exclusive(False):
+                    if self.state == RUNNING:
+                        # A running trajectory counts as a live command for the watchdog
+                        try:
+                            if self.trajectory.tick():
+                                self.watchdog.feed()
+                        except OSError as e:
+                            rospy.logwarn("Trajectory OSError: %d", e.errno)
+                            rospy.logdebug(e)
 
-            # TODO need find solution to the OSError11 looks like sync problem with serial
-            status1, enc1, crc1 = None, None, None
-            status2, enc2, crc2 = None, None, None
+                        # After a watchdog stop the ramp was reset with the link held, see watchdog_stopped
+                        if self.ramp is not None:
+                            self.send_ramp()
 
+                # A failed read skips this cycle's odometry
+                read_start = clock()
+                with profiler.phase("encoders"):
+                    ok1 = self.read_encoder(roboclaw.ReadEncM1, self.enc1)
+                    ok2 = self.read_encoder(roboclaw.ReadEncM2, self.enc2)
+                if ok1 and ok2:
+                    enc1 = self.enc1.value
+                    enc2 = self.enc2.value
+                    if self.telemetry is not None:
+                        with profiler.phase("shm"):
+                            self.write_telemetry(enc1, enc2)
 
-            try:
-                status1, enc1, crc1 = roboclaw.ReadEncM1(self.address)
-            except ValueError:
-                pass
-            except OSError as e:
-                rospy.logwarn("ReadEncM1 OSError: %d", e.errno)
-                rospy.logdebug(e)
+                    with profiler.phase("odometry"):
+                        if (g_invert_motor_axes):
+                            enc1 = -enc1
+                            enc2 = -enc2
 
-            try:
-                status2, enc2, crc2 = roboclaw.ReadEncM2(self.address)
-            except ValueError:
-                pass
-            except OSError as e:
-                rospy.logwarn("ReadEncM2 OSError: %d", e.errno)
-                rospy.logdebug(e)
+                        if (g_flip_left_right_motors):
+                            enc1, enc2 = enc2, enc1
 
-            #if (enc1 in locals()) and (enc2 in locals()):
-	    try:
-		if (g_invert_motor_axes):
-			enc1 = -enc1;
-			enc2 = -enc2;
+                        rospy.logdebug(" Encoders %d %d" % (enc1, enc2))
+                        valid = self.encodm.valid(enc2, enc1)  # left, right
+                        if valid:
+                            vel_x, vel_theta = self.encodm.update(enc2, enc1)
 
-                if (g_flip_left_right_motors):
-			enc1_t = enc1;
-			enc2_t = enc2;
+                    if valid:
+                        with profiler.phase("publish"):
+                            self.encodm.publish_odom(self.encodm.cur_x, self.encodm.cur_y, self.encodm.cur_theta,
+                                                     vel_x, vel_theta)
+                        if self.latency is not None:
+                            self.latency.odom_published(read_start)
 
-			enc2 = enc1_t;
-			enc1 = enc2_t;
-			
+                # A failing diagnostic task must not take the control loop and the watchdog feed with it
+                with profiler.phase("diagnostics"):
+                    try:
+                        self.link_monitor.tick()
+                        self.updater.update()
+                    except Exception as e:
+                        rospy.logerr("Diagnostics failed: %s", e)
+                        rospy.logdebug(e, exc_info=True)
 
-                rospy.logdebug(" Encoders %d %d" % (enc1, enc2))
-                self.encodm.update_publish(enc2, enc1) #update_publish expects enc_left enc_right
+            self.report_profile()
+            if self.latency is not None:
+                self.latency.tick()
+            r_time.sleep()
 
-                self.updater.update()
-            except:
-		print("problems reading encoders")
+    def report_profile(self):
+        if not self.PROFILE or clock() - self.last_profile < self.PROFILE_PERIOD:
+            return
+        self.last_profile = clock()
+        values = []
+        for name, stats in self.profiler.summary():
+            if stats['count']:
+                values.append(("%s n/mean/p99/max ms" % name, "%d/%.2f/%.2f/%.2f" % (
+                    stats['count'], stats['mean'] * 1000, stats['p99'] * 1000, stats['max'] * 1000)))
+        self.profile_values = values
+        rospy.loginfo("Profile: %s", ", ".join("%s %s" % value for value in values))
 
-            r_time.sleep()
+    # Answers once the capture window is over, the control loop keeps running meanwhile
+    def dump_profile(self, request):
+        path = os.path.join(self.PROFILE_DIR, "roboclaw_node_%s.pstats" % time.strftime("%Y%m%d_%H%M%S"))
+        try:
+            functions = self.profiler.capture(self.PROFILE_WINDOW, path)
+        except (IOError, OSError, ValueError) as e:
+            return TriggerResponse(False, str(e))
+        if functions is None:
+            return TriggerResponse(False, "A capture is already running")
+        if not functions:
+            return TriggerResponse(False, "Nothing was profiled in %.1f s" % self.PROFILE_WINDOW)
+        rospy.loginfo("Profile of %d functions written to %s", functions, path)
+        return TriggerResponse(True, path)
+
+    # Failures come back as a cleared ok flag and LastError tells why, without an exception on the hot path
+    def read_encoder(self, reader, out):
+        try:
+            if reader(self.address, out).ok:
+                return True
+        except OSError as e:
+            rospy.logwarn("%s OSError: %d", reader.__name__, e.errno)
+            rospy.logdebug(e)
+            return False
+        error = roboclaw.LastError() or roboclaw.RoboclawError
+        self.read_errors[error.__name__] = self.read_errors.get(error.__name__, 0) + 1
+        rospy.logdebug("%s failed: %s", reader.__name__, error.MESSAGE)
+        # A bad crc is often the tail of an earlier reply, which would garble the following ones too. A timeout is
+        # simply retried next cycle.
+        if error is roboclaw.CrcMismatch or error is roboclaw.Desync:
+            roboclaw.Resync()
+        return False
+
+    def write_telemetry(self, enc1, enc2):
+        try:
+            if self.telemetry.sample(enc1, enc2):
+                return
+        except OSError as e:
+            rospy.logwarn("Telemetry OSError: %d", e.errno)
+            rospy.logdebug(e)
+            return
+        error = roboclaw.LastError() or roboclaw.RoboclawError
+        rospy.logdebug("Telemetry sample skipped: %s", error.MESSAGE)
+
+    # Maps right/left wheel values in meters to M1/M2 ticks
+    def motor_ticks(self, vr, vl):
+        if g_invert_motor_axes:
+            vr = -vr
+            vl = -vl
+        if g_flip_left_right_motors:
+            vr, vl = vl, vr
+        return int(vr * self.TICKS_PER_METER), int(vl * self.TICKS_PER_METER)
 
-    def cmd_vel_callback(self, twist):
-        self.last_set_speed_time = rospy.get_rostime()
+    # Called by the watchdog with the link held, the ramp has to start again from standstill
+    def watchdog_stopped(self):
+        if self.ramp is not None:
+            self.ramp.reset()
+
+    # True when the controller acknowledged a command
+    def send_ramp(self):
+        command = self.ramp.step(clock())
+        if command is None:
+            # The controller is already ramping toward the target
+            return True
+        accel_r, vr, accel_l, vl = command
+        accel_m1, accel_m2 = self.motor_ticks(accel_r, accel_l)
+        vr_ticks, vl_ticks = self.motor_ticks(vr, vl)
+        rospy.logdebug("vr_ticks:%d vl_ticks: %d accel %d %d", vr_ticks, vl_ticks, accel_m1, accel_m2)
+        try:
+            return roboclaw.SpeedAccelM1M2_2(self.address, max(1, abs(accel_m1)), vr_ticks, max(1, abs(accel_m2)),
+                                             vl_ticks)
+        except OSError as e:
+            rospy.logwarn("SpeedAccelM1M2_2 OSError: %d", e.errno)
+            rospy.logdebug(e)
+            return False
+
+    def trajectory_callback(self, trajectory):
+        self.watchdog.feed()
+        self.telemetry_publisher.wake()
+        if self.ramp is not None:
+            self.ramp.reset()
+        self.trajectory.set_trajectory(trajectory)
+
+    def cmd_vel_callback(self, twist, stamp=None):
+        received = clock()
+        acked = False
+        with self.profiler.profiled(), self.profiler.phase("cmd_vel"):
+            with roboclaw.Exclusive(False):
+                if self.state == RUNNING:
+                    acked = self.drive(twist)
+        if acked and self.latency is not None:
+            self.latency.command_acked(received, stamp)
+
+    def cmd_vel_stamped_callback(self, msg):
+        self.cmd_vel_callback(msg.twist, msg.header.stamp)
+
+    # True when the controller acknowledged the command
+    def drive(self, twist):
+        self.watchdog.feed()
+        self.telemetry_publisher.wake()
+        # The controller still runs the segments it has queued, the ramp has to send the target whatever it is
+        if self.trajectory.cancel() and self.ramp is not None:
+            self.ramp.resend()
 
         linear_x = twist.linear.x
         if linear_x > self.MAX_SPEED:
@@ -267,43 +932,37 @@ class Node:
         vr = linear_x + twist.angular.z * self.BASE_WIDTH / 2.0  # m/s
         vl = linear_x - twist.angular.z * self.BASE_WIDTH / 2.0
 
-	if (g_invert_motor_axes):
-		vr = -vr
-		vl = -vl
-
-	if (g_flip_left_right_motors):
-		vr_t = vr
-		vl_t = vl
-		vr = vl_t
-		vl = vr_t
-
+        if self.ramp is not None:
+            self.ramp.set_target(vr, vl)
+            return self.send_ramp()
 
-        vr_ticks = int(vr * self.TICKS_PER_METER)  # ticks/s
-        vl_ticks = int(vl * self.TICKS_PER_METER)
+        vr_ticks, vl_ticks = self.motor_ticks(vr, vl)  # ticks/s
 
         rospy.logdebug("vr_ticks:%d vl_ticks: %d", vr_ticks, vl_ticks)
 
         try:
             # This is a hack way to keep a poorly tuned PID from making noise at speed 0
-            if vr_ticks is 0 and vl_ticks is 0:
-                roboclaw.ForwardM1(self.address, 0)
-                roboclaw.ForwardM2(self.address, 0)
-            else:
-                roboclaw.SpeedM1M2(self.address, vr_ticks, vl_ticks)
+            if vr_ticks == 0 and vl_ticks == 0:
+                ok1 = roboclaw.ForwardM1(self.address, 0)
+                ok2 = roboclaw.ForwardM2(self.address, 0)
+                return ok1 and ok2
+            return roboclaw.SpeedM1M2(self.address, vr_ticks, vl_ticks)
         except OSError as e:
             rospy.logwarn("SpeedM1M2 OSError: %d", e.errno)
             rospy.logdebug(e)
+            return False
 
-    # TODO: Need to make this work when more than one error is raised
     def check_vitals(self, stat):
         try:
-            status = roboclaw.ReadError(self.address)[1]
+            error = roboclaw.ReadError(self.address)
         except OSError as e:
             rospy.logwarn("Diagnostics OSError: %d", e.errno)
             rospy.logdebug(e)
             return
-        state, message = self.ERRORS[status]
-        stat.summary(state, message)
+        if not error[0]:
+            stat.summary(DiagnosticStatus.WARN, "Could not read the error status")
+        else:
+            stat.summary(*decode_status(error[1]))
         try:
             stat.add("Main Batt V:", float(roboclaw.ReadMainBatteryVoltage(self.address)[1] / 10))
             stat.add("Logic Batt V:", float(roboclaw.ReadLogicBatteryVoltage(self.address)[1] / 10))
@@ -312,22 +971,50 @@ class Node:
         except OSError as e:
             rospy.logwarn("Diagnostics OSError: %d", e.errno)
             rospy.logdebug(e)
+        for name in sorted(self.read_errors):
+            stat.add("Encoder read %s" % name, self.read_errors[name])
+        if self.recorder is not None:
+            stat.add("Capture records dropped", self.recorder.dropped)
+        if self.telemetry is not None:
+            stat.add("Shared telemetry samples skipped", self.telemetry.skipped)
+        for key, value in self.link_monitor.values:
+            stat.add(key, value)
+        for key, value in self.profile_values:
+            stat.add(key, value)
+        if self.latency is not None:
+            for key, value in self.latency.values:
+                stat.add(key, value)
         return stat
 
-    # TODO: need clean shutdown so motors stop even if new msgs are arriving
+    # Stops taking commands, then owns the link until a single stop is acknowledged and both speeds read back 0
     def shutdown(self):
         rospy.loginfo("Shutting down")
-        try:
-            roboclaw.ForwardM1(self.address, 0)
-            roboclaw.ForwardM2(self.address, 0)
-        except OSError:
-            rospy.logerr("Shutdown did not work trying again")
-            try:
-                roboclaw.ForwardM1(self.address, 0)
-                roboclaw.ForwardM2(self.address, 0)
-            except OSError as e:
+        for subscriber in self.subscribers:
+            subscriber.unregister()
+        deadline = clock() + self.SHUTDOWN_TIMEOUT
+        acked = False
+        with roboclaw.Exclusive():
+            self.state = STOPPING
+            while self.state == STOPPING and clock() < deadline:
+                try:
+                    if not acked:
+                        acked = roboclaw.DutyM1M2(self.address, 0, 0)
+                        continue
+                    speed1 = roboclaw.ReadSpeedM1(self.address)
+                    speed2 = roboclaw.ReadSpeedM2(self.address)
+                    if speed1[0] and speed2[0] and speed1[1] == 0 and speed2[1] == 0:
+                        self.state = STOPPED
+                except OSError as e:
+                    rospy.logdebug(e)
+        if self.state != STOPPED:
+            if acked:
+                rospy.logwarn("Motors stopped but still turning after %.1f seconds", self.SHUTDOWN_TIMEOUT)
+            else:
                 rospy.logerr("Could not shutdown motors!!!!")
-                rospy.logdebug(e)
+        recorder = roboclaw.StopRecording()
+        if recorder is not None and recorder.dropped:
+            rospy.logwarn("%d records were dropped from the capture %s, the recorder could not keep up",
+                          recorder.dropped, recorder.path)
 
 
 if __name__ == "__main__":
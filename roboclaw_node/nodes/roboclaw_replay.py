@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+import argparse
+import sys
+import time
+
+from roboclaw_driver import replay
+
+# Feeds a capture made with ~record_file back through the driver decoders and the odometry, as fast as possible. With
+# --compare the trajectory is checked against an earlier one instead, for captures kept as regression fixtures.
+
+
+def run(args):
+    txns = replay.load_transactions(args.capture)
+    if not txns:
+        sys.stderr.write("No transactions in %s\n" % args.capture)
+        return 1
+    start = time.time()
+    samples, decoded = replay.encoder_samples(txns)
+    rows = replay.odometry(samples, args.ticks_per_meter, args.base_width, txns[0][0], args.invert_motor_axes,
+                           args.flip_left_right_motors)
+    wall = time.time() - start
+
+    duration = txns[-1][0] - txns[0][0]
+    sys.stderr.write("%d transactions, %d encoder reads decoded, %d odometry samples\n" %
+                     (len(txns), decoded, len(rows[0])))
+    sys.stderr.write("capture %.1f s replayed in %.3f s (%.0fx real time), %.0f reads/s\n" %
+                     (duration, wall, duration / wall if wall else 0.0, decoded / wall if wall else 0.0))
+
+    if args.compare:
+        differences = replay.compare(replay.read_csv(args.compare), rows, args.tolerance)
+        for line in differences[:20]:
+            sys.stderr.write(line + "\n")
+        if differences:
+            sys.stderr.write("Trajectory differs from %s in %d values\n" % (args.compare, len(differences)))
+            return 1
+        sys.stderr.write("Trajectory matches %s\n" % args.compare)
+    if args.output:
+        with open(args.output, "w") as f:
+            replay.write_csv(f, rows)
+    elif not args.compare:
+        replay.write_csv(sys.stdout, rows)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a roboclaw serial capture through the odometry")
+    parser.add_argument("capture")
+    parser.add_argument("-o", "--output", help="trajectory csv, stdout if not given")
+    parser.add_argument("--compare", help="trajectory csv of an earlier replay, exits with 1 when they differ")
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="largest difference --compare accepts")
+    parser.add_argument("--ticks-per-meter", type=float, default=4342.2)
+    parser.add_argument("--base-width", type=float, default=0.315)
+    # The node's ~invert_motor_axes and ~flip_left_right_motors, the encoders are mapped the same way
+    parser.add_argument("--invert-motor-axes", dest="invert_motor_axes", action="store_true", default=True)
+    parser.add_argument("--no-invert-motor-axes", dest="invert_motor_axes", action="store_false")
+    parser.add_argument("--flip-left-right-motors", dest="flip_left_right_motors", action="store_true",
+                        default=False)
+    parser.add_argument("--no-flip-left-right-motors", dest="flip_left_right_motors", action="store_false")
+    args = parser.parse_args()
+    sys.exit(run(args))
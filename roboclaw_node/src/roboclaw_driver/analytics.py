@@ -0,0 +1,389 @@
+import numpy as np
+
+from .odometry import integrate
+from .recorder import _HEADER, DROP, FLUSH, MAGIC, READ, WRITE, supported
+from .roboclaw_driver import Cmd
+
+# Response layout per polled command: (series name, response length without crc, numpy dtype of the payload)
+_RESPONSES = {
+    Cmd.GETM1ENC: ('enc1', 5, np.dtype([('value', '>i4'), ('status', 'u1')])),
+    Cmd.GETM2ENC: ('enc2', 5, np.dtype([('value', '>i4'), ('status', 'u1')])),
+    Cmd.GETM1SPEED: ('speed1', 5, np.dtype([('value', '>i4'), ('status', 'u1')])),
+    Cmd.GETM2SPEED: ('speed2', 5, np.dtype([('value', '>i4'), ('status', 'u1')])),
+    Cmd.GETCURRENTS: ('currents', 4, np.dtype([('m1', '>i2'), ('m2', '>i2')])),
+    Cmd.GETPWMS: ('pwms', 4, np.dtype([('m1', '>i2'), ('m2', '>i2')])),
+    Cmd.GETMBATT: ('main_battery', 2, np.dtype([('value', '>u2')])),
+}
+
+# Commands setting the motors and per motor what they command: the offset of the speed in what was written, None when
+# they leave that motor alone, or 0 for the duty and forward/backward commands, which end speed control and are
+# taken as a commanded speed of 0 (the node stops the motors with them)
+_SPEED_COMMANDS = {
+    Cmd.M1FORWARD: (0, None),
+    Cmd.M1BACKWARD: (0, None),
+    Cmd.M2FORWARD: (None, 0),
+    Cmd.M2BACKWARD: (None, 0),
+    Cmd.M1DUTY: (0, None),
+    Cmd.M2DUTY: (None, 0),
+    Cmd.MIXEDDUTY: (0, 0),
+    Cmd.M1SPEED: (2, None),
+    Cmd.M2SPEED: (None, 2),
+    Cmd.MIXEDSPEED: (2, 6),
+    Cmd.M1SPEEDACCEL: (6, None),
+    Cmd.M2SPEEDACCEL: (None, 6),
+    Cmd.MIXEDSPEEDACCEL: (6, 10),
+    Cmd.MIXEDSPEED2ACCEL: (6, 14),
+}
+
+# Distance commands: per motor the offsets of the speed and of the distance in what was written or None, and the
+# offset of the buffer flag, 1 runs the command at once and 0 queues it behind the one the motor is running. Position
+# commands are not decoded, their speed is only a limit.
+_DISTANCE_COMMANDS = {
+    Cmd.M1SPEEDDIST: (((2, 6), None), 10),
+    Cmd.M2SPEEDDIST: ((None, (2, 6)), 10),
+    Cmd.MIXEDSPEEDDIST: (((2, 6), (10, 14)), 18),
+    Cmd.M1SPEEDACCELDIST: (((6, 10), None), 14),
+    Cmd.M2SPEEDACCELDIST: ((None, (6, 10)), 14),
+    Cmd.MIXEDSPEEDACCELDIST: (((6, 10), (14, 18)), 22),
+    Cmd.MIXEDSPEED2ACCELDIST: (((6, 10), (18, 22)), 26),
+}
+
+# One capture record header, see recorder._RECORD
+_RECORD = np.dtype([('stamp', '<f8'), ('direction', 'u1'), ('length', '<u2')])
+
+
+def _crc_table():
+    table = np.zeros(256, dtype=np.uint32)
+    for i in range(256):
+        crc = i << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table[i] = crc & 0xFFFF
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc16(rows):
+    # CRC of every row of a 2D uint8 array at once, looping over the columns only
+    crc = np.zeros(len(rows), dtype=np.uint32)
+    for column in rows.T:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[((crc >> 8) ^ column) & 0xFF]
+    return crc
+
+
+def _last_before(mask):
+    # Index of the last True strictly before each position, -1 where there is none
+    index = np.where(mask, np.arange(len(mask)), -1)
+    return np.concatenate(([-1], np.maximum.accumulate(index)[:-1]))
+
+
+def _fill_forward(values, known):
+    # Each unknown entry takes the last known one before it, 0 before the first
+    index = np.maximum.accumulate(np.where(known, np.arange(len(known)), -1))
+    return np.where(index >= 0, values[np.maximum(index, 0)], 0)
+
+
+def _gather(data, starts, count):
+    # count bytes from every start as a 2D array, one row per start
+    return data[np.asarray(starts, dtype=np.int64)[:, None] + np.arange(count)]
+
+
+def read_records(path):
+    # The records of a capture as (headers, payload offsets, file bytes), headers a structured array of _RECORD.
+    # Only the walk from one header to the next is a Python loop, a truncated last payload is cut short.
+    with open(path, 'rb') as f:
+        raw = f.read()
+    magic, version = _HEADER.unpack_from(raw)
+    if magic != MAGIC or not supported(version):
+        raise ValueError("%s is not a roboclaw capture" % path)
+    buf = bytearray(raw)
+    offsets = []
+    pos = _HEADER.size
+    end = len(buf) - _RECORD.itemsize
+    while pos <= end:
+        offsets.append(pos)
+        pos += _RECORD.itemsize + (buf[pos + 9] | buf[pos + 10] << 8)
+    data = np.frombuffer(raw, dtype=np.uint8)
+    offsets = np.array(offsets, dtype=np.int64)
+    headers = _gather(data, offsets, _RECORD.itemsize).view(_RECORD).ravel()
+    payloads = offsets + _RECORD.itemsize
+    headers['length'] = np.minimum(headers['length'], len(data) - payloads)
+    return headers, payloads, data
+
+
+def _attempts(direction):
+    # Same split into command attempts as replay.transactions, which ends an attempt that has written at a flush, or
+    # at a write once there was a response. A DROP splits like a flush and the attempt it ends is lost. Returns the
+    # attempt of every record and the lost attempts.
+    write = direction == WRITE
+    read = direction == READ
+    drop = direction == DROP
+    flush = (direction == FLUSH) | drop
+    # Something was written since the last reset: there was a write and no flush after it, as a flush after a write
+    # always ends the attempt
+    written = _last_before(write) > _last_before(flush)
+    ends = flush & written
+    # A write after a response ends the attempt unless the attempt already ended since that response, at a flush or
+    # at an earlier write
+    blocked = _last_before(ends | (write & written)) > _last_before(read)
+    ends |= write & written & (_last_before(read) >= 0) & ~blocked
+    # A flush ends its attempt, a write starts the next one
+    attempt = np.cumsum(ends) - (ends & flush)
+    return attempt, np.unique(attempt[ends & drop])
+
+
+def _streams(headers, payloads, data, attempt, direction, count):
+    # The bytes one direction of every attempt carried, as (bytes, start of each attempt in them, length per attempt)
+    records = np.flatnonzero((headers['direction'] == direction) & (headers['length'] > 0))
+    lengths = headers['length'][records].astype(np.int64)
+    first = np.cumsum(lengths) - lengths
+    index = np.repeat(payloads[records] - first, lengths) + np.arange(lengths.sum())
+    size = np.bincount(attempt[records], weights=lengths, minlength=count).astype(np.int64)
+    return data[index], np.cumsum(size) - size, size
+
+
+def split_attempts(path):
+    # The command attempts of a capture as (stamps, written, written_at, written_size, response, response_at,
+    # response_size), see _streams. Attempts with nothing written are the ones lost at a DROP, the others are what
+    # replay.transactions gives.
+    headers, payloads, buf = read_records(path)
+    direction = headers['direction']
+    # Records without bytes change nothing but a flush. Responses after a DROP up to the next write belong to a write
+    # that was lost.
+    stale = (direction == READ) & (_last_before(direction == DROP) >
+                                   _last_before((direction == WRITE) & (headers['length'] > 0)))
+    keep = ((direction == FLUSH) | (headers['length'] > 0)) & ~stale
+    headers, payloads = headers[keep], payloads[keep]
+    attempt, lost = _attempts(headers['direction'])
+    count = attempt[-1] + 1 if len(attempt) else 0
+    written, written_at, written_size = _streams(headers, payloads, buf, attempt, WRITE, count)
+    written_size[lost] = 0
+    response, response_at, response_size = _streams(headers, payloads, buf, attempt, READ, count)
+    # An attempt is stamped with its first write
+    writes = np.flatnonzero(headers['direction'] == WRITE)
+    first, index = np.unique(attempt[writes], return_index=True)
+    stamps = np.zeros(count)
+    stamps[first] = headers['stamp'][writes[index]]
+    return stamps, written, written_at, written_size, response, response_at, response_size
+
+
+def _schedule(stamps, durations, immediate):
+    # Start and end of each command of one motor. A queued command starts when it is written or when the one before
+    # it ends, whichever is later, so end = max(stamp, previous end) + duration. That is the running maximum of
+    # stamp - durations before it, restarted at every immediate command, plus the durations up to the command.
+    total = np.cumsum(durations)
+    value = stamps - (total - durations)
+    if not len(value):
+        return value, value
+    group = np.cumsum(immediate)
+    low = value.min()
+    span = value.max() - low + 1.0
+    value = np.maximum.accumulate(value - low + group * span) - group * span + low
+    ends = value + total
+    return ends - durations, ends
+
+
+def _commanded(stamps, cmds, written, written_at, written_size):
+    # The commanded speeds of the acknowledged commands as (stamps, speeds), speeds with fields m1 and m2.
+    # A distance command runs for distance / speed seconds, acceleration ignored, then the motor stops unless a queued
+    # one follows. Any other command replaces what was running and queued.
+    times, motors, speeds, kinds = [], [], [], []
+    for motor in (0, 1):
+        index, speed, duration, immediate = [], [], [], []
+        for cmd, offsets in _SPEED_COMMANDS.items():
+            offset = offsets[motor]
+            if offset is None:
+                continue
+            found = np.flatnonzero(cmds == cmd)
+            if offset:
+                found = found[written_size[found] >= offset + 4]
+                speed.append(_gather(written, written_at[found] + offset, 4).view('>i4').ravel().astype(np.int64))
+            else:
+                speed.append(np.zeros(len(found), dtype=np.int64))
+            index.append(found)
+            duration.append(np.zeros(len(found)))
+            immediate.append(np.ones(len(found), dtype=bool))
+        for cmd, (offsets, flag) in _DISTANCE_COMMANDS.items():
+            if offsets[motor] is None:
+                continue
+            found = np.flatnonzero(cmds == cmd)
+            found = found[written_size[found] >= flag + 1]
+            at = written_at[found]
+            value = _gather(written, at + offsets[motor][0], 4).view('>i4').ravel().astype(np.int64)
+            distance = _gather(written, at + offsets[motor][1], 4).view('>u4').ravel().astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                duration.append(np.where(value != 0, distance / np.abs(value), 0.0))
+            index.append(found)
+            speed.append(value)
+            immediate.append(written[at + flag] != 0)
+        index = np.concatenate(index)
+        order = np.argsort(index, kind='mergesort')
+        index, speed = index[order], np.concatenate(speed)[order]
+        duration, immediate = np.concatenate(duration)[order], np.concatenate(immediate)[order]
+        if not len(index):
+            continue
+        is_distance = np.isin(cmds[index], list(_DISTANCE_COMMANDS))
+        # Nothing runs before the first command for the motor, a queued one starts when written
+        immediate[0] = True
+        start, end = _schedule(stamps[index], duration, immediate)
+        # Everything scheduled is cut off by the next immediate command
+        group = np.cumsum(immediate) - 1
+        limit = np.append(stamps[index][immediate][1:], np.inf)[group]
+        starts = start < limit
+        stops = is_distance & (end < limit)
+        times += [start[starts], end[stops]]
+        motors += [np.full(starts.sum(), motor), np.full(stops.sum(), motor)]
+        speeds += [speed[starts], np.zeros(stops.sum(), dtype=np.int64)]
+        # At the same time a stop goes before a start, the next queued command follows without a stop
+        kinds += [np.ones(starts.sum(), dtype=np.int64), np.zeros(stops.sum(), dtype=np.int64)]
+    if not times:
+        return np.zeros(0), np.zeros(0, dtype=[('m1', 'i8'), ('m2', 'i8')])
+    times, motors, speeds, kinds = [np.concatenate(values) for values in (times, motors, speeds, kinds)]
+    order = np.lexsort((kinds, times))
+    times, motors, speeds = times[order], motors[order], speeds[order]
+    commands = np.zeros(len(times), dtype=[('m1', 'i8'), ('m2', 'i8')])
+    # A command for one motor leaves the other at what it was last commanded
+    for motor in (0, 1):
+        field = 'm%d' % (motor + 1)
+        commands[field] = _fill_forward(np.where(motors == motor, speeds, 0), motors == motor)
+    last = np.append(times[1:] != times[:-1], True)
+    return times[last], commands[last]
+
+
+def load_capture(path):
+    # Decodes a capture made with ~record_file into {series: (stamps, values)}, responses failing the crc are dropped.
+    # values is a structured array per series, commanded speeds are in 'cmd_speed' with fields m1 and m2.
+    stamps, written, written_at, written_size, response, response_at, response_size = split_attempts(path)
+    sent = np.flatnonzero(written_size >= 2)
+    cmds = written[written_at[sent] + 1]
+
+    data = {}
+    for cmd, (name, length, dtype) in _RESPONSES.items():
+        found = sent[(cmds == cmd) & (response_size[sent] == length + 2)]
+        frames = np.hstack((_gather(written, written_at[found], 2), _gather(response, response_at[found], length + 2)))
+        crc = frames[:, -2].astype(np.uint32) << 8 | frames[:, -1]
+        valid = crc16(frames[:, :-2]) == crc
+        if len(found):
+            data[name] = (stamps[found[valid]], np.frombuffer(frames[valid, 2:-2].tobytes(), dtype=dtype))
+
+    acked = sent[response_size[sent] >= 1]
+    acked = acked[response[response_at[acked]] == 0xFF]
+    cmd_stamps, commands = _commanded(stamps[acked], written[written_at[acked] + 1], written, written_at[acked],
+                                      written_size[acked])
+    if len(cmd_stamps):
+        data['cmd_speed'] = (cmd_stamps, commands)
+    return data
+
+
+def resample(stamps, values, at):
+    # Last value at or before each time of at (zero order hold), the first value before the series starts
+    index = np.searchsorted(stamps, at, side='right') - 1
+    return values[np.clip(index, 0, len(values) - 1)]
+
+
+def pair_encoders(data):
+    # Each M2 read matched with the M1 read just before it, as the node polls them
+    t1, enc1 = data['enc1']
+    t2, enc2 = data['enc2']
+    index = np.searchsorted(t1, t2, side='right') - 1
+    valid = index >= 0
+    return t2[valid], enc1['value'][index[valid]].astype(np.int64), enc2['value'][valid].astype(np.int64)
+
+
+def odometry(data, ticks_per_meter, base_width, invert=True, flip=False):
+    # Replays the node odometry over the whole log, with the node's motor mapping
+    stamps, enc1, enc2 = pair_encoders(data)
+    if invert:
+        enc1, enc2 = -enc1, -enc2
+    if flip:
+        enc1, enc2 = enc2, enc1
+    x, y, theta, vel_x, vel_theta = integrate(enc2, enc1, stamps, ticks_per_meter, base_width,
+                                              last_enc=(enc2[0], enc1[0]) if len(stamps) else (0, 0))
+    return stamps, x, y, theta, vel_x, vel_theta
+
+
+def odometry_drift(x, y, theta):
+    # For logs that start and end at the same place: position and heading error and the error per meter driven
+    if not len(x):
+        return 0.0, 0.0, 0.0
+    position = np.hypot(x[-1] - x[0], y[-1] - y[0])
+    heading = np.abs(np.arctan2(np.sin(theta[-1] - theta[0]), np.cos(theta[-1] - theta[0])))
+    path = np.sum(np.hypot(np.diff(x), np.diff(y)))
+    return position, heading, position / path if path else 0.0
+
+
+def tracking_error(data, motor):
+    # Measured minus commanded speed in ticks/s at every speed read of the motor (1 or 2)
+    stamps, speeds = data['speed%d' % motor]
+    cmd_stamps, commands = data['cmd_speed']
+    commanded = resample(cmd_stamps, commands['m%d' % motor], stamps)
+    return stamps, speeds['value'] - commanded, commanded
+
+
+def wheel_slip(data, motor, min_pwm=3277):
+    # Wheel speed per unit of duty at every pwm read of the motor (1 or 2) with at least min_pwm of 32767 duty,
+    # relative to its median over the log. A wheel that loses grip spins up at the same duty, so slip is how much
+    # faster than usual it turns. It stays around 0 while the wheel grips and goes negative when it is held back.
+    pwm_stamps, pwms = data['pwms']
+    stamps, speeds = data['speed%d' % motor]
+    duty = pwms['m%d' % motor].astype(np.float64)
+    driven = np.abs(duty) >= min_pwm
+    pwm_stamps, duty = pwm_stamps[driven], duty[driven]
+    if not len(duty) or not len(stamps):
+        return pwm_stamps[:0], duty[:0]
+    ratio = resample(stamps, speeds['value'], pwm_stamps) / duty
+    # A wheel that mostly stood still while driven has no usual speed per duty to compare with
+    usual = np.median(ratio)
+    if usual == 0:
+        return pwm_stamps[:0], duty[:0]
+    return pwm_stamps, ratio / usual - 1.0
+
+
+def current_per_speed(data, motor, bins=20):
+    # Mean current (10 mA units) per speed bin (ticks/s), a rising curve at equal speed points at drive train losses
+    cur_stamps, currents = data['currents']
+    stamps, speeds = data['speed%d' % motor]
+    speed = np.abs(resample(stamps, speeds['value'], cur_stamps)).astype(np.float64)
+    current = np.abs(currents['m%d' % motor]).astype(np.float64)
+    edges = np.linspace(0, speed.max() if len(speed) else 1.0, bins + 1)
+    index = np.clip(np.digitize(speed, edges) - 1, 0, bins - 1)
+    counts = np.bincount(index, minlength=bins)
+    sums = np.bincount(index, weights=current, minlength=bins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return edges, np.where(counts > 0, sums / counts, np.nan), counts
+
+
+def summarize(data, ticks_per_meter, base_width, invert=True, flip=False):
+    # The headline numbers of a log as {name: value}, sections whose series are missing from the capture are skipped
+    summary = {}
+    for name in ('enc1', 'enc2', 'speed1', 'speed2', 'currents', 'cmd_speed'):
+        if name in data and len(data[name][0]) > 1:
+            stamps = data[name][0]
+            # A series whose samples all share one stamp has no rate
+            if stamps[-1] > stamps[0]:
+                summary['%s_rate' % name] = (len(stamps) - 1) / (stamps[-1] - stamps[0])
+    for motor in (1, 2):
+        if 'speed%d' % motor in data and 'cmd_speed' in data:
+            error = np.abs(tracking_error(data, motor)[1])
+            if len(error):
+                summary['m%d_tracking_error_mean' % motor] = error.mean()
+                summary['m%d_tracking_error_p95' % motor] = np.percentile(error, 95)
+        if 'speed%d' % motor in data and 'pwms' in data:
+            slip = np.abs(wheel_slip(data, motor)[1])
+            if len(slip):
+                summary['m%d_slip_mean' % motor] = slip.mean()
+                summary['m%d_slip_max' % motor] = slip.max()
+    if 'enc1' in data and 'enc2' in data:
+        stamps, x, y, theta = odometry(data, ticks_per_meter, base_width, invert, flip)[:4]
+        position, heading, per_meter = odometry_drift(x, y, theta)
+        summary['odom_distance'] = np.sum(np.hypot(np.diff(x), np.diff(y)))
+        summary['odom_drift_position'] = position
+        summary['odom_drift_heading'] = heading
+        summary['odom_drift_per_meter'] = per_meter
+    if 'main_battery' in data and len(data['main_battery'][0]):
+        battery = data['main_battery'][1]['value'] / 10.0
+        summary['main_battery_min'] = battery.min()
+        summary['main_battery_max'] = battery.max()
+    return summary
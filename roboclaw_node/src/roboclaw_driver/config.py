@@ -0,0 +1,98 @@
+from . import roboclaw_driver as roboclaw
+
+
+def _set_encoder_modes(address, m1, m2):
+    return roboclaw.SetM1EncoderMode(address, m1) and roboclaw.SetM2EncoderMode(address, m2)
+
+
+# (name, reader, writer, keys, tolerance). The reader result without its success flag, in the order of keys, is what
+# the writer takes after the address. Fields with a single key are plain values in snapshots and profiles.
+# SetConfig can change the baud rate or the control mode so config goes last.
+FIELDS = (
+    ('m1_velocity_pid', roboclaw.ReadM1VelocityPID, roboclaw.SetM1VelocityPID, ('p', 'i', 'd', 'qpps'),
+     1.0 / 65536),
+    ('m2_velocity_pid', roboclaw.ReadM2VelocityPID, roboclaw.SetM2VelocityPID, ('p', 'i', 'd', 'qpps'),
+     1.0 / 65536),
+    ('m1_position_pid', roboclaw.ReadM1PositionPID, roboclaw.SetM1PositionPID,
+     ('p', 'i', 'd', 'max_i', 'deadzone', 'min', 'max'), 1.0 / 1024),
+    ('m2_position_pid', roboclaw.ReadM2PositionPID, roboclaw.SetM2PositionPID,
+     ('p', 'i', 'd', 'max_i', 'deadzone', 'min', 'max'), 1.0 / 1024),
+    ('main_voltages', roboclaw.ReadMinMaxMainVoltages, roboclaw.SetMainVoltages, ('min', 'max'), 0),
+    ('logic_voltages', roboclaw.ReadMinMaxLogicVoltages, roboclaw.SetLogicVoltages, ('min', 'max'), 0),
+    ('m1_max_current', roboclaw.ReadM1MaxCurrent, roboclaw.SetM1MaxCurrent, ('max',), 0),
+    ('m2_max_current', roboclaw.ReadM2MaxCurrent, roboclaw.SetM2MaxCurrent, ('max',), 0),
+    ('encoder_modes', roboclaw.ReadEncoderModes, _set_encoder_modes, ('m1', 'm2'), 0),
+    ('deadband', roboclaw.GetDeadBand, roboclaw.SetDeadBand, ('min', 'max'), 0),
+    ('pin_functions', roboclaw.ReadPinFunctions, roboclaw.SetPinFunctions, ('s3', 's4', 's5'), 0),
+    ('pwm_mode', roboclaw.ReadPWMMode, roboclaw.SetPWMMode, ('mode',), 0),
+    ('config', roboclaw.GetConfig, roboclaw.SetConfig, ('config',), 0),
+)
+
+
+def read_snapshot(address):
+    # One pass over every field with the link held, fields that could not be read are left out
+    snapshot = {}
+    with roboclaw.Exclusive(False):
+        roboclaw.ClearCache(address)
+        for name, reader, writer, keys, tolerance in FIELDS:
+            result = reader(address)
+            if not result[0]:
+                continue
+            values = list(result[1:len(keys) + 1])
+            snapshot[name] = values[0] if len(keys) == 1 else dict(zip(keys, values))
+    return snapshot
+
+
+def _differs(current, desired, tolerance):
+    return abs(current - desired) > tolerance
+
+
+def diff(snapshot, profile):
+    # Returns {name: (current, wanted)} for the fields of the profile that differ from the snapshot, a profile may
+    # give only some keys of a field and the rest is kept from the snapshot
+    changes = {}
+    for name, reader, writer, keys, tolerance in FIELDS:
+        if name not in profile:
+            continue
+        if name not in snapshot:
+            raise ValueError("%s could not be read from the Roboclaw" % name)
+        current = snapshot[name]
+        if len(keys) == 1:
+            if _differs(current, profile[name], tolerance):
+                changes[name] = (current, profile[name])
+            continue
+        unknown = set(profile[name]) - set(keys)
+        if unknown:
+            raise ValueError("Unknown keys for %s: %s" % (name, ", ".join(sorted(unknown))))
+        wanted = dict(current)
+        wanted.update(profile[name])
+        if any(_differs(current[key], wanted[key], tolerance) for key in keys):
+            changes[name] = (current, wanted)
+    unknown = set(profile) - set(field[0] for field in FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields: %s" % ", ".join(sorted(unknown)))
+    return changes
+
+
+def apply(address, changes, write_nvm=True):
+    # Writes only the changed fields, NVM is only written when at least one of them went through
+    failed = []
+    written = False
+    with roboclaw.Exclusive(False):
+        for name, reader, writer, keys, tolerance in FIELDS:
+            if name not in changes:
+                continue
+            wanted = changes[name][1]
+            args = [wanted] if len(keys) == 1 else [wanted[key] for key in keys]
+            if writer(address, *args):
+                written = True
+            else:
+                failed.append(name)
+        if written and write_nvm and not roboclaw.WriteNVM(address):
+            failed.append('nvm')
+    return failed
+
+
+def sync(address, profile, write_nvm=True):
+    changes = diff(read_snapshot(address), profile)
+    return changes, apply(address, changes, write_nvm)
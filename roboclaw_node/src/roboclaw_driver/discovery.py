@@ -0,0 +1,99 @@
+import json
+import os
+
+from . import roboclaw_driver as roboclaw
+
+# Rates the Roboclaw packet serial mode supports, the usual ones first
+BAUD_RATES = (115200, 38400, 460800, 230400, 57600, 19200, 9600, 2400)
+ADDRESSES = tuple(range(0x80, 0x88))
+PROBE_TIMEOUT = 0.02
+
+
+def default_cache_path():
+    ros_home = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+    return os.path.join(ros_home, 'roboclaw_discovery.json')
+
+
+def device_key(dev):
+    # USB serial number when pyserial can find one, so the cache survives the device moving to another port
+    if not os.path.exists(dev):
+        return 'dev:' + dev
+    path = os.path.realpath(dev)
+    try:
+        from serial.tools import list_ports
+        for info in list_ports.comports():
+            if os.path.realpath(info.device) == path and getattr(info, 'serial_number', None):
+                return 'usb:' + info.serial_number
+    except (ImportError, AttributeError):
+        pass
+    return 'dev:' + path
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _probe(address):
+    if not roboclaw.GetConfig(address)[0]:
+        return None
+    version = roboclaw.ReadVersion(address)
+    return version[1] if version[0] else ""
+
+
+def discover(dev, baud=None, address=None, cache_path=None, timeout=PROBE_TIMEOUT, transport='serial'):
+    # Returns (baud, address, version), or None when nothing answered. The given baud and address and then the cached
+    # result are tried first, a full scan only happens when neither answers.
+    if cache_path is None:
+        cache_path = default_cache_path()
+    key = device_key(dev)
+    cache = load_cache(cache_path)
+
+    candidates = []
+    if baud is not None and address is not None:
+        candidates.append((baud, address))
+    if key in cache:
+        candidates.append((cache[key]['baud'], cache[key]['address']))
+    candidates += [(b, a) for b in BAUD_RATES for a in ADDRESSES]
+
+    # Probed on a link of its own with one attempt per command, the other links keep their retries
+    link = roboclaw.Link()
+    link.trys = 1
+    result = None
+    with roboclaw.Using(link):
+        roboclaw.Open(dev, candidates[0][0], timeout, transport)
+        try:
+            tried = set()
+            for b, a in candidates:
+                if (b, a) in tried:
+                    continue
+                tried.add((b, a))
+                if link.port.baudrate != b:
+                    link.port.baudrate = b
+                version = _probe(a)
+                if version is not None:
+                    result = (b, a, version)
+                    break
+        finally:
+            link.port.close()
+
+    if result is not None and cache.get(key) != {'baud': result[0], 'address': result[1], 'version': result[2]}:
+        cache[key] = {'baud': result[0], 'address': result[1], 'version': result[2]}
+        try:
+            save_cache(cache_path, cache)
+        except (IOError, OSError):
+            pass
+    return result
@@ -0,0 +1,172 @@
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import roboclaw_driver as roboclaw
+from .stats import SkewStats, clock
+
+
+class _Batch(object):
+    # The results of one fan out, filled in by the workers as their calls return
+    def __init__(self, count):
+        self.results = [None] * count
+        self.pending = count
+        self.cond = threading.Condition()
+
+    def finish(self, index, result):
+        with self.cond:
+            self.results[index] = result
+            self.pending -= 1
+            if not self.pending:
+                self.cond.notify_all()
+
+    def wait(self, timeout):
+        deadline = clock() + timeout
+        with self.cond:
+            while self.pending:
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return list(self.results)
+
+
+# A timed Condition.wait polls in steps of up to 50 ms on Python 2, the last ports would go out a millisecond or more
+# after the first. There the waiters spin instead, giving up the GIL each time round.
+_SPIN = sys.version_info[0] < 3
+
+
+class _Barrier(object):
+    # Holds each link's first write of a fan out until every link has its packet ready, then lets them all go and
+    # notes when each went out. threading.Barrier is not in Python 2. A call that ends without writing leaves the
+    # barrier instead, and a link still missing after timeout is not waited for.
+    def __init__(self, parties, timeout):
+        self.parties = parties
+        self.arrived = 0
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.issued = []
+
+    def gate(self, link):
+        link.gate = None
+        deadline = clock() + self.timeout
+        with self.cond:
+            self.arrived += 1
+            if self.arrived >= self.parties:
+                self.cond.notify_all()
+            elif not _SPIN:
+                while self.arrived < self.parties:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+        if _SPIN:
+            while self.arrived < self.parties and clock() < deadline:
+                time.sleep(0)
+        self.issued.append(clock())
+
+    def leave(self, link):
+        if link.gate is None:
+            return
+        link.gate = None
+        with self.cond:
+            self.parties -= 1
+            if self.arrived >= self.parties:
+                self.cond.notify_all()
+
+    def skew(self):
+        # Spread of the write times, None unless at least two links wrote
+        issued = list(self.issued)
+        if len(issued) < 2:
+            return None
+        return max(issued) - min(issued)
+
+
+class _Worker(object):
+    # Runs calls in its own thread with its link bound, so the driver functions it calls act on that link's port. A
+    # priority worker holds the link with priority for each call, it only waits for the transaction in flight.
+    def __init__(self, link, name, priority=False):
+        self.link = link
+        self.priority = priority
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        roboclaw.Bind(self.link)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args, index, batch, barrier = job
+            if barrier is not None:
+                self.link.gate = barrier.gate
+            try:
+                if self.priority:
+                    with roboclaw.Exclusive(True):
+                        result = func(*args)
+                else:
+                    result = func(*args)
+            except Exception as e:
+                result = e
+            if barrier is not None:
+                barrier.leave(self.link)
+            batch.finish(index, result)
+
+
+class Dispatcher(object):
+    # Fans calls out to several links at once, one worker thread per link. A robot with a Roboclaw on each of several
+    # ports then pays one round trip per command instead of one per controller.
+    def __init__(self, links, timeout=1.0, barrier_timeout=0.02):
+        self.links = list(links)
+        self.timeout = timeout
+        self.barrier_timeout = barrier_timeout
+        self.skew = SkewStats()
+        # Fan outs are queued whole so every worker sees them in the same order, two barriers can never wait on
+        # each other
+        self.lock = threading.Lock()
+        self.workers = [_Worker(link, "roboclaw_port%d" % i) for i, link in enumerate(self.links)]
+        # A second worker per link for calls that must not queue behind the fan outs, e.g. stopping the motors
+        self.priority_workers = [_Worker(link, "roboclaw_port%d_priority" % i, True)
+                                 for i, link in enumerate(self.links)]
+
+    def run(self, calls, synchronized=False, priority=False):
+        # calls holds a (func, args) per link, None leaves that link alone. Returns the results in the same order, an
+        # exception raised by a call is returned in its place and a call still running after timeout gives None.
+        # With synchronized the first write of every call goes out at the same moment, the spread between them is
+        # added to skew. With priority the calls skip the queued fan outs and take each link as soon as the
+        # transaction in flight ends, they cannot be synchronized.
+        if synchronized and priority:
+            raise ValueError("Priority calls cannot be synchronized")
+        batch = _Batch(len(self.workers))
+        barrier = None
+        if synchronized:
+            barrier = _Barrier(len([call for call in calls if call is not None]), self.barrier_timeout)
+        workers = self.priority_workers if priority else self.workers
+        with self.lock:
+            for index, (worker, call) in enumerate(zip(workers, calls)):
+                if call is None:
+                    batch.finish(index, None)
+                else:
+                    worker.jobs.put((call[0], call[1], index, batch, barrier))
+        results = batch.wait(self.timeout)
+        if barrier is not None:
+            skew = barrier.skew()
+            if skew is not None:
+                self.skew.add(skew)
+        return results
+
+    def gather(self, func, args_per_link, synchronized=True):
+        # Calls func on every link at once with that link's args, e.g. to sample telemetry from all ports at the
+        # same moment. A None in args_per_link skips that link.
+        return self.run([None if args is None else (func, args) for args in args_per_link], synchronized)
+
+    def close(self):
+        for worker in self.workers + self.priority_workers:
+            worker.jobs.put(None)
@@ -0,0 +1,35 @@
+import errno
+
+
+# Why a transaction failed. They subclass OSError so the existing except OSError handlers catch them too, and carry
+# an errno for the handlers that log it.
+class RoboclawError(OSError):
+    ERRNO = errno.EIO
+    MESSAGE = "Roboclaw transaction failed"
+
+    def __init__(self, message=None):
+        OSError.__init__(self, self.ERRNO, message or self.MESSAGE)
+
+
+# The reply did not arrive, or not all of it, within the port timeout
+class Timeout(RoboclawError):
+    ERRNO = errno.ETIMEDOUT
+    MESSAGE = "No reply from the Roboclaw"
+
+
+# The reply arrived but failed the crc, a garbled byte or the tail of an earlier reply
+class CrcMismatch(RoboclawError):
+    ERRNO = errno.EBADMSG
+    MESSAGE = "Reply failed the crc check"
+
+
+# A write was not acknowledged, usually a wrong address or a crc the Roboclaw rejected
+class NoAck(RoboclawError):
+    ERRNO = getattr(errno, 'ECOMM', errno.EIO)
+    MESSAGE = "Command was not acknowledged"
+
+
+# Something other than the acknowledge came back, host and Roboclaw disagree about where a packet starts
+class Desync(RoboclawError):
+    ERRNO = errno.EPROTO
+    MESSAGE = "Link out of sync"
@@ -0,0 +1,57 @@
+from math import cos, sin
+
+# Wheel roles per drive. Skid steer has any number of wheels per side, they all share the left or right role.
+ROLES = {
+    'diff': ('left', 'right'),
+    'skid': ('left', 'right'),
+    'mecanum': ('front_left', 'front_right', 'rear_left', 'rear_right'),
+}
+
+
+class Kinematics(object):
+    # Body twist to wheel speeds and wheel travel back to body motion. base_width is the distance between the left
+    # and right wheels, wheel_base the distance between the front and rear axles, only used by mecanum.
+    def __init__(self, drive, base_width, wheel_base=0.0):
+        if drive not in ROLES:
+            raise ValueError("Unknown drive %s, expected one of %s" % (drive, ", ".join(sorted(ROLES))))
+        self.drive = drive
+        self.roles = ROLES[drive]
+        self.base_width = base_width
+        self.wheel_base = wheel_base
+        # Lever arm of the rotation on each mecanum wheel, half the track plus half the wheel base
+        self.arm = (base_width + wheel_base) / 2.0
+
+    def inverse(self, vx, vy, wz):
+        # Returns {role: wheel speed in m/s}, vy is ignored by diff and skid steer
+        if self.drive != 'mecanum':
+            return {'left': vx - wz * self.base_width / 2.0, 'right': vx + wz * self.base_width / 2.0}
+        turn = wz * self.arm
+        return {'front_left': vx - vy - turn,
+                'front_right': vx + vy + turn,
+                'rear_left': vx + vy - turn,
+                'rear_right': vx - vy + turn}
+
+    def forward(self, travel):
+        # travel is {role: [distance in m of each wheel with that role]}, wheels that could not be read are left out.
+        # Returns the body motion dx, dy, dtheta in the body frame, or None when a role has no wheel left.
+        means = {}
+        for role in self.roles:
+            distances = travel.get(role)
+            if not distances:
+                return None
+            means[role] = sum(distances) / float(len(distances))
+        if self.drive != 'mecanum':
+            return (means['right'] + means['left']) / 2.0, 0.0, (means['right'] - means['left']) / self.base_width
+        fl, fr, rl, rr = [means[role] for role in self.roles]
+        return ((fl + fr + rl + rr) / 4.0,
+                (-fl + fr + rl - rr) / 4.0,
+                (-fl + fr - rl + rr) / (4.0 * self.arm))
+
+
+def advance(pose, dx, dy, dtheta):
+    # Moves pose (x, y, theta) by a body frame step, along the heading halfway through the turn
+    x, y, theta = pose
+    heading = theta + dtheta / 2.0
+    return (x + dx * cos(heading) - dy * sin(heading),
+            y + dx * sin(heading) + dy * cos(heading),
+            theta + dtheta)
@@ -0,0 +1,134 @@
+import rospy
+from diagnostic_msgs.msg import DiagnosticStatus
+from geometry_msgs.msg import Quaternion
+
+# What roboclaw_node and roboclaw_multi_node share
+
+# Node states, motion commands are only sent while RUNNING
+RUNNING = 0
+STOPPING = 1
+STOPPED = 2
+
+# Error status bits and the diagnostic level each raises
+ERRORS = {0x0000: (DiagnosticStatus.OK, "Normal"),
+          0x0001: (DiagnosticStatus.WARN, "M1 over current"),
+          0x0002: (DiagnosticStatus.WARN, "M2 over current"),
+          0x0004: (DiagnosticStatus.ERROR, "Emergency Stop"),
+          0x0008: (DiagnosticStatus.ERROR, "Temperature1"),
+          0x0010: (DiagnosticStatus.ERROR, "Temperature2"),
+          0x0020: (DiagnosticStatus.ERROR, "Main batt voltage high"),
+          0x0040: (DiagnosticStatus.ERROR, "Logic batt voltage high"),
+          0x0080: (DiagnosticStatus.ERROR, "Logic batt voltage low"),
+          0x0100: (DiagnosticStatus.WARN, "M1 driver fault"),
+          0x0200: (DiagnosticStatus.WARN, "M2 driver fault"),
+          0x0400: (DiagnosticStatus.WARN, "Main batt voltage high"),
+          0x0800: (DiagnosticStatus.WARN, "Main batt voltage low"),
+          0x1000: (DiagnosticStatus.WARN, "Temperature1"),
+          0x2000: (DiagnosticStatus.WARN, "Temperature2"),
+          0x4000: (DiagnosticStatus.OK, "M1 home"),
+          0x8000: (DiagnosticStatus.OK, "M2 home")}
+
+
+# The status is a bit field, several errors can be raised at once. Returns the worst level and all messages.
+def decode_status(status):
+    if status == 0:
+        return ERRORS[0]
+    level = DiagnosticStatus.OK
+    messages = []
+    known = 0
+    for bit in sorted(ERRORS):
+        known |= bit
+        if bit and status & bit:
+            bit_level, message = ERRORS[bit]
+            level = max(level, bit_level)
+            messages.append(message)
+    if status & ~known:
+        level = max(level, DiagnosticStatus.WARN)
+        messages.append("Error 0x%04x" % (status & ~known))
+    return level, ", ".join(messages)
+
+
+# 2106 per 0.1 seconds is max speed, error in the 16th bit is 32768
+# TODO lets find a better way to deal with this error
+def encoder_jumped(name, enc, last):
+    if abs(enc - last) > 20000:
+        rospy.logerr("Ignoring %s encoder jump: cur %d, last %d" % (name, enc, last))
+        return True
+    return False
+
+
+# The command watchdog is the safety stop, a ~cmd_timeout that would turn it off or into a busy loop is refused
+def cmd_timeout_param():
+    timeout = float(rospy.get_param("~cmd_timeout", "1.0"))
+    if timeout <= 0:
+        raise ValueError("~cmd_timeout must be above 0, got %s" % timeout)
+    return timeout
+
+
+# Time between two watchdog checks, a quarter of the timeout but at least 1 ms and at most 50 ms
+def watchdog_period(timeout):
+    return max(0.001, min(0.05, timeout / 4.0))
+
+
+# Runs a watchdog loop, if it fails the node is shut down so its shutdown stops the motors instead of running on
+# without the safety stop
+def run_watchdog(loop):
+    try:
+        loop()
+    except Exception as e:
+        rospy.logfatal("Command watchdog failed: %s", e)
+        rospy.signal_shutdown("Command watchdog failed")
+
+
+# Loaded by load_odom_modules, importing them takes a large part of the start up time. NumPy and the batched
+# integration are only needed once odometry runs.
+tf = None
+Odometry = None
+np = None
+integrate = None
+
+
+def load_odom_modules():
+    global tf, Odometry, np, integrate
+    if tf is None:
+        import numpy as np
+        import tf
+        from nav_msgs.msg import Odometry
+        from .odometry import integrate
+
+
+class OdomPublisher(object):
+    # Publishes the pose on /odom and as the odom to base_footprint transform
+    def __init__(self):
+        load_odom_modules()
+        self.odom_pub = rospy.Publisher('/odom', Odometry, queue_size=10)
+        self.broadcaster = tf.TransformBroadcaster()
+
+    def publish(self, current_time, pose, vx, vy, vth):
+        cur_x, cur_y, cur_theta = pose
+        quat = tf.transformations.quaternion_from_euler(0, 0, cur_theta)
+        self.broadcaster.sendTransform((cur_x, cur_y, 0), quat, current_time, "base_footprint", "odom")
+
+        odom = Odometry()
+        odom.header.stamp = current_time
+        odom.header.frame_id = 'odom'
+
+        odom.pose.pose.position.x = cur_x
+        odom.pose.pose.position.y = cur_y
+        odom.pose.pose.position.z = 0.0
+        odom.pose.pose.orientation = Quaternion(*quat)
+
+        odom.pose.covariance[0] = 0.01
+        odom.pose.covariance[7] = 0.01
+        odom.pose.covariance[14] = 99999
+        odom.pose.covariance[21] = 99999
+        odom.pose.covariance[28] = 99999
+        odom.pose.covariance[35] = 0.01
+
+        odom.child_frame_id = 'base_footprint'
+        odom.twist.twist.linear.x = vx
+        odom.twist.twist.linear.y = vy
+        odom.twist.twist.angular.z = vth
+        odom.twist.covariance = odom.pose.covariance
+
+        self.odom_pub.publish(odom)
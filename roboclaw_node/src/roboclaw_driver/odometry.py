@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def normalize_angles(angles):
+    return np.arctan2(np.sin(angles), np.cos(angles))
+
+
+def _steps(values, before):
+    return np.diff(np.concatenate(([before], values)))
+
+
+def integrate(enc_left, enc_right, stamps, ticks_per_meter, base_width, start=(0.0, 0.0, 0.0),
+              last_enc=(0, 0), last_time=None):
+    # Batched form of EncoderOdom.update: integrates successive encoder readings from a start pose and the readings
+    # before them. Returns arrays x, y, theta, vel_x, vel_theta with the pose after each sample.
+    enc_left = np.asarray(enc_left, dtype=np.int64)
+    enc_right = np.asarray(enc_right, dtype=np.int64)
+    stamps = np.asarray(stamps, dtype=np.float64)
+
+    left_ticks = _steps(enc_left, last_enc[0])
+    right_ticks = _steps(enc_right, last_enc[1])
+    dist_left = left_ticks / float(ticks_per_meter)
+    dist_right = right_ticks / float(ticks_per_meter)
+    dist = (dist_right + dist_left) / 2.0
+    d_time = _steps(stamps, stamps[0] if last_time is None else last_time) if len(stamps) else stamps
+
+    straight = left_ticks == right_ticks
+    d_theta = np.where(straight, 0.0, (dist_right - dist_left) / base_width)
+    theta_after = start[2] + np.cumsum(d_theta)
+    theta_before = theta_after - d_theta
+
+    # Exact arc for turning samples, a straight line when both wheels moved the same number of ticks
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.where(straight, 0.0, dist / np.where(straight, 1.0, d_theta))
+    dx = np.where(straight, dist * np.cos(theta_before), r * (np.sin(theta_after) - np.sin(theta_before)))
+    dy = np.where(straight, dist * np.sin(theta_before), -r * (np.cos(theta_after) - np.cos(theta_before)))
+    x = start[0] + np.cumsum(dx)
+    y = start[1] + np.cumsum(dy)
+
+    moving = np.abs(d_time) >= 0.000001
+    safe_time = np.where(moving, d_time, 1.0)
+    vel_x = np.where(moving, dist / safe_time, 0.0)
+    vel_theta = np.where(moving, d_theta / safe_time, 0.0)
+    return x, y, normalize_angles(theta_after), vel_x, vel_theta
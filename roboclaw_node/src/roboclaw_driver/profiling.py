@@ -0,0 +1,158 @@
+import cProfile
+import pstats
+import sys
+import threading
+import time
+
+from .stats import PHASE_BUCKETS, Histogram, clock
+
+# From Python 3.12 one cProfile sees every thread, and only one can be active in the process
+_PROCESS_WIDE = sys.version_info >= (3, 12)
+
+
+class _Null(object):
+    # What phase and profiled hand out when there is nothing to do, the cost is one with statement
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _Null()
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.add(clock() - self.start)
+        return False
+
+
+class _Capture(object):
+    # The cProfile of each thread while a capture runs, as thread ident -> (lock, cProfile.Profile). The lock is held
+    # while a block runs under the profile.
+    def __init__(self):
+        self.open = True
+        self.profiles = {}
+
+
+class _Profiled(object):
+    # Runs the block under the calling thread's cProfile, before Python 3.12 cProfile only sees the thread that
+    # enabled it
+    __slots__ = ('capture', 'entry', 'enabled')
+
+    def __init__(self, capture, entry):
+        self.capture = capture
+        self.entry = entry
+
+    def __enter__(self):
+        self.entry[0].acquire()
+        # The capture may have ended since the block asked for its profile
+        self.enabled = self.capture.open
+        if self.enabled:
+            self.entry[1].enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.entry[1].disable()
+        self.entry[0].release()
+        return False
+
+
+class Profiler(object):
+    # Wall time histograms of named phases, and on demand a cProfile capture of the profiled blocks of every thread.
+    # The phases are not timed while a capture runs, cProfile slows down everything it sees. Phase timing is a no-op
+    # when not enabled.
+    def __init__(self, enabled=True, edges=PHASE_BUCKETS):
+        self.enabled = enabled
+        self.edges = edges
+        self.phases = {}
+        self.order = []
+        self.lock = threading.Lock()
+        self.capture_lock = threading.Lock()
+        self.capturing = None
+
+    def phase(self, name):
+        if not self.enabled or self.capturing is not None:
+            return _NULL
+        histogram = self.phases.get(name)
+        if histogram is None:
+            with self.lock:
+                if name not in self.phases:
+                    self.phases[name] = Histogram(self.edges)
+                    self.order.append(name)
+                histogram = self.phases[name]
+        return _Timer(histogram)
+
+    def profiled(self):
+        capture = self.capturing
+        if capture is None or _PROCESS_WIDE:
+            return _NULL
+        ident = threading.current_thread().ident
+        entry = capture.profiles.get(ident)
+        if entry is None:
+            with self.lock:
+                entry = capture.profiles.setdefault(ident, (threading.Lock(), cProfile.Profile()))
+        return _Profiled(capture, entry)
+
+    def summary(self, reset=True):
+        # [(phase, {count, mean, max, p50, p99, ...})] in the order the phases first ran, since the last reset
+        with self.lock:
+            summary = [(name, self.phases[name].as_dict()) for name in self.order]
+            if reset:
+                for name in self.order:
+                    self.phases[name].reset()
+        return summary
+
+    def capture(self, duration, path):
+        # Runs cProfile for duration seconds and writes what it collected as a pstats file. Returns the number of
+        # functions in it, 0 when nothing was profiled and None when another capture is running. From Python 3.12
+        # the capture covers everything the process ran, before only the profiled blocks.
+        if not self.capture_lock.acquire(False):
+            return None
+        try:
+            capture = _Capture()
+            process = None
+            if _PROCESS_WIDE:
+                # Raises ValueError when something else in the process is profiling
+                process = cProfile.Profile()
+                process.enable()
+            self.capturing = capture
+            try:
+                time.sleep(duration)
+            finally:
+                self.capturing = None
+                capture.open = False
+                if process is not None:
+                    process.disable()
+            profiles = [process] if process is not None else []
+            with self.lock:
+                entries = list(capture.profiles.values())
+            for lock, profile in entries:
+                # Waits for blocks still running
+                with lock:
+                    profiles.append(profile)
+            stats = None
+            for profile in profiles:
+                if not profile.getstats():
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            if stats is None:
+                return 0
+            stats.dump_stats(path)
+            return len(stats.stats)
+        finally:
+            self.capture_lock.release()
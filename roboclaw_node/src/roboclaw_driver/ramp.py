@@ -0,0 +1,72 @@
+from math import sqrt
+from threading import Lock
+
+
+class RampGenerator(object):
+    # Host side model of the controller's speed ramp. The Roboclaw does the ramping itself through SpeedAccelM1M2_2,
+    # the host only has to resend when the target changes or, with a jerk limit, to step the acceleration. The wheel
+    # with the larger speed change gets the full acceleration and the other one is scaled so both arrive together.
+    def __init__(self, max_accel, max_jerk):
+        self.MAX_ACCEL = max_accel
+        self.MAX_JERK = max_jerk
+        self.lock = Lock()
+        self.reset()
+
+    # Also called by the watchdog thread, see Node.watchdog_stopped
+    def reset(self):
+        with self.lock:
+            self.target = (0.0, 0.0)
+            self.speed = [0.0, 0.0]
+            self.accel = 0.0
+            self.last_time = None
+            self.dirty = False
+
+    # The controller may be anywhere, e.g. after a trajectory, the next step sends the target at the full acceleration
+    def resend(self):
+        with self.lock:
+            self.speed = None
+
+    def set_target(self, vr, vl):
+        with self.lock:
+            if (vr, vl) != self.target:
+                self.target = (vr, vl)
+                self.dirty = True
+
+    # Returns (accel_r, vr, accel_l, vl) when a new command has to be sent, None otherwise
+    def step(self, now):
+        with self.lock:
+            d_time = min(now - self.last_time, 0.5) if self.last_time is not None else 0.0
+            self.last_time = now
+            if self.speed is None:
+                self.speed = list(self.target)
+                self.accel = 0.0
+                self.dirty = False
+                return self.MAX_ACCEL, self.target[0], self.MAX_ACCEL, self.target[1]
+
+            # Advance the model with the acceleration that was commanded last
+            errors = [t - v for t, v in zip(self.target, self.speed)]
+            max_error = max(abs(e) for e in errors)
+            if max_error > 0.0:
+                step = min(1.0, self.accel * d_time / max_error)
+                self.speed = [v + e * step for v, e in zip(self.speed, errors)]
+                max_error *= 1.0 - step
+            if max_error <= 0.0:
+                self.accel = 0.0
+                if not self.dirty:
+                    return None
+                self.dirty = False
+                return self.MAX_ACCEL, self.target[0], self.MAX_ACCEL, self.target[1]
+
+            if self.MAX_JERK > 0.0:
+                # Grow the acceleration at the jerk limit but no faster than it can be brought back to 0 on arrival
+                accel = min(self.MAX_ACCEL, self.accel + self.MAX_JERK * max(d_time, 0.01),
+                            sqrt(2.0 * self.MAX_JERK * max_error))
+            else:
+                accel = self.MAX_ACCEL
+            if accel == self.accel and not self.dirty:
+                return None
+            self.accel = accel
+            self.dirty = False
+            errors = [t - v for t, v in zip(self.target, self.speed)]
+            return (accel * abs(errors[0]) / max_error, self.target[0],
+                    accel * abs(errors[1]) / max_error, self.target[1])
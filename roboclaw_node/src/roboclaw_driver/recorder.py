@@ -0,0 +1,167 @@
+import io
+import struct
+import threading
+
+from .stats import clock
+
+# Capture file layout: MAGIC, version, then records of _RECORD followed by the payload bytes. Version 1 captures
+# have no DROP records and read the same.
+MAGIC = b'RCLW'
+VERSION = 2
+_HEADER = struct.Struct('<4sH')
+_RECORD = struct.Struct('<dBH')
+# Payload of a DROP record, the number of records lost
+_DROP = struct.Struct('<I')
+
+WRITE = 0
+READ = 1
+FLUSH = 2
+# Records were lost to a full ring before this one, the traffic around it can not be split into transactions
+DROP = 3
+
+
+def supported(version):
+    return 1 <= version <= VERSION
+
+
+class RingBuffer(object):
+    # Single producer/single consumer byte ring, head and tail only ever grow so no lock is needed under the GIL
+    def __init__(self, size):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        # Drops not yet marked in the ring
+        self.lost = 0
+
+    def _copy_in(self, pos, data):
+        start = pos % self.size
+        end = start + len(data)
+        if end <= self.size:
+            self.buf[start:end] = data
+        else:
+            split = self.size - start
+            self.buf[start:] = data[:split]
+            self.buf[:end - self.size] = data[split:]
+        return pos + len(data)
+
+    def put(self, stamp, direction, data):
+        # The first record after a drop is preceded by a DROP record, both go in or neither
+        length = _RECORD.size + len(data)
+        if self.lost:
+            length += _RECORD.size + _DROP.size
+        if length > self.size - (self.head - self.tail):
+            self.dropped += 1
+            self.lost += 1
+            return False
+        if self.lost:
+            self.mark(stamp)
+        pos = self._copy_in(self.head, _RECORD.pack(stamp, direction, len(data)))
+        self.head = self._copy_in(pos, data)
+        return True
+
+    def mark(self, stamp):
+        # Writes the DROP record for the pending drops, the caller makes sure it fits
+        pos = self._copy_in(self.head, _RECORD.pack(stamp, DROP, _DROP.size))
+        self.head = self._copy_in(pos, _DROP.pack(self.lost))
+        self.lost = 0
+
+    def chunks(self):
+        # Views of the pending bytes, at most two when the data wraps around the end of the buffer
+        head = self.head
+        start = self.tail % self.size
+        end = start + head - self.tail
+        if end <= self.size:
+            return head, [self.view[start:end]]
+        return head, [self.view[start:], self.view[:end - self.size]]
+
+    def consume(self, head):
+        self.tail = head
+
+
+class Recorder(object):
+    def __init__(self, path, size=1 << 20, period=0.1):
+        self.path = path
+        self.PERIOD = period
+        self.ring = RingBuffer(size)
+        self.records = 0
+        self._file = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._file = io.open(self.path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._thread = threading.Thread(target=self._run, name="roboclaw_recorder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Records lost because the writer thread fell behind
+    @property
+    def dropped(self):
+        return self.ring.dropped
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        # Drops at the very end have no record after them to carry their mark, the ring is empty now
+        if self.ring.lost:
+            self.ring.mark(clock())
+            self.flush()
+        self._file.close()
+
+    def record(self, direction, data):
+        if self.ring.put(clock(), direction, data):
+            self.records += 1
+
+    def flush(self):
+        head, chunks = self.ring.chunks()
+        for chunk in chunks:
+            self._file.write(chunk)
+        self.ring.consume(head)
+        self._file.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.PERIOD):
+            self.flush()
+
+
+class TapPort(object):
+    # Sits between the driver and the real port and copies all traffic into a recorder
+    def __init__(self, port, recorder):
+        self.port = port
+        self.recorder = recorder
+
+    def write(self, data):
+        result = self.port.write(data)
+        self.recorder.record(WRITE, data)
+        return result
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.recorder.record(READ, data)
+        return data
+
+    def flushInput(self):
+        self.port.flushInput()
+        self.recorder.record(FLUSH, b'')
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+
+def read_capture(path):
+    with io.open(path, 'rb') as f:
+        magic, version = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or not supported(version):
+            raise ValueError("%s is not a roboclaw capture" % path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            stamp, direction, length = _RECORD.unpack(header)
+            yield stamp, direction, f.read(length)
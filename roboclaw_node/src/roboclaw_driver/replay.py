@@ -0,0 +1,153 @@
+from . import roboclaw_driver as roboclaw
+from .odometry import integrate
+from .recorder import DROP, FLUSH, READ, read_capture
+
+# Encoder steps larger than this between two polls are glitches and skipped, as node_common.encoder_jumped does
+ENCODER_JUMP = 20000
+
+CSV_HEADER = "stamp,x,y,theta,vx,vth"
+
+
+class ReplayPort(object):
+    # Stands in for the serial port and answers the driver with a recorded response
+    def __init__(self):
+        self.response = b''
+        self.written = bytearray()
+
+    def load(self, response):
+        self.response = bytes(response)
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+    def read(self, size=1):
+        data = self.response[:size]
+        self.response = self.response[size:]
+        return data
+
+    def flushInput(self):
+        pass
+
+    def inWaiting(self):
+        return len(self.response)
+
+
+def transactions(records):
+    # Splits a capture into (stamp, written, response) per command attempt, an attempt starts with the
+    # first write after a flush or a response. Records were lost at a DROP, an attempt it ends is left out and so are
+    # responses up to the next write, they belong to a write that was lost.
+    stamp = None
+    written = bytearray()
+    response = bytearray()
+    lost = False
+    for t, direction, data in records:
+        if direction == DROP:
+            if written:
+                written = bytearray()
+                response = bytearray()
+            lost = True
+            continue
+        if not data and direction != FLUSH:
+            # Nothing went over the wire
+            continue
+        if direction == READ:
+            if not lost:
+                response += data
+            continue
+        if written and (response or direction == FLUSH):
+            yield stamp, written, response
+            written = bytearray()
+            response = bytearray()
+        if direction != FLUSH:
+            if not written:
+                stamp = t
+            written += data
+            lost = False
+    if written:
+        yield stamp, written, response
+
+
+def load_transactions(path):
+    return list(transactions(read_capture(path)))
+
+
+def encoder_samples(txns):
+    # Decodes the encoder reads of a capture through the driver as (stamp, enc1, enc2), one for each M2 read that
+    # follows a good M1 read as Node.run polls them. Also returns the number of reads decoded.
+    port = ReplayPort()
+    link = roboclaw.Link()
+    link.port = port
+    samples = []
+    decoded = 0
+    enc1 = None
+    with roboclaw.Using(link):
+        for stamp, written, response in txns:
+            if len(written) < 2 or written[1] not in (roboclaw.Cmd.GETM1ENC, roboclaw.Cmd.GETM2ENC):
+                continue
+            port.load(response)
+            if written[1] == roboclaw.Cmd.GETM1ENC:
+                result = roboclaw.ReadEncM1(written[0])
+            else:
+                result = roboclaw.ReadEncM2(written[0])
+            decoded += 1
+            if not result[0]:
+                enc1 = None
+                continue
+            if written[1] == roboclaw.Cmd.GETM1ENC:
+                enc1 = result[1]
+            elif enc1 is not None:
+                samples.append((stamp, enc1, result[1]))
+                enc1 = None
+    return samples, decoded
+
+
+def odometry(samples, ticks_per_meter, base_width, start_time, invert=True, flip=False):
+    # The node odometry over decoded samples, with the node's motor mapping and its glitch filter. The encoders start
+    # from 0 as after the handshake. Returns arrays stamps, x, y, theta, vel_x, vel_theta, stamps from start_time.
+    lefts, rights, stamps = [], [], []
+    last_left = last_right = 0
+    for stamp, enc1, enc2 in samples:
+        if invert:
+            enc1 = -enc1
+            enc2 = -enc2
+        if flip:
+            enc1, enc2 = enc2, enc1
+        if abs(enc2 - last_left) > ENCODER_JUMP or abs(enc1 - last_right) > ENCODER_JUMP:
+            continue
+        last_left, last_right = enc2, enc1
+        lefts.append(enc2)
+        rights.append(enc1)
+        stamps.append(stamp - start_time)
+    x, y, theta, vel_x, vel_theta = integrate(lefts, rights, stamps, ticks_per_meter, base_width, last_time=0.0)
+    return stamps, x, y, theta, vel_x, vel_theta
+
+
+def write_csv(out, rows):
+    out.write(CSV_HEADER + "\n")
+    for row in zip(*rows):
+        out.write("%.6f,%.6f,%.6f,%.6f,%.6f,%.6f\n" % row)
+
+
+def read_csv(path):
+    with open(path) as f:
+        header = f.readline().strip()
+        if header != CSV_HEADER:
+            raise ValueError("%s is not a replay trajectory" % path)
+        return [tuple(float(value) for value in line.split(",")) for line in f if line.strip()]
+
+
+def compare(expected, rows, tolerance):
+    # Differences between a trajectory and the expected one as messages, empty when they match within tolerance.
+    # Both are in the csv precision.
+    actual = [tuple(float("%.6f" % value) for value in row) for row in zip(*rows)]
+    if len(actual) != len(expected):
+        return ["%d samples, expected %d" % (len(actual), len(expected))]
+    names = CSV_HEADER.split(",")
+    differences = []
+    for i, (want, got) in enumerate(zip(expected, actual)):
+        for name, a, b in zip(names, want, got):
+            if abs(a - b) > tolerance:
+                differences.append("sample %d %s %.6f, expected %.6f" % (i, name, b, a))
+    return differences
@@ -0,0 +1,49 @@
+# Reusable results for the high rate reads. Pass one as out to the read and it is filled in place instead of a new
+# tuple being built, the fields are only meaningful while ok is 1. They index and unpack like the tuples they replace.
+
+
+class _Result(object):
+    __slots__ = ('ok',)
+    _fields = ('ok',)
+
+    def __getitem__(self, index):
+        return getattr(self, self._fields[index])
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        for name in self._fields:
+            yield getattr(self, name)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name))
+                                                          for name in self._fields))
+
+
+class EncoderResult(_Result):
+    # Encoder counts or speeds, status holds the direction and overflow bits
+    __slots__ = ('value', 'status')
+    _fields = ('ok', 'value', 'status')
+
+    def __init__(self):
+        self.ok = 0
+        self.value = 0
+        self.status = 0
+
+    def load(self, values):
+        self.value, self.status = values
+
+
+class PairResult(_Result):
+    # One value per motor: currents, pwms or buffer depths
+    __slots__ = ('m1', 'm2')
+    _fields = ('ok', 'm1', 'm2')
+
+    def __init__(self):
+        self.ok = 0
+        self.m1 = 0
+        self.m2 = 0
+
+    def load(self, values):
+        self.m1, self.m2 = values
@@ -1,10 +1,29 @@
+import contextlib
 import random
-import serial
+import struct
+import sys
 import time
 import threading
 
+from .errors import RoboclawError, Timeout, CrcMismatch, NoAck, Desync
+from .recorder import Recorder, TapPort
+from .results import EncoderResult, PairResult
+from .stats import LinkStats, clock
+from .transports import open_transport
+from .tuning import tune
+
 _trystimeout = 3
 
+# The port of the default link, see Link
+port = None
+
+# Read-through cache of rarely changing settings, see Link.cache
+_cache_enabled = True
+_cache_ttl = None
+
+# Why the last failed transaction of each thread failed, see LastError
+_errors = threading.local()
+
 
 # Command Enums
 
@@ -23,6 +42,8 @@ class Cmd:
     MIXEDLEFT = 11
     MIXEDFB = 12
     MIXEDLR = 13
+    SETSERIALTIMEOUT = 14
+    GETSERIALTIMEOUT = 15
     GETM1ENC = 16
     GETM2ENC = 17
     GETM1SPEED = 18
@@ -101,85 +122,300 @@ class Cmd:
     FLAGBOOTLOADER = 255
 
 
+CMD_NAMES = dict((val, name) for name, val in vars(Cmd).items() if not name.startswith('_'))
+
+
 # Private Functions
 
+class _LinkLock(object):
+    # Reentrant lock serialising transactions between threads, priority waiters are served before normal ones
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._priority_waiting = 0
+
+    def acquire(self, priority=False):
+        me = threading.current_thread()
+        with self._cond:
+            if self._owner is me:
+                self._depth += 1
+                return
+            if priority:
+                self._priority_waiting += 1
+            while self._owner is not None or (self._priority_waiting and not priority):
+                self._cond.wait()
+            if priority:
+                self._priority_waiting -= 1
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._cond.notify_all()
+
+
+class Link(object):
+    # Everything tied to one port: the port, the lock serialising its transactions, the packet being built and its
+    # crc, cached settings, (group, address) -> (time read, result), and statistics. The module functions act on the
+    # link bound to the calling thread, see Using and Bind, or on the default link. When gate is set it is called with
+    # the link right before the next packet goes out, dispatcher.Dispatcher uses it to line up writes across ports.
+    # trys overrides _trystimeout, the attempts per transaction, for this link alone.
+    def __init__(self):
+        self.port = None
+        self.trys = None
+        self.lock = _LinkLock()
+        self.crc = 0
+        self.txbuf = bytearray()
+        self.cache = {}
+        self.stats = LinkStats()
+        self.gate = None
+
+
+class _DefaultLink(Link):
+    # Its port is the module level port, code that reads or assigns roboclaw_driver.port keeps working
+    @property
+    def port(self):
+        return port
+
+    @port.setter
+    def port(self, value):
+        global port
+        port = value
+
+
+class _Binding(threading.local):
+    link = None
+
+
+_default = _DefaultLink()
+_bound = _Binding()
+
+
+def _link():
+    return _bound.link or _default
+
+
+def _trys():
+    trys = _link().trys
+    return _trystimeout if trys is None else trys
+
+
+def _transaction(func):
+    def wrapper(*args):
+        link = _link()
+        link.lock.acquire()
+        try:
+            stats = link.stats
+            if not stats.enabled:
+                return func(*args)
+            stats.begin()
+            try:
+                result = func(*args)
+            except Exception:
+                stats.end(False)
+                raise
+            stats.end(result is True or (result is not False and result[0]))
+            return result
+        finally:
+            link.lock.release()
+
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+# Cached reads return a tuple whether they hit, missed or the cache is off, the uncached readers mix lists and tuples
+def _cached(group):
+    def decorator(func):
+        def wrapper(address):
+            if not _cache_enabled:
+                return tuple(func(address))
+            link = _link()
+            link.lock.acquire()
+            try:
+                entry = link.cache.get((group, address))
+                if entry is not None and (_cache_ttl is None or clock() - entry[0] < _cache_ttl):
+                    return entry[1]
+                result = tuple(func(address))
+                if result[0]:
+                    link.cache[(group, address)] = (clock(), result)
+                return result
+            finally:
+                link.lock.release()
+
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    return decorator
+
+
+# Setters drop the cached reads they affect, with no groups everything cached for the address is dropped
+def _invalidates(*groups):
+    def decorator(func):
+        def wrapper(address, *args):
+            link = _link()
+            link.lock.acquire()
+            try:
+                return func(address, *args)
+            finally:
+                for key in list(link.cache):
+                    if key[1] == address and (not groups or key[0] in groups):
+                        del link.cache[key]
+                link.lock.release()
+
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    return decorator
+
+
+# CRC-CCITT one byte at a time instead of one bit at a time
+def _crc_table():
+    table = []
+    for i in range(0, 256):
+        crc = i << 8
+        for bit in range(0, 8):
+            if (crc & 0x8000) == 0x8000:
+                crc = ((crc << 1) ^ 0x1021)
+            else:
+                crc <<= 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+# Python 2 str and Python 3 bytes both give ints when iterated once wrapped in a bytearray, Python 3 needs no copy
+if sys.version_info[0] < 3:
+    _iterbytes = bytearray
+    _native_str = str
+else:
+    def _iterbytes(data):
+        return data
+
+    def _native_str(data):
+        return data.decode('latin-1')
+
+_WORD = struct.Struct('>H')
+_LONG = struct.Struct('>I')
+_SLONG = struct.Struct('>i')
+_SLONG_BYTE = struct.Struct('>iB')
+_SWORDS = struct.Struct('>hh')
+_BYTES = struct.Struct('>BB')
+
+
 def crc_clear():
-    global _crc
-    _crc = 0
+    _link().crc = 0
     return
 
 
 def crc_update(data):
-    global _crc
-    _crc ^= data << 8
-    for bit in range(0, 8):
-        if (_crc & 0x8000) == 0x8000:
-            _crc = ((_crc << 1) ^ 0x1021)
-        else:
-            _crc <<= 1
+    link = _link()
+    link.crc = ((link.crc << 8) & 0xFFFF) ^ _CRC_TABLE[((link.crc >> 8) ^ data) & 0xFF]
     return
 
 
+# The crc of the packet so far, covering what was sent and what was read back
+def _crc():
+    return _link().crc
+
+
+def _crc_bytes(link, data):
+    crc = link.crc
+    for byte in _iterbytes(data):
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[(crc >> 8) ^ byte]
+    link.crc = crc
+
+
+def _timeout():
+    _link().stats.timeout()
+    _errors.last = Timeout
+
+
+def _crc_mismatch():
+    _link().stats.crc_error()
+    _errors.last = CrcMismatch
+
+
 def _sendcommand(address, command):
-    crc_clear()
-    crc_update(address)
-    port.write(chr(address))
-    crc_update(command)
-    port.write(chr(command))
+    link = _link()
+    link.stats.sent(command)
+    link.crc = 0
+    del link.txbuf[:]
+    _writebyte(address)
+    _writebyte(command)
     return
 
 
+# Written to the port in one call once the packet is complete or a reply is read
+def _flushcommand(link):
+    if link.gate is not None:
+        link.gate(link)
+    link.stats.bytes_written += len(link.txbuf)
+    link.port.write(link.txbuf)
+    del link.txbuf[:]
+
+
+# Reads count bytes and adds them to the crc, None when they did not all arrive
+def _readbytes(count):
+    link = _link()
+    if link.txbuf:
+        _flushcommand(link)
+    data = link.port.read(count)
+    link.stats.bytes_read += len(data)
+    if len(data) < count:
+        _timeout()
+        return None
+    _crc_bytes(link, data)
+    return data
+
+
 def _readchecksumword():
-    data = port.read(2)
+    link = _link()
+    data = link.port.read(2)
+    link.stats.bytes_read += len(data)
     if len(data) == 2:
-        crc = (ord(data[0]) << 8) | ord(data[1])
-        return 1, crc
+        return 1, _WORD.unpack(data)[0]
+    _timeout()
     return 0, 0
 
 
 def _readbyte():
-    data = port.read(1)
-    if len(data):
-        val = ord(data)
-        crc_update(val)
-        return 1, val
+    data = _readbytes(1)
+    if data is not None:
+        return 1, ord(data)
     return 0, 0
 
 
 def _readword():
-    val1 = _readbyte()
-    if val1[0]:
-        val2 = _readbyte()
-        if val2[0]:
-            return 1, val1[1] << 8 | val2[1]
+    data = _readbytes(2)
+    if data is not None:
+        return 1, _WORD.unpack(data)[0]
     return 0, 0
 
 
-def _readlong():
-    val1 = _readbyte()
-    if val1[0]:
-        val2 = _readbyte()
-        if val2[0]:
-            val3 = _readbyte()
-            if val3[0]:
-                val4 = _readbyte()
-                if val4[0]:
-                    return 1, val1[1] << 24 | val2[1] << 16 | val3[1] << 8 | val4[1]
+def _readint():
+    data = _readbytes(4)
+    if data is not None:
+        return 1, _LONG.unpack(data)[0]
     return 0, 0
 
 
-def _readslong():
-    val = _readlong()
-    if val[0]:
-        if val[1] & 0x80000000:
-            return val[0], val[1] - 0x100000000
-        return val[0], val[1]
+def _readsint():
+    data = _readbytes(4)
+    if data is not None:
+        return 1, _SLONG.unpack(data)[0]
     return 0, 0
 
 
 def _writebyte(val):
-    crc_update(val & 0xFF)
-    port.write(chr(val & 0xFF))
+    link = _link()
+    val &= 0xFF
+    link.crc = ((link.crc << 8) & 0xFFFF) ^ _CRC_TABLE[(link.crc >> 8) ^ val]
+    link.txbuf.append(val)
 
 
 def _writesbyte(val):
@@ -187,36 +423,37 @@ def _writesbyte(val):
 
 
 def _writeword(val):
-    _writebyte((val >> 8) & 0xFF)
-    _writebyte(val & 0xFF)
+    _writebyte(val >> 8)
+    _writebyte(val)
 
 
 def _writesword(val):
     _writeword(val)
 
 
-def _writelong(val):
-    _writebyte((val >> 24) & 0xFF)
-    _writebyte((val >> 16) & 0xFF)
-    _writebyte((val >> 8) & 0xFF)
-    _writebyte(val & 0xFF)
+def _writeint(val):
+    _writebyte(val >> 24)
+    _writebyte(val >> 16)
+    _writebyte(val >> 8)
+    _writebyte(val)
 
 
-def _writeslong(val):
-    _writelong(val)
+def _writesint(val):
+    _writeint(val)
 
 
+@_transaction
 def _read1(address, cmd):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
-        port.flushInput()
+        _link().port.flushInput()
         _sendcommand(address, cmd)
         val1 = _readbyte()
         if val1[0]:
             crc = _readchecksumword()
             if crc[0]:
-                if _crc & 0xFFFF != crc[1] & 0xFFFF:
+                if _crc() != crc[1] & 0xFFFF:
+                    _crc_mismatch()
                     return 0, 0
                 return 1, val1[1]
         trys -= 1
@@ -225,17 +462,18 @@ def _read1(address, cmd):
     return 0, 0
 
 
+@_transaction
 def _read2(address, cmd):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
-        port.flushInput()
+        _link().port.flushInput()
         _sendcommand(address, cmd)
         val1 = _readword()
         if val1[0]:
             crc = _readchecksumword()
             if crc[0]:
-                if _crc & 0xFFFF != crc[1] & 0xFFFF:
+                if _crc() != crc[1] & 0xFFFF:
+                    _crc_mismatch()
                     return 0, 0
                 return 1, val1[1]
         trys -= 1
@@ -244,17 +482,18 @@ def _read2(address, cmd):
     return 0, 0
 
 
+@_transaction
 def _read4(address, cmd):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
-        port.flushInput()
+        _link().port.flushInput()
         _sendcommand(address, cmd)
-        val1 = _readlong()
+        val1 = _readint()
         if val1[0]:
             crc = _readchecksumword()
             if crc[0]:
-                if _crc & 0xFFFF != crc[1] & 0xFFFF:
+                if _crc() != crc[1] & 0xFFFF:
+                    _crc_mismatch()
                     return 0, 0
                 return 1, val1[1]
         trys -= 1
@@ -263,64 +502,88 @@ def _read4(address, cmd):
     return 0, 0
 
 
+@_transaction
 def _read4_1(address, cmd):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
-        port.flushInput()
+        _link().port.flushInput()
         _sendcommand(address, cmd)
-        val1 = _readslong()
-        if val1[0]:
-            val2 = _readbyte()
-            if val2[0]:
-                crc = _readchecksumword()
-                if crc[0]:
-                    if _crc & 0xFFFF != crc[1] & 0xFFFF:
-                        return 0, 0
-                    return 1, val1[1], val2[1]
+        data = _readbytes(5)
+        if data is not None:
+            crc = _readchecksumword()
+            if crc[0]:
+                if _crc() != crc[1] & 0xFFFF:
+                    _crc_mismatch()
+                    return 0, 0
+                val, status = _SLONG_BYTE.unpack(data)
+                return 1, val, status
         trys -= 1
         if trys == 0:
             break
     return 0, 0
 
 
+# Fills out, a result from .results, from a reply laid out as fmt
+@_transaction
+def _read_into(address, cmd, fmt, out):
+    out.ok = 0
+    trys = _trys()
+    while 1:
+        _link().port.flushInput()
+        _sendcommand(address, cmd)
+        data = _readbytes(fmt.size)
+        if data is not None:
+            crc = _readchecksumword()
+            if crc[0]:
+                if _crc() != crc[1] & 0xFFFF:
+                    _crc_mismatch()
+                    return out
+                out.load(fmt.unpack(data))
+                out.ok = 1
+                return out
+        trys -= 1
+        if trys == 0:
+            break
+    return out
+
+
+@_transaction
 def _read_n(address, cmd, args):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
-        port.flushInput()
+        _link().port.flushInput()
         trys -= 1
         if trys == 0:
             break
-        failed = False
         _sendcommand(address, cmd)
-        data = [1, ]
-        for i in range(0, args):
-            val = _readlong()
-            if val[0] == 0:
-                failed = True
-                break
-            data.append(val[1])
-        if failed:
+        values = _readbytes(4 * args)
+        if values is None:
             continue
+        data = [1, ]
+        data.extend(struct.unpack('>%dI' % args, values))
         crc = _readchecksumword()
         if crc[0]:
-            if _crc & 0xFFFF == crc[1] & 0xFFFF:
+            if _crc() == crc[1] & 0xFFFF:
                 return data
+            _crc_mismatch()
     return 0, 0, 0, 0, 0
 
 
 def _writechecksum():
-    global _crc
-    _writeword(_crc & 0xFFFF)
+    _writeword(_crc())
     val = _readbyte()
-    if val[0]:
-        return True
-    return False
+    if not val[0]:
+        _errors.last = NoAck
+        return False
+    if val[1] != 0xFF:
+        _errors.last = Desync
+        return False
+    return True
 
 
+@_transaction
 def _write0(address, cmd):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         if _writechecksum():
@@ -329,8 +592,9 @@ def _write0(address, cmd):
     return False
 
 
+@_transaction
 def _write1(address, cmd, val):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writebyte(val)
@@ -340,8 +604,9 @@ def _write1(address, cmd, val):
     return False
 
 
-def _write111(address, cmd, val1, val2):
-    trys = _trystimeout
+@_transaction
+def _write11(address, cmd, val1, val2):
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writebyte(val1)
@@ -352,8 +617,9 @@ def _write111(address, cmd, val1, val2):
     return False
 
 
+@_transaction
 def _write111(address, cmd, val1, val2, val3):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writebyte(val1)
@@ -365,8 +631,9 @@ def _write111(address, cmd, val1, val2, val3):
     return False
 
 
+@_transaction
 def _write2(address, cmd, val):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writeword(val)
@@ -376,8 +643,9 @@ def _write2(address, cmd, val):
     return False
 
 
+@_transaction
 def _writeS2(address, cmd, val):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writesword(val)
@@ -387,8 +655,9 @@ def _writeS2(address, cmd, val):
     return False
 
 
+@_transaction
 def _write22(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writeword(val1)
@@ -399,8 +668,9 @@ def _write22(address, cmd, val1, val2):
     return False
 
 
+@_transaction
 def _writeS22(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writesword(val1)
@@ -411,8 +681,9 @@ def _writeS22(address, cmd, val1, val2):
     return False
 
 
+@_transaction
 def _writeS2S2(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writesword(val1)
@@ -423,96 +694,104 @@ def _writeS2S2(address, cmd, val1, val2):
     return False
 
 
+@_transaction
 def _writeS24(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writesword(val1)
-        _writelong(val2)
+        _writeint(val2)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _writeS24S24(address, cmd, val1, val2, val3, val4):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
         _writesword(val1)
-        _writelong(val2)
+        _writeint(val2)
         _writesword(val3)
-        _writelong(val4)
+        _writeint(val4)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write4(address, cmd, val):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val)
+        _writeint(val)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _writeS4(address, cmd, val):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writeslong(val)
+        _writesint(val)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write44(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writelong(val2)
+        _writeint(val1)
+        _writeint(val2)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write4S4(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writeslong(val2)
+        _writeint(val1)
+        _writesint(val2)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _writeS4S4(address, cmd, val1, val2):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writeslong(val1)
-        _writeslong(val2)
+        _writesint(val1)
+        _writesint(val2)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write441(address, cmd, val1, val2, val3):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writelong(val2)
+        _writeint(val1)
+        _writeint(val2)
         _writebyte(val3)
         if _writechecksum():
             return True
@@ -520,12 +799,13 @@ def _write441(address, cmd, val1, val2, val3):
     return False
 
 
+@_transaction
 def _writeS441(address, cmd, val1, val2, val3):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writeslong(val1)
-        _writelong(val2)
+        _writesint(val1)
+        _writeint(val2)
         _writebyte(val3)
         if _writechecksum():
             return True
@@ -533,26 +813,28 @@ def _writeS441(address, cmd, val1, val2, val3):
     return False
 
 
+@_transaction
 def _write4S4S4(address, cmd, val1, val2, val3):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writeslong(val2)
-        _writeslong(val3)
+        _writeint(val1)
+        _writesint(val2)
+        _writesint(val3)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write4S441(address, cmd, val1, val2, val3, val4):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writeslong(val2)
-        _writelong(val3)
+        _writeint(val1)
+        _writesint(val2)
+        _writeint(val3)
         _writebyte(val4)
         if _writechecksum():
             return True
@@ -560,42 +842,45 @@ def _write4S441(address, cmd, val1, val2, val3, val4):
     return False
 
 
+@_transaction
 def _write4444(address, cmd, val1, val2, val3, val4):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writelong(val2)
-        _writelong(val3)
-        _writelong(val4)
+        _writeint(val1)
+        _writeint(val2)
+        _writeint(val3)
+        _writeint(val4)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write4S44S4(address, cmd, val1, val2, val3, val4):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writeslong(val2)
-        _writelong(val3)
-        _writeslong(val4)
+        _writeint(val1)
+        _writesint(val2)
+        _writeint(val3)
+        _writesint(val4)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write44441(address, cmd, val1, val2, val3, val4, val5):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writelong(val2)
-        _writelong(val3)
-        _writelong(val4)
+        _writeint(val1)
+        _writeint(val2)
+        _writeint(val3)
+        _writeint(val4)
         _writebyte(val5)
         if _writechecksum():
             return True
@@ -603,14 +888,15 @@ def _write44441(address, cmd, val1, val2, val3, val4, val5):
     return False
 
 
+@_transaction
 def _writeS44S441(address, cmd, val1, val2, val3, val4, val5):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writeslong(val1)
-        _writelong(val2)
-        _writeslong(val3)
-        _writelong(val4)
+        _writesint(val1)
+        _writeint(val2)
+        _writesint(val3)
+        _writeint(val4)
         _writebyte(val5)
         if _writechecksum():
             return True
@@ -618,15 +904,16 @@ def _writeS44S441(address, cmd, val1, val2, val3, val4, val5):
     return False
 
 
+@_transaction
 def _write4S44S441(address, cmd, val1, val2, val3, val4, val5, val6):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writeslong(val2)
-        _writelong(val3)
-        _writeslong(val4)
-        _writelong(val5)
+        _writeint(val1)
+        _writesint(val2)
+        _writeint(val3)
+        _writesint(val4)
+        _writeint(val5)
         _writebyte(val6)
         if _writechecksum():
             return True
@@ -634,16 +921,17 @@ def _write4S44S441(address, cmd, val1, val2, val3, val4, val5, val6):
     return False
 
 
+@_transaction
 def _write4S444S441(address, cmd, val1, val2, val3, val4, val5, val6, val7):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writeslong(val2)
-        _writelong(val3)
-        _writelong(val4)
-        _writeslong(val5)
-        _writelong(val6)
+        _writeint(val1)
+        _writesint(val2)
+        _writeint(val3)
+        _writeint(val4)
+        _writesint(val5)
+        _writeint(val6)
         _writebyte(val7)
         if _writechecksum():
             return True
@@ -651,35 +939,37 @@ def _write4S444S441(address, cmd, val1, val2, val3, val4, val5, val6, val7):
     return False
 
 
+@_transaction
 def _write4444444(address, cmd, val1, val2, val3, val4, val5, val6, val7):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writelong(val2)
-        _writelong(val3)
-        _writelong(val4)
-        _writelong(val5)
-        _writelong(val6)
-        _writelong(val7)
+        _writeint(val1)
+        _writeint(val2)
+        _writeint(val3)
+        _writeint(val4)
+        _writeint(val5)
+        _writeint(val6)
+        _writeint(val7)
         if _writechecksum():
             return True
         trys -= 1
     return False
 
 
+@_transaction
 def _write444444441(address, cmd, val1, val2, val3, val4, val5, val6, val7, val8, val9):
-    trys = _trystimeout
+    trys = _trys()
     while trys:
         _sendcommand(address, cmd)
-        _writelong(val1)
-        _writelong(val2)
-        _writelong(val3)
-        _writelong(val4)
-        _writelong(val5)
-        _writelong(val6)
-        _writelong(val7)
-        _writelong(val8)
+        _writeint(val1)
+        _writeint(val2)
+        _writeint(val3)
+        _writeint(val4)
+        _writeint(val5)
+        _writeint(val6)
+        _writeint(val7)
+        _writeint(val8)
         _writebyte(val9)
         if _writechecksum():
             return True
@@ -690,9 +980,10 @@ def _write444444441(address, cmd, val1, val2, val3, val4, val5, val6, val7, val8
 # User accessible functions
 
 def SendRandomData(cnt):
-    for i in range(0, cnt):
-        byte = random.getrandbits(8)
-        port.write(chr(byte))
+    data = bytearray(random.getrandbits(8) for i in range(0, cnt))
+    link = _link()
+    link.port.write(data)
+    link.stats.bytes_written += cnt
     return
 
 
@@ -704,10 +995,12 @@ def BackwardM1(address, val):
     return _write1(address, Cmd.M1BACKWARD, val)
 
 
+@_invalidates('main_voltages')
 def SetMinVoltageMainBattery(address, val):
     return _write1(address, Cmd.SETMINMB, val)
 
 
+@_invalidates('main_voltages')
 def SetMaxVoltageMainBattery(address, val):
     return _write1(address, Cmd.SETMAXMB, val)
 
@@ -752,19 +1045,38 @@ def LeftRightMixed(address, val):
     return _write1(address, Cmd.MIXEDLR, val)
 
 
-def ReadEncM1(address):
+# Motors stop if no valid packet arrives for timeout tenths of a second, 0 disables
+@_invalidates('serial_timeout')
+def SetSerialTimeout(address, timeout):
+    return _write1(address, Cmd.SETSERIALTIMEOUT, timeout)
+
+
+@_cached('serial_timeout')
+def GetSerialTimeout(address):
+    return _read1(address, Cmd.GETSERIALTIMEOUT)
+
+
+def ReadEncM1(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETM1ENC, _SLONG_BYTE, out)
     return _read4_1(address, Cmd.GETM1ENC)
 
 
-def ReadEncM2(address):
+def ReadEncM2(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETM2ENC, _SLONG_BYTE, out)
     return _read4_1(address, Cmd.GETM2ENC)
 
 
-def ReadSpeedM1(address):
+def ReadSpeedM1(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETM1SPEED, _SLONG_BYTE, out)
     return _read4_1(address, Cmd.GETM1SPEED)
 
 
-def ReadSpeedM2(address):
+def ReadSpeedM2(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETM2SPEED, _SLONG_BYTE, out)
     return _read4_1(address, Cmd.GETM2SPEED)
 
 
@@ -772,31 +1084,30 @@ def ResetEncoders(address):
     return _write0(address, Cmd.RESETENC)
 
 
+@_cached('version')
+@_transaction
 def ReadVersion(address):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
-        port.flushInput()
+        _link().port.flushInput()
         _sendcommand(address, Cmd.GETVERSION)
-        str = ""
+        version = bytearray()
         passed = True
         for i in range(0, 48):
-            data = port.read(1)
-            if len(data):
-                val = ord(data)
-                crc_update(val)
-                if val == 0:
-                    break
-                str += data[0]
-            else:
+            val = _readbyte()
+            if not val[0]:
                 passed = False
                 break
+            if val[1] == 0:
+                break
+            version.append(val[1])
         if passed:
             crc = _readchecksumword()
             if crc[0]:
-                if _crc & 0xFFFF == crc[1] & 0xFFFF:
-                    return 1, str
+                if _crc() == crc[1] & 0xFFFF:
+                    return 1, _native_str(version)
                 else:
+                    _crc_mismatch()
                     time.sleep(0.01)
         trys -= 1
         if trys == 0:
@@ -820,27 +1131,35 @@ def ReadLogicBatteryVoltage(address, ):
     return _read2(address, Cmd.GETLBATT)
 
 
+@_invalidates('logic_voltages')
 def SetMinVoltageLogicBattery(address, val):
     return _write1(address, Cmd.SETMINLB, val)
 
 
+@_invalidates('logic_voltages')
 def SetMaxVoltageLogicBattery(address, val):
     return _write1(address, Cmd.SETMAXLB, val)
 
 
+@_invalidates('m1_velocity_pid')
 def SetM1VelocityPID(address, p, i, d, qpps):
-    return _write4444(address, Cmd.SETM1PID, long(d * 65536), long(p * 65536), long(i * 65536), qpps)
+    return _write4444(address, Cmd.SETM1PID, int(d * 65536), int(p * 65536), int(i * 65536), qpps)
 
 
+@_invalidates('m2_velocity_pid')
 def SetM2VelocityPID(address, p, i, d, qpps):
-    return _write4444(address, Cmd.SETM2PID, long(d * 65536), long(p * 65536), long(i * 65536), qpps)
+    return _write4444(address, Cmd.SETM2PID, int(d * 65536), int(p * 65536), int(i * 65536), qpps)
 
 
-def ReadISpeedM1(address):
+def ReadISpeedM1(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETM1ISPEED, _SLONG_BYTE, out)
     return _read4_1(address, Cmd.GETM1ISPEED)
 
 
-def ReadISpeedM2(address):
+def ReadISpeedM2(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETM2ISPEED, _SLONG_BYTE, out)
     return _read4_1(address, Cmd.GETM2ISPEED)
 
 
@@ -877,7 +1196,7 @@ def SpeedAccelM2(address, accel, speed):
 
 
 def SpeedAccelM1M2(address, accel, speed1, speed2):
-    return _write4S4S4(address, Cmd.M1SPEEDACCEL, accel, speed1, speed2)
+    return _write4S4S4(address, Cmd.MIXEDSPEEDACCEL, accel, speed1, speed2)
 
 
 def SpeedDistanceM1(address, speed, distance, buffer):
@@ -901,17 +1220,21 @@ def SpeedAccelDistanceM2(address, accel, speed, distance, buffer):
 
 
 def SpeedAccelDistanceM1M2(address, accel, speed1, distance1, speed2, distance2, buffer):
-    return _write4S44S441(address, Cmd.MIXEDSPEED2ACCELDIST, accel, speed1, distance1, speed2, distance2, buffer)
+    return _write4S44S441(address, Cmd.MIXEDSPEEDACCELDIST, accel, speed1, distance1, speed2, distance2, buffer)
 
 
-def ReadBuffers(address):
+def ReadBuffers(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETBUFFERS, _BYTES, out)
     val = _read2(address, Cmd.GETBUFFERS)
     if val[0]:
         return 1, val[1] >> 8, val[1] & 0xFF
     return 0, 0, 0
 
 
-def ReadPWMs(address):
+def ReadPWMs(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETPWMS, _SWORDS, out)
     val = _read4(address, Cmd.GETPWMS)
     if val[0]:
         pwm1 = val[1] >> 16
@@ -924,7 +1247,9 @@ def ReadPWMs(address):
     return 0, 0, 0
 
 
-def ReadCurrents(address):
+def ReadCurrents(address, out=None):
+    if out is not None:
+        return _read_into(address, Cmd.GETCURRENTS, _SWORDS, out)
     val = _read4(address, Cmd.GETCURRENTS)
     if val[0]:
         cur1 = val[1] >> 16
@@ -938,7 +1263,7 @@ def ReadCurrents(address):
 
 
 def SpeedAccelM1M2_2(address, accel1, speed1, accel2, speed2):
-    return _write4S44S4(address, Cmd.MIXEDSPEED2ACCEL, accel, speed1, accel2, speed2)
+    return _write4S44S4(address, Cmd.MIXEDSPEED2ACCEL, accel1, speed1, accel2, speed2)
 
 
 def SpeedAccelDistanceM1M2_2(address, accel1, speed1, distance1, accel2, speed2, distance2, buffer):
@@ -958,6 +1283,7 @@ def DutyAccelM1M2(address, accel1, duty1, accel2, duty2):
     return _writeS24S24(Cmd.MIXEDDUTYACCEL, duty1, accel1, duty2, accel2)
 
 
+@_cached('m1_velocity_pid')
 def ReadM1VelocityPID(address):
     data = _read_n(address, Cmd.READM1PID, 4)
     if data[0]:
@@ -968,6 +1294,7 @@ def ReadM1VelocityPID(address):
     return 0, 0, 0, 0, 0
 
 
+@_cached('m2_velocity_pid')
 def ReadM2VelocityPID(address):
     data = _read_n(address, Cmd.READM2PID, 4)
     if data[0]:
@@ -978,14 +1305,17 @@ def ReadM2VelocityPID(address):
     return 0, 0, 0, 0, 0
 
 
+@_invalidates('main_voltages')
 def SetMainVoltages(address, min, max):
     return _write22(address, Cmd.SETMAINVOLTAGES, min, max)
 
 
+@_invalidates('logic_voltages')
 def SetLogicVoltages(address, min, max):
     return _write22(address, Cmd.SETLOGICVOLTAGES, min, max)
 
 
+@_cached('main_voltages')
 def ReadMinMaxMainVoltages(address):
     val = _read4(address, Cmd.GETMINMAXMAINVOLTAGES)
     if val[0]:
@@ -995,6 +1325,7 @@ def ReadMinMaxMainVoltages(address):
     return 0, 0, 0
 
 
+@_cached('logic_voltages')
 def ReadMinMaxLogicVoltages(address):
     val = _read4(address, Cmd.GETMINMAXLOGICVOLTAGES)
     if val[0]:
@@ -1004,32 +1335,36 @@ def ReadMinMaxLogicVoltages(address):
     return 0, 0, 0
 
 
+@_invalidates('m1_position_pid')
 def SetM1PositionPID(address, kp, ki, kd, kimax, deadzone, min, max):
-    return _write4444444(address, Cmd.SETM1POSPID, long(kd * 1024), long(kp * 1024), long(ki * 1024), kimax, deadzone,
+    return _write4444444(address, Cmd.SETM1POSPID, int(kd * 1024), int(kp * 1024), int(ki * 1024), kimax, deadzone,
                          min, max)
 
 
+@_invalidates('m2_position_pid')
 def SetM2PositionPID(address, kp, ki, kd, kimax, deadzone, min, max):
-    return _write4444444(address, Cmd.SETM2POSPID, long(kd * 1024), long(kp * 1024), long(ki * 1024), kimax, deadzone,
+    return _write4444444(address, Cmd.SETM2POSPID, int(kd * 1024), int(kp * 1024), int(ki * 1024), kimax, deadzone,
                          min, max)
 
 
+@_cached('m1_position_pid')
 def ReadM1PositionPID(address):
     data = _read_n(address, Cmd.READM1POSPID, 7)
     if data[0]:
-        data[0] /= 1024.0
         data[1] /= 1024.0
         data[2] /= 1024.0
+        data[3] /= 1024.0
         return data
     return 0, 0, 0, 0, 0, 0, 0, 0
 
 
+@_cached('m2_position_pid')
 def ReadM2PositionPID(address):
     data = _read_n(address, Cmd.READM2POSPID, 7)
     if data[0]:
-        data[0] /= 1024.0
         data[1] /= 1024.0
         data[2] /= 1024.0
+        data[3] /= 1024.0
         return data
     return 0, 0, 0, 0, 0, 0, 0, 0
 
@@ -1056,24 +1391,27 @@ def SetM2DefaultAccel(address, accel):
     return _write4(address, Cmd.SETM2DEFAULTACCEL, accel)
 
 
+@_invalidates('pin_functions')
 def SetPinFunctions(address, S3mode, S4mode, S5mode):
     return _write111(address, Cmd.SETPINFUNCTIONS, S3mode, S4mode, S5mode)
 
 
+@_cached('pin_functions')
+@_transaction
 def ReadPinFunctions(address):
-    global _crc
-    trys = _trystimeout
+    trys = _trys()
     while 1:
         _sendcommand(address, Cmd.GETPINFUNCTIONS)
         val1 = _readbyte()
         if val1[0]:
             val2 = _readbyte()
-            if val1[0]:
+            if val2[0]:
                 val3 = _readbyte()
-                if val1[0]:
+                if val3[0]:
                     crc = _readchecksumword()
                     if crc[0]:
-                        if _crc & 0xFFFF != crc[1] & 0xFFFF:
+                        if _crc() != crc[1] & 0xFFFF:
+                            _crc_mismatch()
                             return 0, 0
                         return 1, val1[1], val2[1], val3[1]
         trys -= 1
@@ -1082,10 +1420,12 @@ def ReadPinFunctions(address):
     return 0, 0
 
 
+@_invalidates('deadband')
 def SetDeadBand(address, min, max):
-    return _write111(address, Cmd.SETDEADBAND, min, max)
+    return _write11(address, Cmd.SETDEADBAND, min, max)
 
 
+@_cached('deadband')
 def GetDeadBand(address):
     val = _read2(address, Cmd.GETDEADBAND)
     if val[0]:
@@ -1094,6 +1434,7 @@ def GetDeadBand(address):
 
 
 # Warning(TTL Serial): Baudrate will change if not already set to 38400.  Communications will be lost
+@_invalidates()
 def RestoreDefaults(address):
     return _write0(address, Cmd.RESTOREDEFAULTS)
 
@@ -1110,6 +1451,7 @@ def ReadError(address):
     return _read2(address, Cmd.GETERROR)
 
 
+@_cached('encoder_modes')
 def ReadEncoderModes(address):
     val = _read2(address, Cmd.GETENCODERMODE)
     if val[0]:
@@ -1117,10 +1459,12 @@ def ReadEncoderModes(address):
     return 0, 0, 0
 
 
+@_invalidates('encoder_modes')
 def SetM1EncoderMode(address, mode):
     return _write1(address, Cmd.SETM1ENCODERMODE, mode)
 
 
+@_invalidates('encoder_modes')
 def SetM2EncoderMode(address, mode):
     return _write1(address, Cmd.SETM2ENCODERMODE, mode)
 
@@ -1132,6 +1476,7 @@ def WriteNVM(address):
 
 # restores settings from NVM
 # Warning(TTL Serial): If baudrate changes or the control mode changes communications will be lost
+@_invalidates()
 def ReadNVM(address):
     return _write0(address, Cmd.READNVM)
 
@@ -1139,22 +1484,27 @@ def ReadNVM(address):
 # Warning(TTL Serial): If control mode is changed from packet serial mode
 # when setting config communications will be lost!
 # Warning(TTL Serial): If baudrate of packet serial mode is changed communications will be lost!
+@_invalidates('config')
 def SetConfig(address, config):
     return _write2(address, Cmd.SETCONFIG, config)
 
 
+@_cached('config')
 def GetConfig(address):
     return _read2(address, Cmd.GETCONFIG)
 
 
+@_invalidates('m1_max_current')
 def SetM1MaxCurrent(address, max):
     return _write44(address, Cmd.SETM1MAXCURRENT, max, 0)
 
 
+@_invalidates('m2_max_current')
 def SetM2MaxCurrent(address, max):
     return _write44(address, Cmd.SETM2MAXCURRENT, max, 0)
 
 
+@_cached('m1_max_current')
 def ReadM1MaxCurrent(address):
     data = _read_n(address, Cmd.GETM1MAXCURRENT, 2)
     if data[0]:
@@ -1162,6 +1512,7 @@ def ReadM1MaxCurrent(address):
     return 0, 0
 
 
+@_cached('m2_max_current')
 def ReadM2MaxCurrent(address):
     data = _read_n(address, Cmd.GETM2MAXCURRENT, 2)
     if data[0]:
@@ -1169,15 +1520,149 @@ def ReadM2MaxCurrent(address):
     return 0, 0
 
 
+@_invalidates('pwm_mode')
 def SetPWMMode(address, mode):
     return _write1(address, Cmd.SETPWMMODE, mode)
 
 
+@_cached('pwm_mode')
 def ReadPWMMode(address):
     return _read1(address, Cmd.GETPWMMODE)
 
 
-def Open(comport, rate):
-    global port
-    port = serial.Serial(comport, baudrate=rate, timeout=0.1, interCharTimeout=0.01)
+# Static settings like the version, PIDs and limits are cached until changed through this driver or ttl seconds
+def EnableCache(enable, ttl=None):
+    global _cache_enabled, _cache_ttl
+    _cache_enabled = enable
+    _cache_ttl = ttl
+    _link().cache.clear()
+
+
+def ClearCache(address=None):
+    cache = _link().cache
+    for key in list(cache):
+        if address is None or key[1] == address:
+            del cache[key]
+
+
+# Holds the link across several commands, other threads wait and priority holders go ahead of them
+@contextlib.contextmanager
+def Exclusive(priority=True):
+    link = _link()
+    link.lock.acquire(priority)
+    try:
+        yield
+    finally:
+        link.lock.release()
+
+
+# Makes the module functions in this thread act on link, for robots with a Roboclaw on each of several ports
+@contextlib.contextmanager
+def Using(link):
+    previous = _bound.link
+    _bound.link = link
+    try:
+        yield link
+    finally:
+        _bound.link = previous
+
+
+# Binds link for the rest of the thread's life, for worker threads that only ever talk to one port
+def Bind(link):
+    _bound.link = link
+
+
+# Link instrumentation, kept on by default as it only costs a few counter updates per transaction. The counters are
+# updated by whichever thread holds the link, so they are read and reset with it held.
+def GetStats():
+    link = _link()
+    link.lock.acquire()
+    try:
+        return link.stats.snapshot(CMD_NAMES)
+    finally:
+        link.lock.release()
+
+
+def ResetStats():
+    link = _link()
+    link.lock.acquire()
+    try:
+        link.stats.reset()
+    finally:
+        link.lock.release()
+
+
+def EnableStats(enable):
+    _link().stats.enabled = enable
+
+
+# Bytes received but not yet consumed by the driver
+def GetInputQueueDepth():
+    return _link().port.inWaiting()
+
+
+# The error class behind the last failed call of this thread, None if none failed yet. Checking the success flag and
+# only then asking why keeps failures as cheap as successes, Check raises instead.
+def LastError():
+    return getattr(_errors, 'last', None)
+
+
+def Check(result):
+    if result is True or (result is not False and result[0]):
+        return result
+    raise (LastError() or RoboclawError)()
+
+
+# Waits for the line to go quiet and drops what arrived, so the next command starts on a packet boundary
+def Resync(quiet=0.01, limit=0.2):
+    link = _link()
+    link.lock.acquire()
+    try:
+        deadline = clock() + limit
+        while True:
+            time.sleep(quiet)
+            pending = link.port.inWaiting()
+            link.port.flushInput()
+            if not pending or clock() > deadline:
+                return not pending
+    finally:
+        link.lock.release()
+
+
+# Captures all serial traffic to a binary file, the file is written by a background thread
+def StartRecording(path, size=1 << 20):
+    link = _link()
+    recorder = Recorder(path, size)
+    recorder.start()
+    link.lock.acquire()
+    try:
+        link.port = TapPort(link.port, recorder)
+    finally:
+        link.lock.release()
+    return recorder
+
+
+# Returns the recorder that was stopped, its dropped counts the records the file is missing, None if none ran
+def StopRecording():
+    link = _link()
+    link.lock.acquire()
+    try:
+        tap = link.port
+        if not isinstance(tap, TapPort):
+            return None
+        link.port = tap.port
+    finally:
+        link.lock.release()
+    tap.recorder.stop()
+    return tap.recorder
+
+
+# transport is one of transports.TRANSPORTS, comport is host:port for the socket transport. With low_latency the
+# tty is tuned for short round trips, see tuning.tune, and the settings in effect are returned.
+def Open(comport, rate, timeout=0.1, transport='serial', low_latency=False):
+    link = _link()
+    link.cache.clear()
+    link.port = open_transport(transport, comport, rate, timeout)
+    if low_latency:
+        return tune(link.port, comport)
     return
@@ -0,0 +1,111 @@
+import mmap
+import os
+import struct
+
+from . import roboclaw_driver as roboclaw
+from .stats import clock
+
+# Shared file layout: _HEADER, then `slots` records of _RECORD. Each record carries its own sequence number which
+# the single writer makes odd while the slot is being written and even once it is complete, readers retry on a
+# mismatch instead of taking a lock.
+MAGIC = b'RCSH'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHIQ')
+_RECORD = struct.Struct('<QdiiiihhQ')
+_SEQ = struct.Struct('<Q')
+_RECORD_SIZE = 48
+_HEADER_SIZE = 64
+_HEAD_OFFSET = 12
+
+
+class TelemetryWriter(object):
+    def __init__(self, path, slots=1024):
+        self.path = path
+        self.slots = slots
+        size = _HEADER_SIZE + slots * _RECORD_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self.map, 0, MAGIC, VERSION, _RECORD_SIZE, slots, 0)
+        self.count = 0
+
+    def write(self, enc1, enc2, speed1, speed2, cur1, cur2, stamp=None):
+        if stamp is None:
+            stamp = clock()
+        seq = self.count * 2 + 1
+        offset = _HEADER_SIZE + (self.count % self.slots) * _RECORD_SIZE
+        _SEQ.pack_into(self.map, offset, seq)
+        _RECORD.pack_into(self.map, offset, seq, stamp, enc1, enc2, speed1, speed2, cur1, cur2, seq)
+        _SEQ.pack_into(self.map, offset, seq + 1)
+        self.count += 1
+        _SEQ.pack_into(self.map, _HEAD_OFFSET, self.count)
+
+    def close(self):
+        self.map.close()
+
+
+class TelemetrySampler(object):
+    # Reads the speeds and currents to go with a pair of encoder counts and writes them as one sample. A sample with a
+    # failed read is not written, readers could not tell its stale values from real ones.
+    def __init__(self, writer, address):
+        self.writer = writer
+        self.address = address
+        self.speed1 = roboclaw.EncoderResult()
+        self.speed2 = roboclaw.EncoderResult()
+        self.currents = roboclaw.PairResult()
+        self.skipped = 0
+
+    # True when the sample was written, otherwise roboclaw.LastError tells which read failed and why
+    def sample(self, enc1, enc2, stamp=None):
+        address = self.address
+        if not (roboclaw.ReadSpeedM1(address, self.speed1).ok and roboclaw.ReadSpeedM2(address, self.speed2).ok and
+                roboclaw.ReadCurrents(address, self.currents).ok):
+            self.skipped += 1
+            return False
+        self.writer.write(enc1, enc2, self.speed1.value, self.speed2.value, self.currents.m1, self.currents.m2,
+                          stamp)
+        return True
+
+
+class TelemetryReader(object):
+    # Records are (stamp, enc1, enc2, speed1, speed2, cur1, cur2), stamps come from the writer's monotonic clock
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.slots, _ = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or record_size != _RECORD_SIZE:
+            raise ValueError("%s is not a roboclaw telemetry buffer" % path)
+
+    def head(self):
+        return _SEQ.unpack_from(self.map, _HEAD_OFFSET)[0]
+
+    def get(self, index):
+        # None if the record is being written or was already overwritten by a newer one
+        offset = _HEADER_SIZE + (index % self.slots) * _RECORD_SIZE
+        record = _RECORD.unpack_from(self.map, offset)
+        if record[0] != index * 2 + 2 or record[-1] != index * 2 + 1 or \
+                _SEQ.unpack_from(self.map, offset)[0] != record[0]:
+            return None
+        return record[1:-1]
+
+    def latest(self):
+        head = self.head()
+        if not head:
+            return None
+        return self.get(head - 1)
+
+    def read_since(self, index):
+        # Yields (index, record) for everything newer than index that is still in the buffer
+        head = self.head()
+        index = max(index, head - self.slots)
+        while index < head:
+            record = self.get(index)
+            if record is not None:
+                yield index, record
+            index += 1
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,221 @@
+import bisect
+import sys
+import time
+import warnings
+
+# CLOCK_MONOTONIC per platform, for clock_gettime through ctypes
+_CLOCK_MONOTONIC = {'linux': 1, 'darwin': 6, 'freebsd': 4}
+
+
+def _ctypes_monotonic():
+    clock_id = _CLOCK_MONOTONIC[sys.platform.rstrip('0123456789')]
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    ts_ref = ctypes.byref(ts)
+
+    def monotonic():
+        if clock_gettime(clock_id, ts_ref):
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    monotonic()
+    return monotonic
+
+
+# Timeouts and latencies must not jump with the wall clock. Python 2 has no time.monotonic, there the monotonic
+# package or clock_gettime through ctypes stand in, wall time is only a last resort.
+def _monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        from monotonic import monotonic
+        return monotonic
+    except (ImportError, RuntimeError):
+        pass
+    try:
+        return _ctypes_monotonic()
+    except (KeyError, ImportError, AttributeError, TypeError, OSError):
+        pass
+    warnings.warn("No monotonic clock on this platform, timeouts and latencies follow the wall clock")
+    return time.time
+
+
+clock = _monotonic()
+
+# Upper edges (seconds) of the latency histogram buckets, anything slower lands in the last bucket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+# Upper edges (seconds) of the issue skew histogram, the spread of the write times of one synchronized fan out
+SKEW_BUCKETS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01)
+
+# Upper edges (seconds) of the histograms of node phases, from a few lines of maths to a slow serial round trip
+PHASE_BUCKETS = (0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1,
+                 0.2, 0.5, 1.0)
+
+
+def bucket_percentile(buckets, pct, overflow=LATENCY_BUCKETS[-1], edges=LATENCY_BUCKETS):
+    # Resolution is one bucket, the upper edge of the bucket holding the percentile is returned
+    total = sum(buckets)
+    if not total:
+        return 0.0
+    target = total * pct / 100.0
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen >= target:
+            if i < len(edges):
+                return edges[i]
+            break
+    return overflow
+
+
+class CmdStats(object):
+    __slots__ = ('calls', 'failures', 'retries', 'timeouts', 'crc_errors', 'total_time', 'max_time', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def percentile(self, pct):
+        return bucket_percentile(self.buckets, pct, self.max_time)
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'failures': self.failures,
+                'retries': self.retries,
+                'timeouts': self.timeouts,
+                'crc_errors': self.crc_errors,
+                'mean': self.total_time / self.calls if self.calls else 0.0,
+                'max': self.max_time,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': list(self.buckets)}
+
+
+class Histogram(object):
+    __slots__ = ('edges', 'count', 'total', 'max', 'last', 'buckets')
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * (len(self.edges) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(self.edges, value)] += 1
+
+    def percentile(self, pct):
+        return bucket_percentile(self.buckets, pct, self.max, self.edges)
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'last': self.last,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': list(self.buckets)}
+
+
+class SkewStats(Histogram):
+    __slots__ = ()
+
+    def __init__(self):
+        Histogram.__init__(self, SKEW_BUCKETS)
+
+
+class LinkStats(object):
+    def __init__(self):
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.commands = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.since = clock()
+        self._start = 0.0
+        self._cmd = None
+        self._sends = 0
+        self._timeouts = 0
+        self._crc_errors = 0
+
+    # Called by the driver around every transaction, each transaction may send the command several times
+    def begin(self):
+        self._start = clock()
+        self._cmd = None
+        self._sends = 0
+        self._timeouts = 0
+        self._crc_errors = 0
+
+    def sent(self, cmd):
+        self._cmd = cmd
+        self._sends += 1
+
+    def timeout(self):
+        self._timeouts += 1
+
+    def crc_error(self):
+        self._crc_errors += 1
+
+    def end(self, ok):
+        elapsed = clock() - self._start
+        if self._cmd is None:
+            return
+        stats = self.commands.get(self._cmd)
+        if stats is None:
+            stats = self.commands[self._cmd] = CmdStats()
+        retries = self._sends - 1 if self._sends > 1 else 0
+        stats.calls += 1
+        if not ok:
+            stats.failures += 1
+        stats.retries += retries
+        stats.timeouts += self._timeouts
+        stats.crc_errors += self._crc_errors
+        stats.total_time += elapsed
+        if elapsed > stats.max_time:
+            stats.max_time = elapsed
+        stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        self.retries += retries
+        self.timeouts += self._timeouts
+        self.crc_errors += self._crc_errors
+
+    def snapshot(self, names=None):
+        commands = {}
+        for cmd, stats in self.commands.items():
+            key = names.get(cmd, cmd) if names else cmd
+            commands[key] = stats.as_dict()
+        return {'elapsed': clock() - self.since,
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read,
+                'retries': self.retries,
+                'timeouts': self.timeouts,
+                'crc_errors': self.crc_errors,
+                'commands': commands}
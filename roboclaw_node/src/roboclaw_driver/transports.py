@@ -0,0 +1,204 @@
+import errno
+import os
+import select
+import socket
+import struct
+
+from .stats import clock
+from .tuning import set_low_latency
+
+# Transports give the driver the part of the pyserial interface it uses: write, read, flushInput, inWaiting, close and
+# a baudrate attribute. Each is created as cls(dev, baudrate, timeout), see TRANSPORTS.
+
+
+def SerialTransport(dev, baudrate, timeout):
+    import serial
+    return serial.Serial(dev, baudrate=baudrate, timeout=timeout, interCharTimeout=0.01)
+
+
+class TermiosTransport(object):
+    # Raw os.read/os.write on the tty, without pyserial's per call overhead. Reads wait in select for the whole reply
+    # so a short transaction costs one or two system calls.
+    def __init__(self, dev, baudrate, timeout):
+        import termios
+        self.termios = termios
+        self.timeout = timeout
+        self.fd = os.open(dev, os.O_RDWR | os.O_NOCTTY)
+        try:
+            self._baudrate = None
+            self.baudrate = baudrate
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.low_latency = set_low_latency(self.fd)
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, rate):
+        termios = self.termios
+        speed = getattr(termios, 'B%d' % rate, None)
+        if speed is None:
+            raise ValueError("Unsupported baud rate %d" % rate)
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self.fd)
+        # Raw 8N1, no flow control, no echo, no translation of any byte
+        iflag = 0
+        oflag = 0
+        cflag = (cflag & ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | getattr(termios, 'CRTSCTS', 0))
+                 | termios.CS8 | termios.CREAD | termios.CLOCAL)
+        lflag = 0
+        # Reads never block in the kernel, select does the waiting
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+        termios.tcsetattr(self.fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+        self._baudrate = rate
+
+    def write(self, data):
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.write(self.fd, view[written:])
+        return written
+
+    def read(self, size=1):
+        data = b''
+        deadline = clock() + self.timeout
+        while len(data) < size:
+            remaining = deadline - clock()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                break
+            chunk = os.read(self.fd, size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def flushInput(self):
+        self.termios.tcflush(self.fd, self.termios.TCIFLUSH)
+
+    def inWaiting(self):
+        import fcntl
+        return struct.unpack('I', fcntl.ioctl(self.fd, self.termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SocketTransport(object):
+    # Serial over TCP bridges such as ser2net in raw mode, dev is host:port. The baud rate is set on the bridge,
+    # baudrate is only kept for callers that read it.
+    def __init__(self, dev, baudrate, timeout):
+        host, port = dev.rsplit(':', 1)
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, int(port)), timeout=max(timeout, 1.0))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+
+    def write(self, data):
+        self.sock.sendall(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        deadline = clock() + self.timeout
+        while len(self.buffer) < size:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                break
+            if not chunk:
+                raise IOError(errno.ECONNRESET, "Connection to %s closed" % (self.sock.getpeername(),))
+            self.buffer += chunk
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    # Pulls in what the bridge already sent without waiting
+    def _drain(self):
+        self.sock.settimeout(0.0)
+        try:
+            while True:
+                chunk = self.sock.recv(4096)
+                if not chunk:
+                    break
+                self.buffer += chunk
+        except (socket.error, IOError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def flushInput(self):
+        self._drain()
+        self.buffer = b''
+
+    def inWaiting(self):
+        self._drain()
+        return len(self.buffer)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+class LoopbackTransport(object):
+    # In memory port for tests and benchmarks. Whatever responder(data) returns for each write becomes readable, and
+    # feed queues bytes directly. Without a responder writes are kept in written. Reads never wait, a missing reply
+    # reads as a timeout right away.
+    def __init__(self, dev=None, baudrate=115200, timeout=0.0, responder=None):
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.responder = responder
+        self.buffer = bytearray()
+        self.written = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def write(self, data):
+        if self.responder is None:
+            self.written += data
+            return len(data)
+        reply = self.responder(bytes(data))
+        if reply:
+            self.buffer += reply
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def flushInput(self):
+        del self.buffer[:]
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {
+    'serial': SerialTransport,
+    'termios': TermiosTransport,
+    'socket': SocketTransport,
+    'loopback': LoopbackTransport,
+}
+
+
+def open_transport(name, dev, baudrate, timeout):
+    if name not in TRANSPORTS:
+        raise ValueError("Unknown transport %s, expected one of %s" % (name, ", ".join(sorted(TRANSPORTS))))
+    return TRANSPORTS[name](dev, baudrate, timeout)
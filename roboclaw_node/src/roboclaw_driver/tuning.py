@@ -0,0 +1,106 @@
+import os
+import struct
+
+# Linux serial_struct ioctls, flags is the fifth int of the struct
+_TIOCGSERIAL = 0x541E
+_TIOCSSERIAL = 0x541F
+_TIOCEXCL = 0x540C
+_ASYNC_LOW_LATENCY = 1 << 13
+_SERIAL_FLAGS = struct.Struct('=i')
+_SERIAL_FLAGS_OFFSET = 16
+
+# Milliseconds the FTDI chip waits before sending a partly filled USB packet, the default of 16 dominates round trips
+LATENCY_TIMER = 1
+
+
+# Has the tty layer hand received bytes to readers right away instead of batching them, False where the driver or
+# the platform does not support it
+def set_low_latency(fd):
+    try:
+        import fcntl
+        info = bytearray(fcntl.ioctl(fd, _TIOCGSERIAL, b'\0' * 128))
+        flags = _SERIAL_FLAGS.unpack_from(info, _SERIAL_FLAGS_OFFSET)[0]
+        if not flags & _ASYNC_LOW_LATENCY:
+            _SERIAL_FLAGS.pack_into(info, _SERIAL_FLAGS_OFFSET, flags | _ASYNC_LOW_LATENCY)
+            fcntl.ioctl(fd, _TIOCSSERIAL, bytes(info))
+            info = bytearray(fcntl.ioctl(fd, _TIOCGSERIAL, b'\0' * 128))
+            flags = _SERIAL_FLAGS.unpack_from(info, _SERIAL_FLAGS_OFFSET)[0]
+        return bool(flags & _ASYNC_LOW_LATENCY)
+    except (ImportError, IOError, OSError):
+        return False
+
+
+# Other processes can no longer open the port, a second node or a terminal would garble the traffic
+def set_exclusive(fd):
+    try:
+        import fcntl
+        import termios
+        fcntl.ioctl(fd, getattr(termios, 'TIOCEXCL', _TIOCEXCL))
+        return True
+    except (ImportError, IOError, OSError):
+        return False
+
+
+# Reads return what is there at once and the caller waits in select, no VTIME inter byte timer adds to a reply
+def set_read_timing(fd, vmin=0, vtime=0):
+    try:
+        import termios
+        attrs = termios.tcgetattr(fd)
+        if attrs[6][termios.VMIN] != vmin or attrs[6][termios.VTIME] != vtime:
+            attrs[6][termios.VMIN] = vmin
+            attrs[6][termios.VTIME] = vtime
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            attrs = termios.tcgetattr(fd)
+        return attrs[6][termios.VMIN], attrs[6][termios.VTIME]
+    except (ImportError, IOError, OSError):
+        return None
+
+
+# sysfs file of the FTDI latency timer, None for devices that have none such as CDC ACM ones
+def latency_timer_path(dev):
+    name = os.path.basename(os.path.realpath(dev))
+    for path in ('/sys/bus/usb-serial/devices/%s/latency_timer' % name,
+                 '/sys/class/tty/%s/device/latency_timer' % name):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# Lowers the latency timer when allowed to, returns the value in effect or None without a timer. Writing needs root
+# or a udev rule, the current value is returned when it fails.
+def set_latency_timer(dev, ms=LATENCY_TIMER):
+    path = latency_timer_path(dev)
+    if path is None:
+        return None
+    current = None
+    try:
+        with open(path) as f:
+            current = int(f.read())
+        if current > ms:
+            with open(path, 'w') as f:
+                f.write('%d' % ms)
+            with open(path) as f:
+                current = int(f.read())
+    except (IOError, OSError, ValueError):
+        pass
+    return current
+
+
+# Applies all of the above to an open port and returns the settings in effect, {} for ports that are not a tty
+def tune(port, dev):
+    fileno = getattr(port, 'fileno', None)
+    if fileno is None:
+        return {}
+    try:
+        fd = fileno()
+        if not os.isatty(fd):
+            return {}
+    except (IOError, OSError, ValueError):
+        return {}
+    settings = {'low_latency': set_low_latency(fd),
+                'exclusive': set_exclusive(fd),
+                'latency_timer': set_latency_timer(dev)}
+    timing = set_read_timing(fd)
+    if timing is not None:
+        settings['vmin'], settings['vtime'] = timing
+    return settings
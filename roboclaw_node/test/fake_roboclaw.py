@@ -0,0 +1,71 @@
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver.transports import LoopbackTransport
+
+# Faults that can be queued on a FakeRoboclaw, each applies to one packet
+CRC = 'crc'  # the reply has its crc flipped
+SILENT = 'silent'  # nothing comes back
+NAK = 'nak'  # a write is answered with something other than the 0xFF acknowledge
+
+
+def crc16(data):
+    # CRC-CCITT one bit at a time, as the Roboclaw manual gives it
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for bit in range(0, 8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+    return crc & 0xFFFF
+
+
+class FakeRoboclaw(object):
+    # Answers the driver over a LoopbackTransport the way a Roboclaw does. reads maps a command to its reply payload,
+    # or to a function returning it, every other command is taken as a write and acknowledged when its crc is right.
+    # Commands are noted in requests as they arrive and acknowledged writes in writes as (command, argument bytes),
+    # on_write[command] is called with the argument bytes of each.
+    def __init__(self, address=0x80):
+        self.address = address
+        self.reads = {}
+        self.on_write = {}
+        self.requests = []
+        self.writes = []
+        self.faults = []
+        self.port = LoopbackTransport(responder=self.respond)
+
+    def respond(self, data):
+        data = bytearray(data)
+        fault = self.faults.pop(0) if self.faults else None
+        self.requests.append(data[1])
+        if fault == SILENT or data[0] != self.address:
+            return b''
+        cmd = data[1]
+        if cmd in self.reads:
+            payload = self.reads[cmd]
+            if callable(payload):
+                payload = payload()
+            reply = bytearray(payload)
+            reply += struct.pack('>H', crc16(data[:2] + reply))
+            if fault == CRC:
+                reply[-1] ^= 0xFF
+            return bytes(reply)
+        if len(data) < 4 or crc16(data[:-2]) != struct.unpack('>H', bytes(data[-2:]))[0]:
+            return b''
+        args = bytes(data[2:-2])
+        self.writes.append((cmd, args))
+        if cmd in self.on_write:
+            self.on_write[cmd](args)
+        return b'\x00' if fault == NAK else b'\xff'
+
+    def count(self, cmd):
+        return self.requests.count(cmd)
+
+
+def encoder(value, status=0):
+    return struct.pack('>iB', value, status)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'src'))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from roboclaw_driver import recorder, replay
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.roboclaw_driver import Cmd
+
+from fake_roboclaw import CRC, SILENT, FakeRoboclaw, encoder
+
+# Regenerates drive.bin and drive.csv, the capture test_replay replays and the trajectory it must give. The capture
+# is what the node sends and receives at 10 Hz while the robot drives straight, turns, spins and drives straight again
+# with the default motor mapping. One M2 reply fails the crc, one M1 read times out and one M1 count glitches.
+
+ADDRESS = 0x80
+PERIOD = 0.1
+TICKS_PER_METER = 4342.2
+BASE_WIDTH = 0.315
+# (polls, right wheel ticks per poll, left wheel ticks per poll)
+SEGMENTS = ((40, 300, 300), (20, 300, 100), (20, 150, -150), (20, 300, 300))
+CRC_POLL = 10
+TIMEOUT_POLL = 30
+GLITCH_POLL = 50
+
+
+def polls():
+    # Raw (m1, m2) counts of every poll, M1 is the right wheel and both are inverted
+    right = left = 0
+    for count, right_step, left_step in SEGMENTS:
+        for _ in range(count):
+            right += right_step
+            left += left_step
+            yield -right, -left
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 0.0005
+        return self.now
+
+
+def record(path):
+    clock = Clock()
+    recorder.clock = clock
+    fake = FakeRoboclaw(ADDRESS)
+    link = roboclaw.Link()
+    link.port = fake.port
+    with roboclaw.Using(link):
+        roboclaw.StartRecording(path)
+        roboclaw.SpeedM1M2(ADDRESS, 0, 0)
+        roboclaw.ResetEncoders(ADDRESS)
+        for poll, (m1, m2) in enumerate(polls()):
+            clock.now = 1000.0 + (poll + 1) * PERIOD
+            roboclaw.SpeedM1M2(ADDRESS, 1000, 1000)
+            fake.reads[Cmd.GETM1ENC] = encoder(m1 + (32768 if poll == GLITCH_POLL else 0))
+            fake.reads[Cmd.GETM2ENC] = encoder(m2)
+            if poll == TIMEOUT_POLL:
+                fake.faults = [SILENT] * roboclaw._trystimeout
+            roboclaw.ReadEncM1(ADDRESS)
+            if poll == CRC_POLL:
+                fake.faults = [CRC]
+            roboclaw.ReadEncM2(ADDRESS)
+        roboclaw.StopRecording()
+
+
+if __name__ == '__main__':
+    capture = os.path.join(HERE, 'drive.bin')
+    record(capture)
+    txns = replay.load_transactions(capture)
+    samples, decoded = replay.encoder_samples(txns)
+    with open(os.path.join(HERE, 'drive.csv'), 'w') as f:
+        replay.write_csv(f, replay.odometry(samples, TICKS_PER_METER, BASE_WIDTH, txns[0][0]))
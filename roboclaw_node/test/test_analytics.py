@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import analytics, recorder, replay
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.recorder import DROP, FLUSH, READ, WRITE
+
+from fake_roboclaw import FakeRoboclaw
+
+ADDRESS = 0x80
+
+
+def write_capture(path, records):
+    with open(path, 'wb') as f:
+        f.write(recorder._HEADER.pack(recorder.MAGIC, recorder.VERSION))
+        for stamp, direction, data in records:
+            f.write(recorder._RECORD.pack(stamp, direction, len(data)))
+            f.write(data)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CaptureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'capture.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class TestAttempts(CaptureTestCase):
+    def test_matches_replay_transactions(self):
+        # The closed form split gives the attempts of the generator on random records, empty ones and drops included
+        rng = random.Random(7)
+        for run in range(300):
+            records = []
+            for i in range(rng.randint(0, 30)):
+                direction = rng.choice((WRITE, WRITE, READ, READ, FLUSH, DROP))
+                if direction == DROP:
+                    data = struct.pack('<I', 1)
+                elif direction == FLUSH:
+                    data = b''
+                else:
+                    data = bytes(bytearray(rng.getrandbits(8) for _ in range(rng.randint(0, 3))))
+                records.append((float(i), direction, data))
+            write_capture(self.path, records)
+
+            expected = [(t, bytes(w), bytes(r)) for t, w, r in replay.transactions(records)]
+            stamps, written, written_at, written_size, response, response_at, response_size = \
+                analytics.split_attempts(self.path)
+            found = [(stamps[i], written[written_at[i]:written_at[i] + written_size[i]].tobytes(),
+                      response[response_at[i]:response_at[i] + response_size[i]].tobytes())
+                     for i in np.flatnonzero(written_size)]
+            self.assertEqual(found, expected, records)
+
+
+class TestCommandedSpeed(CaptureTestCase):
+    def setUp(self):
+        CaptureTestCase.setUp(self)
+        self.clock = Clock()
+        self.saved_clock = recorder.clock
+        recorder.clock = self.clock
+        self.link = roboclaw.Link()
+        self.link.port = FakeRoboclaw(ADDRESS).port
+        roboclaw.Bind(self.link)
+
+    def tearDown(self):
+        roboclaw.Bind(None)
+        recorder.clock = self.saved_clock
+        CaptureTestCase.tearDown(self)
+
+    def at(self, now):
+        self.clock.now = now
+
+    def test_trajectory(self):
+        roboclaw.StartRecording(self.path)
+        self.at(1.0)
+        roboclaw.SpeedM1M2(ADDRESS, 100, 200)
+        # M1 runs 2 s at 1000 then 1 s at 300, M2 1 s at 500 then 2 s at -300, both stop at 5
+        self.at(2.0)
+        roboclaw.SpeedAccelDistanceM1M2(ADDRESS, 5000, 1000, 2000, 500, 500, 1)
+        self.at(2.5)
+        roboclaw.SpeedAccelDistanceM1M2(ADDRESS, 5000, 300, 300, -300, 600, 0)
+        # A trajectory cut short by a stop
+        self.at(6.0)
+        roboclaw.SpeedAccelDistanceM1M2(ADDRESS, 5000, 100, 1000, 100, 1000, 1)
+        self.at(6.5)
+        roboclaw.SpeedM1M2(ADDRESS, 0, 0)
+        # A single motor command queued behind nothing starts when written
+        self.at(7.0)
+        roboclaw.SpeedDistanceM2(ADDRESS, 50, 100, 0)
+        roboclaw.StopRecording()
+
+        stamps, commands = analytics.load_capture(self.path)['cmd_speed']
+        self.assertTrue(np.allclose(stamps, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 6.5, 7.0, 9.0]), stamps)
+        self.assertEqual(commands['m1'].tolist(), [100, 1000, 1000, 300, 0, 100, 0, 0, 0])
+        self.assertEqual(commands['m2'].tolist(), [200, 500, -300, -300, 0, 100, 0, 50, 0])
+
+
+class TestWheelSlip(unittest.TestCase):
+    def setUp(self):
+        stamps = np.arange(10, dtype=np.float64)
+        speeds = np.zeros(10, dtype=[('value', '>i4'), ('status', 'u1')])
+        speeds['value'] = 1000
+        speeds['value'][4] = 1500
+        pwms = np.zeros(10, dtype=[('m1', '>i2'), ('m2', '>i2')])
+        pwms['m1'] = 16384
+        pwms['m1'][7] = 1000
+        self.data = {'speed1': (stamps, speeds), 'pwms': (stamps + 0.01, pwms)}
+
+    def test_slip(self):
+        # The wheel turns half again as fast at the same duty at 4, the duty at 7 is too low to tell
+        stamps, slip = analytics.wheel_slip(self.data, 1)
+        self.assertEqual(len(stamps), 9)
+        self.assertAlmostEqual(slip[4], 0.5)
+        self.assertEqual(np.count_nonzero(slip), 1)
+
+    def test_summary(self):
+        summary = analytics.summarize(self.data, 4342.2, 0.315)
+        self.assertAlmostEqual(summary['m1_slip_max'], 0.5)
+        self.assertNotIn('m1_tracking_error_mean', summary)
+        self.assertEqual(summary['speed1_rate'], 1.0)
+
+    def test_wheel_standing_still(self):
+        # Driven but not turning, the median speed per duty is 0 and there is no slip to give
+        self.data['speed1'][1]['value'] = 0
+        self.data['speed1'][1]['value'][4] = 1500
+        stamps, slip = analytics.wheel_slip(self.data, 1)
+        self.assertEqual((len(stamps), len(slip)), (0, 0))
+        self.assertNotIn('m1_slip_max', analytics.summarize(self.data, 4342.2, 0.315))
+
+    def test_single_stamp(self):
+        # A truncated capture whose reads all carry one stamp has no read rate
+        stamps = self.data['speed1'][0]
+        stamps[:] = 3.0
+        with np.errstate(all='raise'):
+            summary = analytics.summarize(self.data, 4342.2, 0.315)
+        self.assertNotIn('speed1_rate', summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
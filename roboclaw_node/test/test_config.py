@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import config
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.roboclaw_driver import Cmd
+
+from fake_roboclaw import NAK, SILENT, FakeRoboclaw
+
+ADDRESS = 0x80
+
+
+class TestSync(unittest.TestCase):
+    # A controller that only knows its max currents and pwm mode, the other fields are left out of its snapshot
+    def setUp(self):
+        self.fake = FakeRoboclaw(ADDRESS)
+        self.state = {'m1': 10000, 'm2': 10000, 'pwm': 1}
+        self.fake.reads[Cmd.GETM1MAXCURRENT] = lambda: struct.pack('>II', self.state['m1'], 0)
+        self.fake.reads[Cmd.GETM2MAXCURRENT] = lambda: struct.pack('>II', self.state['m2'], 0)
+        self.fake.reads[Cmd.GETPWMMODE] = lambda: struct.pack('>B', self.state['pwm'])
+        self.fake.on_write[Cmd.SETM1MAXCURRENT] = lambda args: self.state.update(m1=struct.unpack('>I', args[:4])[0])
+        self.fake.on_write[Cmd.SETPWMMODE] = lambda args: self.state.update(pwm=bytearray(args)[0])
+        self.link = roboclaw.Link()
+        self.link.port = self.fake.port
+        roboclaw.Bind(self.link)
+
+    def tearDown(self):
+        roboclaw.Bind(None)
+
+    def written(self):
+        return [cmd for cmd, args in self.fake.writes]
+
+    def test_snapshot(self):
+        self.assertEqual(config.read_snapshot(ADDRESS), {'m1_max_current': 10000, 'm2_max_current': 10000,
+                                                         'pwm_mode': 1})
+
+    def test_matching_profile_writes_nothing(self):
+        changes, failed = config.sync(ADDRESS, {'m1_max_current': 10000, 'pwm_mode': 1})
+        self.assertEqual((changes, failed), ({}, []))
+        self.assertEqual(self.written(), [])
+
+    def test_changes_are_saved_once(self):
+        changes, failed = config.sync(ADDRESS, {'m1_max_current': 8000, 'm2_max_current': 10000, 'pwm_mode': 0})
+        self.assertEqual(changes, {'m1_max_current': (10000, 8000), 'pwm_mode': (1, 0)})
+        self.assertEqual(failed, [])
+        self.assertEqual(self.written(), [Cmd.SETM1MAXCURRENT, Cmd.SETPWMMODE, Cmd.WRITENVM])
+        self.assertEqual(self.state, {'m1': 8000, 'm2': 10000, 'pwm': 0})
+        self.assertEqual(config.diff(config.read_snapshot(ADDRESS), {'m1_max_current': 8000, 'pwm_mode': 0}), {})
+
+    def test_without_nvm(self):
+        config.sync(ADDRESS, {'m1_max_current': 8000}, write_nvm=False)
+        self.assertEqual(self.written(), [Cmd.SETM1MAXCURRENT])
+
+    def test_nothing_written_skips_nvm(self):
+        changes = config.diff(config.read_snapshot(ADDRESS), {'m1_max_current': 8000})
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        self.assertEqual(config.apply(ADDRESS, changes), ['m1_max_current'])
+        self.assertEqual(self.written(), [])
+        self.assertEqual(self.fake.count(Cmd.WRITENVM), 0)
+
+    def test_failed_nvm_is_reported(self):
+        changes = config.diff(config.read_snapshot(ADDRESS), {'m1_max_current': 8000})
+        # The current goes through, every attempt at NVM is answered with a nak
+        self.fake.faults = [None] + [NAK] * roboclaw._trystimeout
+        self.assertEqual(config.apply(ADDRESS, changes), ['nvm'])
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, config.diff, config.read_snapshot(ADDRESS), {'m3_max_current': 1})
+
+    def test_unreadable_field(self):
+        self.assertRaises(ValueError, config.diff, config.read_snapshot(ADDRESS), {'deadband': {'min': 0}})
+
+
+if __name__ == '__main__':
+    unittest.main()
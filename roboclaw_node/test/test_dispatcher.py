@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.dispatcher import Dispatcher, _Barrier
+from roboclaw_driver.roboclaw_driver import Cmd
+from roboclaw_driver.stats import clock
+
+from fake_roboclaw import FakeRoboclaw, encoder
+
+ADDRESS = 0x80
+
+
+class DispatcherTestCase(unittest.TestCase):
+    # One FakeRoboclaw per port
+    def setUp(self):
+        self.fakes = [FakeRoboclaw(ADDRESS) for i in range(3)]
+        links = []
+        for fake in self.fakes:
+            fake.reads[Cmd.GETM1ENC] = encoder(5)
+            links.append(roboclaw.Link())
+            links[-1].port = fake.port
+        self.dispatcher = Dispatcher(links, timeout=5.0, barrier_timeout=0.5)
+
+    def tearDown(self):
+        self.dispatcher.close()
+
+
+class TestDispatcher(DispatcherTestCase):
+    def test_run(self):
+        results = self.dispatcher.run([(roboclaw.ReadEncM1, (ADDRESS,)), None, (roboclaw.SpeedM1M2, (ADDRESS, 1, 2))])
+        self.assertEqual(tuple(results[0]), (1, 5, 0))
+        self.assertEqual(results[1:], [None, True])
+        self.assertEqual(self.fakes[1].requests, [])
+        self.assertEqual(self.fakes[2].writes, [(Cmd.MIXEDSPEED, b'\x00\x00\x00\x01\x00\x00\x00\x02')])
+
+    def test_exception_is_returned(self):
+        def fail():
+            raise ValueError("no")
+
+        results = self.dispatcher.run([(fail, ()), None, None])
+        self.assertIsInstance(results[0], ValueError)
+
+    def test_synchronized(self):
+        self.assertEqual(self.dispatcher.gather(roboclaw.SpeedM1M2, [(ADDRESS, 10, 20)] * 3), [True] * 3)
+        self.assertEqual(self.dispatcher.skew.count, 1)
+        self.assertTrue(self.dispatcher.skew.last < 0.5)
+        self.assertRaises(ValueError, self.dispatcher.run, [None] * 3, True, True)
+
+    def test_priority_skips_the_queue(self):
+        # A long poll holds the first port's worker, a stop on the normal path waits behind it and one with priority
+        # goes out between two of its reads
+        done = threading.Event()
+
+        def poll():
+            while not done.is_set():
+                roboclaw.ReadEncM1(ADDRESS)
+
+        poller = threading.Thread(target=self.dispatcher.run, args=([(poll, ()), None, None],))
+        poller.start()
+        try:
+            while not self.fakes[0].count(Cmd.GETM1ENC):
+                time.sleep(0.001)
+            stop = [(roboclaw.ForwardM1, (ADDRESS, 0))] * 3
+            self.dispatcher.timeout = 0.1
+            self.assertEqual(self.dispatcher.run(stop), [None, True, True])
+            self.dispatcher.timeout = 5.0
+            self.assertEqual(self.dispatcher.run(stop, priority=True), [True] * 3)
+            requests = list(self.fakes[0].requests)
+            self.assertEqual(requests.count(Cmd.M1FORWARD), 1)
+            # The poll goes on after the stop
+            while self.fakes[0].count(Cmd.GETM1ENC) == requests.count(Cmd.GETM1ENC):
+                time.sleep(0.001)
+        finally:
+            done.set()
+            poller.join()
+        # The stop queued on the normal path goes out once the poll is over
+        self.assertEqual(self.fakes[0].requests[-1], Cmd.M1FORWARD)
+        self.assertEqual(self.fakes[0].count(Cmd.M1FORWARD), 2)
+
+
+class TestBarrier(unittest.TestCase):
+    def test_waits_for_every_party(self):
+        barrier = _Barrier(2, 5.0)
+        links = [roboclaw.Link(), roboclaw.Link()]
+        arrived = []
+
+        def late():
+            time.sleep(0.05)
+            arrived.append(clock())
+            barrier.gate(links[1])
+
+        thread = threading.Thread(target=late)
+        thread.start()
+        barrier.gate(links[0])
+        thread.join()
+        self.assertTrue(min(barrier.issued) >= arrived[0])
+        self.assertEqual(len(barrier.issued), 2)
+        self.assertTrue(barrier.skew() < 0.05)
+
+    def test_leaving_party_is_not_waited_for(self):
+        barrier = _Barrier(2, 5.0)
+        links = [roboclaw.Link(), roboclaw.Link()]
+        links[1].gate = barrier.gate
+        barrier.leave(links[1])
+        start = clock()
+        barrier.gate(links[0])
+        self.assertTrue(clock() - start < 1.0)
+        self.assertIsNone(barrier.skew())
+
+    def test_timeout(self):
+        barrier = _Barrier(2, 0.05)
+        start = clock()
+        barrier.gate(roboclaw.Link())
+        self.assertTrue(clock() - start >= 0.04)
+        self.assertIsNone(barrier.skew())
+
+
+if __name__ == '__main__':
+    unittest.main()
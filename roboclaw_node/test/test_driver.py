@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+import os
+import random
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.roboclaw_driver import Cmd
+
+from fake_roboclaw import CRC, NAK, SILENT, FakeRoboclaw, crc16, encoder
+
+ADDRESS = 0x80
+
+
+class DriverTestCase(unittest.TestCase):
+    # Every test talks to its own FakeRoboclaw through a link bound to the test thread
+    def setUp(self):
+        self.fake = FakeRoboclaw(ADDRESS)
+        self.link = roboclaw.Link()
+        self.link.port = self.fake.port
+        roboclaw.Bind(self.link)
+
+    def tearDown(self):
+        roboclaw.Bind(None)
+
+
+class TestCrc(unittest.TestCase):
+    def test_table_matches_bitwise(self):
+        rng = random.Random(3)
+        link = roboclaw.Link()
+        with roboclaw.Using(link):
+            for length in (0, 1, 2, 7, 64, 300):
+                data = bytearray(rng.getrandbits(8) for _ in range(length))
+                roboclaw.crc_clear()
+                for byte in data:
+                    roboclaw.crc_update(byte)
+                self.assertEqual(roboclaw._crc(), crc16(data))
+
+                link.crc = 0
+                roboclaw._crc_bytes(link, bytes(data))
+                self.assertEqual(link.crc, crc16(data))
+
+
+class TestTransactions(DriverTestCase):
+    def test_read(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(-1234, 0x02)
+        self.assertEqual(tuple(roboclaw.ReadEncM1(ADDRESS)), (1, -1234, 0x02))
+
+    def test_read_version(self):
+        self.fake.reads[Cmd.GETVERSION] = b'USB Roboclaw 2x7a v4.1.34\n\x00'
+        ok, version = roboclaw.ReadVersion(ADDRESS)
+        self.assertEqual(ok, 1)
+        self.assertEqual(version, 'USB Roboclaw 2x7a v4.1.34\n')
+        self.assertTrue(isinstance(version, str))
+
+    def test_write(self):
+        self.assertTrue(roboclaw.SpeedM1M2(ADDRESS, 1000, -1000))
+        self.assertEqual(self.fake.writes, [(Cmd.MIXEDSPEED, struct.pack('>ii', 1000, -1000))])
+
+    def test_crc_mismatch(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(42)
+        self.fake.faults = [CRC]
+        self.assertEqual(tuple(roboclaw.ReadEncM1(ADDRESS)), (0, 0))
+        self.assertIs(roboclaw.LastError(), roboclaw.CrcMismatch)
+        self.assertEqual(roboclaw.GetStats()['crc_errors'], 1)
+        # The next read goes through again
+        self.assertEqual(tuple(roboclaw.ReadEncM1(ADDRESS)), (1, 42, 0))
+
+    def test_timeout_is_retried(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(42)
+        self.fake.faults = [SILENT, SILENT]
+        self.assertEqual(tuple(roboclaw.ReadEncM1(ADDRESS)), (1, 42, 0))
+        self.assertEqual(self.fake.count(Cmd.GETM1ENC), 3)
+
+    def test_link_attempts(self):
+        # A link's own attempt count leaves the other links, here the default one, at _trystimeout
+        self.link.trys = 1
+        self.fake.reads[Cmd.GETM1ENC] = encoder(42)
+        self.fake.faults = [SILENT]
+        self.assertEqual(tuple(roboclaw.ReadEncM1(ADDRESS)), (0, 0))
+        self.assertEqual(self.fake.count(Cmd.GETM1ENC), 1)
+        self.assertIsNone(roboclaw._default.trys)
+        self.assertEqual(roboclaw._trystimeout, 3)
+
+    def test_read_timeout(self):
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        self.assertEqual(tuple(roboclaw.ReadEncM1(ADDRESS)), (0, 0))
+        self.assertIs(roboclaw.LastError(), roboclaw.Timeout)
+
+    def test_missing_ack(self):
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        self.assertFalse(roboclaw.SpeedM1M2(ADDRESS, 0, 0))
+        self.assertIs(roboclaw.LastError(), roboclaw.NoAck)
+        self.assertEqual(self.fake.writes, [])
+
+    def test_wrong_ack(self):
+        self.fake.faults = [NAK] * roboclaw._trystimeout
+        self.assertFalse(roboclaw.SpeedM1M2(ADDRESS, 0, 0))
+        self.assertIs(roboclaw.LastError(), roboclaw.Desync)
+
+    def test_write_retried_after_missing_ack(self):
+        self.fake.faults = [NAK]
+        self.assertTrue(roboclaw.SpeedM1M2(ADDRESS, 10, 20))
+        self.assertEqual(len(self.fake.writes), 2)
+
+
+class TestStats(DriverTestCase):
+    def test_transaction_stats(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(1)
+        roboclaw.ReadEncM1(ADDRESS)
+        self.fake.faults = [SILENT]
+        roboclaw.SpeedM1M2(ADDRESS, 0, 0)
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        roboclaw.SpeedM1M2(ADDRESS, 0, 0)
+
+        stats = roboclaw.GetStats()
+        read = stats['commands']['GETM1ENC']
+        self.assertEqual((read['calls'], read['failures'], read['retries']), (1, 0, 0))
+        write = stats['commands']['MIXEDSPEED']
+        self.assertEqual((write['calls'], write['failures'], write['retries'], write['timeouts']), (2, 1, 3, 4))
+        self.assertEqual(stats['retries'], 3)
+        self.assertEqual(stats['timeouts'], 4)
+        # 2 bytes out and 7 back for the read, 12 out and 1 back per acknowledged attempt of the write
+        self.assertEqual(stats['bytes_read'], 7 + 1)
+        self.assertEqual(stats['bytes_written'], 2 + 12 * 5)
+        self.assertEqual(sum(read['buckets']), 1)
+
+    def test_snapshot_while_commands_are_added(self):
+        # Each new command adds an entry to the stats while another thread takes snapshots
+        errors = []
+
+        def worker():
+            roboclaw.Bind(self.link)
+            try:
+                for _ in range(10):
+                    roboclaw.ResetStats()
+                    for cmd in range(256):
+                        roboclaw._write0(ADDRESS, cmd)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        try:
+            while thread.is_alive():
+                roboclaw.GetStats()
+        except Exception as e:
+            errors.append(e)
+        thread.join()
+        self.assertEqual(errors, [])
+
+    def test_disabled(self):
+        roboclaw.EnableStats(False)
+        self.fake.reads[Cmd.GETM1ENC] = encoder(1)
+        roboclaw.ReadEncM1(ADDRESS)
+        self.assertEqual(roboclaw.GetStats()['commands'], {})
+
+    def test_reset(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(1)
+        roboclaw.ReadEncM1(ADDRESS)
+        roboclaw.ResetStats()
+        stats = roboclaw.GetStats()
+        self.assertEqual((stats['commands'], stats['bytes_read'], stats['bytes_written']), ({}, 0, 0))
+
+
+class TestErrors(DriverTestCase):
+    def test_check_passes_results_through(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(5)
+        result = roboclaw.ReadEncM1(ADDRESS)
+        self.assertIs(roboclaw.Check(result), result)
+        self.assertIs(roboclaw.Check(roboclaw.SpeedM1M2(ADDRESS, 0, 0)), True)
+
+    def test_check_raises_last_error(self):
+        self.fake.reads[Cmd.GETM1ENC] = encoder(5)
+        self.fake.faults = [CRC]
+        with self.assertRaises(roboclaw.CrcMismatch) as raised:
+            roboclaw.Check(roboclaw.ReadEncM1(ADDRESS))
+        self.assertTrue(isinstance(raised.exception, OSError))
+        self.assertEqual(raised.exception.errno, roboclaw.CrcMismatch.ERRNO)
+
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        self.assertRaises(roboclaw.NoAck, roboclaw.Check, roboclaw.SpeedM1M2(ADDRESS, 0, 0))
+
+    def test_resync(self):
+        self.fake.port.feed(b'\x12\x34\x56')
+        self.assertEqual(roboclaw.GetInputQueueDepth(), 3)
+        self.assertTrue(roboclaw.Resync(quiet=0.0))
+        self.assertEqual(roboclaw.GetInputQueueDepth(), 0)
+
+    def test_resync_gives_up_on_a_busy_line(self):
+        port = self.fake.port
+
+        class Chatty(object):
+            def inWaiting(self):
+                port.feed(b'\x00')
+                return port.inWaiting()
+
+            def __getattr__(self, name):
+                return getattr(port, name)
+
+        self.link.port = Chatty()
+        self.assertFalse(roboclaw.Resync(quiet=0.0, limit=0.01))
+
+
+class TestCache(DriverTestCase):
+    def setUp(self):
+        DriverTestCase.setUp(self)
+        self.config = 0x00E3
+        self.fake.reads[Cmd.GETCONFIG] = lambda: struct.pack('>H', self.config)
+        self.fake.on_write[Cmd.SETCONFIG] = lambda args: setattr(self, 'config', struct.unpack('>H', args)[0])
+
+    def tearDown(self):
+        roboclaw.EnableCache(True)
+        DriverTestCase.tearDown(self)
+
+    def test_hit(self):
+        self.assertEqual(tuple(roboclaw.GetConfig(ADDRESS)), (1, 0x00E3))
+        self.assertEqual(tuple(roboclaw.GetConfig(ADDRESS)), (1, 0x00E3))
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 1)
+
+    def test_same_type_on_hit_and_miss(self):
+        # The velocity pid is unpacked into a list, it still comes back as a tuple
+        self.fake.reads[Cmd.READM1PID] = struct.pack('>IIII', 0x10000, 0x8000, 0, 44000)
+        expected = (1, 1.0, 0.5, 0.0, 44000)
+        self.assertEqual(roboclaw.ReadM1VelocityPID(ADDRESS), expected)
+        self.assertEqual(roboclaw.ReadM1VelocityPID(ADDRESS), expected)
+        roboclaw.EnableCache(False)
+        self.assertEqual(roboclaw.ReadM1VelocityPID(ADDRESS), expected)
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        self.assertEqual(roboclaw.ReadM1VelocityPID(ADDRESS), (0, 0, 0, 0, 0))
+
+    def test_failed_read_is_not_cached(self):
+        self.fake.faults = [SILENT] * roboclaw._trystimeout
+        self.assertFalse(roboclaw.GetConfig(ADDRESS)[0])
+        self.assertEqual(tuple(roboclaw.GetConfig(ADDRESS)), (1, 0x00E3))
+
+    def test_setter_invalidates(self):
+        roboclaw.GetConfig(ADDRESS)
+        self.assertTrue(roboclaw.SetConfig(ADDRESS, 0x00A3))
+        self.assertEqual(tuple(roboclaw.GetConfig(ADDRESS)), (1, 0x00A3))
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 2)
+
+    def test_other_setters_keep_it(self):
+        roboclaw.GetConfig(ADDRESS)
+        roboclaw.SetPWMMode(ADDRESS, 1)
+        roboclaw.GetConfig(ADDRESS)
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 1)
+
+    def test_restore_invalidates_everything(self):
+        roboclaw.GetConfig(ADDRESS)
+        roboclaw.ReadNVM(ADDRESS)
+        roboclaw.GetConfig(ADDRESS)
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 2)
+
+    def test_clear(self):
+        roboclaw.GetConfig(ADDRESS)
+        roboclaw.ClearCache(ADDRESS + 1)
+        roboclaw.GetConfig(ADDRESS)
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 1)
+        roboclaw.ClearCache(ADDRESS)
+        roboclaw.GetConfig(ADDRESS)
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 2)
+
+    def test_disabled(self):
+        roboclaw.EnableCache(False)
+        roboclaw.GetConfig(ADDRESS)
+        roboclaw.GetConfig(ADDRESS)
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 2)
+
+    def test_ttl(self):
+        roboclaw.EnableCache(True, ttl=0.0)
+        roboclaw.GetConfig(ADDRESS)
+        roboclaw.GetConfig(ADDRESS)
+        self.assertEqual(self.fake.count(Cmd.GETCONFIG), 2)
+
+    def test_per_link(self):
+        roboclaw.GetConfig(ADDRESS)
+        other = FakeRoboclaw(ADDRESS)
+        other.reads[Cmd.GETCONFIG] = struct.pack('>H', 0x0001)
+        link = roboclaw.Link()
+        link.port = other.port
+        with roboclaw.Using(link):
+            self.assertEqual(tuple(roboclaw.GetConfig(ADDRESS)), (1, 0x0001))
+
+
+class TestResults(DriverTestCase):
+    def test_filled_in_place(self):
+        out = roboclaw.EncoderResult()
+        self.fake.reads[Cmd.GETM1ENC] = encoder(100, 0x01)
+        self.assertIs(roboclaw.ReadEncM1(ADDRESS, out), out)
+        self.assertEqual((out.ok, out.value, out.status), (1, 100, 0x01))
+
+        self.fake.reads[Cmd.GETM1ENC] = encoder(-7)
+        self.assertIs(roboclaw.ReadEncM1(ADDRESS, out), out)
+        ok, value, status = out
+        self.assertEqual((ok, value, status), (1, -7, 0))
+        self.assertEqual((out[0], out[1], len(out)), (1, -7, 3))
+
+    def test_failure_clears_ok(self):
+        out = roboclaw.EncoderResult()
+        self.fake.reads[Cmd.GETM2SPEED] = encoder(300)
+        roboclaw.ReadSpeedM2(ADDRESS, out)
+        self.fake.faults = [CRC]
+        self.assertIs(roboclaw.ReadSpeedM2(ADDRESS, out), out)
+        self.assertEqual(out.ok, 0)
+        self.assertIs(roboclaw.LastError(), roboclaw.CrcMismatch)
+
+    def test_same_values_as_tuples(self):
+        self.fake.reads[Cmd.GETCURRENTS] = struct.pack('>hh', 150, -20)
+        self.fake.reads[Cmd.GETPWMS] = struct.pack('>hh', -32767, 16000)
+        self.fake.reads[Cmd.GETBUFFERS] = struct.pack('>BB', 0x80, 3)
+        for reader in (roboclaw.ReadCurrents, roboclaw.ReadPWMs, roboclaw.ReadBuffers):
+            self.assertEqual(tuple(reader(ADDRESS, roboclaw.PairResult())), tuple(reader(ADDRESS)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+from math import pi
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver.kinematics import Kinematics, advance
+
+BASE_WIDTH = 0.315
+WHEEL_BASE = 0.25
+TWISTS = ((0.5, 0.0, 0.0), (0.0, 0.0, 1.2), (0.4, 0.0, -0.7), (-0.3, 0.2, 0.5), (0.0, -0.6, 0.0))
+
+
+def travel(speeds, d_time, wheels=1):
+    # Distance every wheel of each role moves in d_time, wheels per role as on a skid steer with several per side
+    return dict((role, [speed * d_time] * wheels) for role, speed in speeds.items())
+
+
+class TestKinematics(unittest.TestCase):
+    def assertMotion(self, expected, actual):
+        for a, b in zip(expected, actual):
+            self.assertAlmostEqual(a, b, places=12)
+
+    def test_round_trip(self):
+        # The wheel speeds of a twist, driven for d_time, come back as that twist times d_time
+        for drive in ('diff', 'skid', 'mecanum'):
+            kinematics = Kinematics(drive, BASE_WIDTH, WHEEL_BASE)
+            for vx, vy, wz in TWISTS:
+                if drive != 'mecanum':
+                    vy = 0.0
+                speeds = kinematics.inverse(vx, vy, wz)
+                self.assertEqual(sorted(speeds), sorted(kinematics.roles))
+                self.assertMotion((vx * 0.1, vy * 0.1, wz * 0.1), kinematics.forward(travel(speeds, 0.1)))
+
+    def test_skid_averages_each_side(self):
+        kinematics = Kinematics('skid', BASE_WIDTH)
+        speeds = kinematics.inverse(0.5, 0.0, 1.0)
+        self.assertMotion((0.05, 0.0, 0.1), kinematics.forward(travel(speeds, 0.1, wheels=3)))
+        # One wheel per side is enough, a side with none gives no motion
+        self.assertMotion((0.05, 0.0, 0.1), kinematics.forward({'left': [speeds['left'] * 0.1],
+                                                                'right': [speeds['right'] * 0.1] * 2}))
+        self.assertIsNone(kinematics.forward({'left': [0.1], 'right': []}))
+
+    def test_diff_ignores_lateral(self):
+        kinematics = Kinematics('diff', BASE_WIDTH)
+        self.assertEqual(kinematics.inverse(0.5, 0.3, 0.0), {'left': 0.5, 'right': 0.5})
+
+    def test_unknown_drive(self):
+        self.assertRaises(ValueError, Kinematics, 'omni', BASE_WIDTH)
+
+    def test_advance(self):
+        self.assertMotion((1.0, 0.0, 0.0), advance((0.0, 0.0, 0.0), 1.0, 0.0, 0.0))
+        # Facing +y a forward step moves along y and a step to the left along -x
+        self.assertMotion((-0.2, 1.0, pi / 2), advance((0.0, 0.0, pi / 2), 1.0, 0.2, 0.0))
+        # Turning on the spot moves nowhere
+        self.assertMotion((0.0, 0.0, 0.5), advance((0.0, 0.0, 0.0), 0.0, 0.0, 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
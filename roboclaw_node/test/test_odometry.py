@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+import os
+import random
+import sys
+import unittest
+from math import cos, pi, sin
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import odometry
+
+try:
+    import rospy
+except ImportError:
+    rospy = None
+
+TICKS_PER_METER = 4342.2
+BASE_WIDTH = 0.315
+TOLERANCE = 1e-9
+
+
+class ScalarOdom:
+    # EncoderOdom.update as it was before the batched integration, the reference both forms must agree with
+    def __init__(self):
+        self.cur_x = 0
+        self.cur_y = 0
+        self.cur_theta = 0.0
+        self.last_enc_left = 0
+        self.last_enc_right = 0
+        self.last_enc_time = 0.0
+
+    @staticmethod
+    def normalize_angle(angle):
+        while angle > pi:
+            angle -= 2.0 * pi
+        while angle < -pi:
+            angle += 2.0 * pi
+        return angle
+
+    def update(self, enc_left, enc_right, current_time):
+        left_ticks = enc_left - self.last_enc_left
+        right_ticks = enc_right - self.last_enc_right
+        self.last_enc_left = enc_left
+        self.last_enc_right = enc_right
+
+        dist_left = left_ticks / TICKS_PER_METER
+        dist_right = right_ticks / TICKS_PER_METER
+        dist = (dist_right + dist_left) / 2.0
+
+        d_time = current_time - self.last_enc_time
+        self.last_enc_time = current_time
+
+        if left_ticks == right_ticks:
+            d_theta = 0.0
+            self.cur_x += dist * cos(self.cur_theta)
+            self.cur_y += dist * sin(self.cur_theta)
+        else:
+            d_theta = (dist_right - dist_left) / BASE_WIDTH
+            r = dist / d_theta
+            self.cur_x += r * (sin(d_theta + self.cur_theta) - sin(self.cur_theta))
+            self.cur_y -= r * (cos(d_theta + self.cur_theta) - cos(self.cur_theta))
+            self.cur_theta = self.normalize_angle(self.cur_theta + d_theta)
+
+        if abs(d_time) < 0.000001:
+            vel_x = 0.0
+            vel_theta = 0.0
+        else:
+            vel_x = dist / d_time
+            vel_theta = d_theta / d_time
+        return vel_x, vel_theta
+
+
+def samples(seed, count=2000):
+    # Random encoder readings mixing straight steps, turns, spins in place, standstill and repeated stamps
+    rng = random.Random(seed)
+    enc_left, enc_right, stamps = [], [], []
+    left = right = 0
+    stamp = 0.0
+    for _ in range(count):
+        kind = rng.random()
+        step = rng.randint(-300, 300)
+        if kind < 0.3:
+            left += step
+            right += step
+        elif kind < 0.4:
+            left += step
+            right -= step
+        elif kind < 0.5:
+            pass
+        else:
+            left += step
+            right += step + rng.randint(-150, 150)
+        if rng.random() >= 0.1:
+            stamp += rng.uniform(0.005, 0.2)
+        enc_left.append(left)
+        enc_right.append(right)
+        stamps.append(stamp)
+    return enc_left, enc_right, stamps
+
+
+def reference(enc_left, enc_right, stamps):
+    odom = ScalarOdom()
+    poses = []
+    for left, right, stamp in zip(enc_left, enc_right, stamps):
+        vel_x, vel_theta = odom.update(left, right, stamp)
+        poses.append((odom.cur_x, odom.cur_y, odom.cur_theta, vel_x, vel_theta))
+    return np.array(poses).T
+
+
+class TestBatchOdometry(unittest.TestCase):
+    def assertMatches(self, expected, actual, vel_rtol=0):
+        x, y, theta, vel_x, vel_theta = expected
+        self.assertTrue(np.allclose(actual[0], x, rtol=0, atol=TOLERANCE))
+        self.assertTrue(np.allclose(actual[1], y, rtol=0, atol=TOLERANCE))
+        # Both wrap into [-pi, pi], compare the heading on the circle so pi and -pi agree
+        self.assertTrue(np.all(np.abs(odometry.normalize_angles(actual[2] - theta)) < TOLERANCE))
+        self.assertTrue(np.allclose(actual[3], vel_x, rtol=vel_rtol, atol=TOLERANCE))
+        self.assertTrue(np.allclose(actual[4], vel_theta, rtol=vel_rtol, atol=TOLERANCE))
+
+    def test_samples_include_every_kind(self):
+        enc_left, enc_right, stamps = samples(1)
+        left_ticks = np.diff(enc_left)
+        right_ticks = np.diff(enc_right)
+        self.assertTrue(np.any((left_ticks == right_ticks) & (left_ticks != 0)))
+        self.assertTrue(np.any(left_ticks != right_ticks))
+        self.assertTrue(np.any(np.diff(stamps) == 0))
+
+    def test_integrate_matches_scalar_update(self):
+        for seed in range(5):
+            enc_left, enc_right, stamps = samples(seed)
+            actual = odometry.integrate(enc_left, enc_right, stamps, TICKS_PER_METER, BASE_WIDTH, last_time=0.0)
+            self.assertMatches(reference(enc_left, enc_right, stamps), actual)
+
+    def test_integrate_in_chunks(self):
+        # Carrying the pose, readings and stamp over from one batch to the next gives the same as one long batch
+        enc_left, enc_right, stamps = samples(7)
+        expected = reference(enc_left, enc_right, stamps)
+        start, last_enc, last_time = (0.0, 0.0, 0.0), (0, 0), 0.0
+        chunks = []
+        bounds = [0, 1, 2, 50, 51, 700, 1500, len(stamps)]
+        for begin, end in zip(bounds, bounds[1:]):
+            x, y, theta, vel_x, vel_theta = odometry.integrate(enc_left[begin:end], enc_right[begin:end],
+                                                               stamps[begin:end], TICKS_PER_METER, BASE_WIDTH,
+                                                               start, last_enc, last_time)
+            chunks.append((x, y, theta, vel_x, vel_theta))
+            start = (x[-1], y[-1], theta[-1])
+            last_enc = (enc_left[end - 1], enc_right[end - 1])
+            last_time = stamps[end - 1]
+        actual = [np.concatenate([chunk[i] for chunk in chunks]) for i in range(5)]
+        self.assertMatches(expected, actual)
+
+    @unittest.skipIf(rospy is None, "rospy is not available")
+    def test_encoder_odom_matches_scalar_update(self):
+        node = load_node_script()
+        enc_left, enc_right, stamps = samples(11)
+        expected = reference(enc_left, enc_right, stamps)
+
+        batch = node.EncoderOdom(TICKS_PER_METER, BASE_WIDTH, rospy.Time(0), publish=False)
+        half = len(stamps) // 2
+        first = batch.update_batch(enc_left[:half], enc_right[:half], stamps[:half])
+        second = batch.update_batch(enc_left[half:], enc_right[half:], stamps[half:])
+        # rospy.Time keeps whole nanoseconds, the velocities then differ by the rounding of the stamps
+        self.assertMatches(expected, [np.concatenate((a, b)) for a, b in zip(first, second)], 1e-6)
+
+        scalar = node.EncoderOdom(TICKS_PER_METER, BASE_WIDTH, rospy.Time(0), publish=False)
+        poses = []
+        for left, right, stamp in zip(enc_left, enc_right, stamps):
+            vel_x, vel_theta = scalar.update(left, right, rospy.Time.from_sec(stamp))
+            poses.append((scalar.cur_x, scalar.cur_y, scalar.cur_theta, vel_x, vel_theta))
+        self.assertMatches(expected, np.array(poses).T, 1e-6)
+
+    @unittest.skipIf(rospy is None, "rospy is not available")
+    def test_encoder_odom_mixes_single_and_batch(self):
+        # Single samples go through the scalar update and carry over into update_batch and back
+        node = load_node_script()
+        enc_left, enc_right, stamps = samples(13, 300)
+        expected = reference(enc_left, enc_right, stamps)
+
+        odom = node.EncoderOdom(TICKS_PER_METER, BASE_WIDTH, rospy.Time(0), publish=False)
+        poses = []
+        for i in range(100):
+            vel_x, vel_theta = odom.update(enc_left[i], enc_right[i], rospy.Time.from_sec(stamps[i]))
+            poses.append((odom.cur_x, odom.cur_y, odom.cur_theta, vel_x, vel_theta))
+        poses += zip(*odom.update_batch(enc_left[100:200], enc_right[100:200], stamps[100:200]))
+        for i in range(200, len(stamps)):
+            vel_x, vel_theta = odom.update(enc_left[i], enc_right[i], rospy.Time.from_sec(stamps[i]))
+            poses.append((odom.cur_x, odom.cur_y, odom.cur_theta, vel_x, vel_theta))
+        self.assertMatches(expected, np.array(poses).T, 1e-6)
+
+
+def load_node_script():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nodes', 'roboclaw_node.py')
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        import imp
+        return imp.load_source('roboclaw_node_script', path)
+    spec = spec_from_file_location('roboclaw_node_script', path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver.ramp import RampGenerator
+
+ACCEL = 1.0
+JERK = 4.0
+
+
+class TestRamp(unittest.TestCase):
+    def test_sends_only_changes(self):
+        ramp = RampGenerator(ACCEL, 0.0)
+        self.assertIsNone(ramp.step(0.0))
+        ramp.set_target(0.5, 0.25)
+        # The faster wheel gets the full acceleration, the other one half so both arrive together
+        self.assertEqual(ramp.step(0.0), (ACCEL, 0.5, ACCEL / 2.0, 0.25))
+        self.assertIsNone(ramp.step(0.1))
+        ramp.set_target(0.5, 0.25)
+        self.assertIsNone(ramp.step(0.2))
+        # Arrived, the same target is not sent again
+        self.assertIsNone(ramp.step(1.0))
+        self.assertEqual(ramp.speed, [0.5, 0.25])
+
+    def test_new_target_on_arrival(self):
+        ramp = RampGenerator(ACCEL, 0.0)
+        ramp.set_target(0.5, 0.5)
+        ramp.step(0.0)
+        ramp.step(1.0)
+        ramp.set_target(0.0, 0.0)
+        self.assertEqual(ramp.step(1.1), (ACCEL, 0.0, ACCEL, 0.0))
+
+    def test_reset(self):
+        ramp = RampGenerator(ACCEL, 0.0)
+        ramp.set_target(0.5, 0.5)
+        ramp.step(0.0)
+        ramp.reset()
+        self.assertEqual((ramp.target, ramp.speed, ramp.accel, ramp.dirty), ((0.0, 0.0), [0.0, 0.0], 0.0, False))
+        self.assertIsNone(ramp.step(0.1))
+        ramp.set_target(0.5, 0.5)
+        self.assertEqual(ramp.step(0.2), (ACCEL, 0.5, ACCEL, 0.5))
+
+    def test_jerk(self):
+        # The acceleration grows by the jerk limit per step and comes back down before the target
+        ramp = RampGenerator(ACCEL, JERK)
+        ramp.set_target(1.0, 1.0)
+        accels = []
+        now = 0.0
+        for i in range(40):
+            command = ramp.step(now)
+            if command is not None:
+                accels.append(command[0])
+                self.assertEqual(command[1::2], (1.0, 1.0))
+            now += 0.05
+        self.assertAlmostEqual(accels[0], JERK * 0.01)
+        self.assertAlmostEqual(accels[1], JERK * 0.01 + JERK * 0.05)
+        self.assertAlmostEqual(max(accels), ACCEL)
+        self.assertTrue(accels[-1] < ACCEL)
+        for a, b in zip(accels, accels[1:]):
+            self.assertTrue(b - a <= JERK * 0.05 + 1e-9)
+        self.assertAlmostEqual(ramp.speed[0], 1.0)
+        self.assertIsNone(ramp.step(now))
+
+    def test_zero_after_trajectory(self):
+        # A trajectory resets the ramp with the wheels left at its speeds. Once it is cancelled a zero command must go
+        # out although the model target is already 0.
+        ramp = RampGenerator(ACCEL, JERK)
+        ramp.reset()
+        ramp.resend()
+        ramp.set_target(0.0, 0.0)
+        self.assertEqual(ramp.step(0.0), (ACCEL, 0.0, ACCEL, 0.0))
+        self.assertIsNone(ramp.step(0.1))
+
+    def test_resend_with_new_target(self):
+        ramp = RampGenerator(ACCEL, JERK)
+        ramp.resend()
+        ramp.set_target(0.3, -0.3)
+        self.assertEqual(ramp.step(0.0), (ACCEL, 0.3, ACCEL, -0.3))
+        self.assertEqual(ramp.speed, [0.3, -0.3])
+        self.assertIsNone(ramp.step(0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import recorder, replay
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.recorder import DROP, FLUSH, READ, WRITE
+from roboclaw_driver.roboclaw_driver import Cmd
+
+from fake_roboclaw import FakeRoboclaw, encoder
+
+ADDRESS = 0x80
+
+
+def records(ring):
+    # The records pending in a ring as (direction, payload)
+    head, chunks = ring.chunks()
+    data = b''.join(chunk.tobytes() for chunk in chunks)
+    found = []
+    pos = 0
+    while pos < len(data):
+        stamp, direction, length = recorder._RECORD.unpack_from(data, pos)
+        pos += recorder._RECORD.size
+        found.append((direction, data[pos:pos + length]))
+        pos += length
+    return found
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_wraps(self):
+        ring = recorder.RingBuffer(40)
+        for i in range(10):
+            self.assertTrue(ring.put(0.0, WRITE, bytearray([i] * 5)))
+            self.assertEqual(records(ring), [(WRITE, bytearray([i] * 5))])
+            ring.consume(ring.chunks()[0])
+        self.assertEqual(ring.dropped, 0)
+
+    def test_drop_is_marked(self):
+        ring = recorder.RingBuffer(32)
+        self.assertTrue(ring.put(0.0, WRITE, b'\x80\x10'))
+        self.assertFalse(ring.put(0.0, READ, b'\x00' * 16))
+        self.assertFalse(ring.put(0.0, READ, b'\x00' * 2))
+        self.assertEqual(ring.dropped, 2)
+        ring.consume(ring.chunks()[0])
+
+        self.assertTrue(ring.put(1.0, WRITE, b'\x80\x11'))
+        self.assertEqual(records(ring), [(DROP, struct.pack('<I', 2)), (WRITE, b'\x80\x11')])
+        self.assertEqual(ring.lost, 0)
+
+    def test_mark_needs_room_too(self):
+        # A record that fits on its own but not with the mark in front is dropped as well
+        ring = recorder.RingBuffer(30)
+        ring.put(0.0, WRITE, b'\x00' * 5)
+        self.assertFalse(ring.put(0.0, READ, b'\x00' * 10))
+        ring.consume(ring.chunks()[0])
+        self.assertFalse(ring.put(0.0, READ, b'\x00' * 5))
+        self.assertTrue(ring.put(0.0, READ, b''))
+        self.assertEqual(records(ring), [(DROP, struct.pack('<I', 2)), (READ, b'')])
+
+
+class TestTransactions(unittest.TestCase):
+    def test_split(self):
+        capture = [(0.0, FLUSH, b''), (1.0, WRITE, b'\x80\x10'), (1.1, READ, b'\x01\x02'),
+                   (2.0, FLUSH, b''), (3.0, WRITE, b'\x80\x23\xff\xee'), (3.1, READ, b'\xff'),
+                   (4.0, WRITE, b'\x80\x11'), (4.1, READ, b'\x03')]
+        self.assertEqual([(t, bytes(w), bytes(r)) for t, w, r in replay.transactions(capture)],
+                         [(1.0, b'\x80\x10', b'\x01\x02'), (3.0, b'\x80\x23\xff\xee', b'\xff'),
+                          (4.0, b'\x80\x11', b'\x03')])
+
+    def test_drop_after_write(self):
+        # The reply to the write is partly lost, the rest must not be taken for the reply to the next write
+        capture = [(1.0, WRITE, b'\x80\x10'), (1.1, READ, b'\x01'), (1.2, DROP, struct.pack('<I', 1)),
+                   (1.3, READ, b'\x02\x03'), (2.0, FLUSH, b''), (2.1, WRITE, b'\x80\x11'), (2.2, READ, b'\x04')]
+        self.assertEqual([(t, bytes(w), bytes(r)) for t, w, r in replay.transactions(capture)],
+                         [(2.1, b'\x80\x11', b'\x04')])
+
+    def test_drop_of_a_write(self):
+        capture = [(1.0, WRITE, b'\x80\x10'), (1.1, READ, b'\x01'), (1.5, DROP, struct.pack('<I', 1)),
+                   (1.6, READ, b'\x02'), (2.0, WRITE, b'\x80\x11'), (2.2, READ, b'\x04')]
+        self.assertEqual([(t, bytes(w), bytes(r)) for t, w, r in replay.transactions(capture)],
+                         [(2.0, b'\x80\x11', b'\x04')])
+
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'capture.bin')
+        self.fake = FakeRoboclaw(ADDRESS)
+        self.link = roboclaw.Link()
+        self.link.port = self.fake.port
+        roboclaw.Bind(self.link)
+
+    def tearDown(self):
+        roboclaw.Bind(None)
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        roboclaw.StartRecording(self.path)
+        for value in range(5):
+            self.fake.reads[Cmd.GETM1ENC] = encoder(value * 100)
+            roboclaw.ReadEncM1(ADDRESS)
+        roboclaw.SpeedM1M2(ADDRESS, 10, 20)
+        stopped = roboclaw.StopRecording()
+        self.assertIs(self.link.port, self.fake.port)
+        self.assertEqual(stopped.dropped, 0)
+
+        txns = replay.load_transactions(self.path)
+        self.assertEqual(len(txns), 6)
+        port = replay.ReplayPort()
+        link = roboclaw.Link()
+        link.port = port
+        with roboclaw.Using(link):
+            for value, (stamp, written, response) in zip(range(5), txns):
+                port.load(response)
+                self.assertEqual(tuple(roboclaw.ReadEncM1(written[0])), (1, value * 100, 0))
+        self.assertEqual(bytes(txns[5][2]), b'\xff')
+
+    def test_drops_are_reported_and_marked(self):
+        # The writer thread never runs before stop, so the small ring overflows
+        rec = recorder.Recorder(self.path, size=64, period=60.0)
+        rec.start()
+        self.link.port = recorder.TapPort(self.fake.port, rec)
+        self.fake.reads[Cmd.GETM1ENC] = encoder(7)
+        for i in range(10):
+            roboclaw.ReadEncM1(ADDRESS)
+        self.assertIs(roboclaw.StopRecording(), rec)
+        self.assertTrue(rec.dropped > 0)
+
+        marks = [struct.unpack('<I', data)[0] for stamp, direction, data in recorder.read_capture(self.path)
+                 if direction == DROP]
+        self.assertEqual(sum(marks), rec.dropped)
+        for stamp, written, response in replay.load_transactions(self.path):
+            self.assertEqual(bytes(response[:5]), encoder(7))
+
+    def test_stop_without_recording(self):
+        self.assertIsNone(roboclaw.StopRecording())
+
+
+if __name__ == '__main__':
+    unittest.main()
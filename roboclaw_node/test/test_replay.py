@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+from roboclaw_driver import analytics, replay
+
+# drive.bin is a recorded drive with a crc failure, a timeout and an encoder glitch and drive.csv the trajectory it
+# replays to, see fixtures/make_drive.py. A change to the capture format, the decoders or the odometry that moves
+# the trajectory fails here.
+FIXTURE = os.path.join(HERE, 'fixtures', 'drive.bin')
+EXPECTED = os.path.join(HERE, 'fixtures', 'drive.csv')
+TICKS_PER_METER = 4342.2
+BASE_WIDTH = 0.315
+POLLS = 100
+
+
+class TestReplayFixture(unittest.TestCase):
+    def setUp(self):
+        self.txns = replay.load_transactions(FIXTURE)
+        self.samples, self.decoded = replay.encoder_samples(self.txns)
+
+    def test_encoders(self):
+        # Every poll reads both encoders, the timed out read is tried three times. The polls with the crc failure
+        # and the timeout give no sample.
+        self.assertEqual(self.decoded, 2 * POLLS + 2)
+        self.assertEqual(len(self.samples), POLLS - 2)
+        self.assertEqual(self.samples[0][1:], (-300, -300))
+        self.assertEqual(self.samples[-1][1:], (-(40 * 300 + 20 * 300 + 20 * 150 + 20 * 300),
+                                                -(40 * 300 + 20 * 100 - 20 * 150 + 20 * 300)))
+        stamps = [sample[0] for sample in self.samples]
+        self.assertEqual(stamps, sorted(stamps))
+
+    def test_vectorised_decode_agrees(self):
+        data = analytics.load_capture(FIXTURE)
+        stamps, enc1, enc2 = analytics.pair_encoders(data)
+        # analytics pairs an M2 read with the last good M1 read, also across the timed out one
+        expected = dict((stamp, (enc1, enc2)) for stamp, enc1, enc2 in self.samples)
+        self.assertEqual(len(stamps), POLLS - 1)
+        for stamp, a, b in zip(stamps, enc1, enc2):
+            if stamp in expected:
+                self.assertEqual(expected[stamp], (a, b))
+
+    def test_trajectory(self):
+        rows = replay.odometry(self.samples, TICKS_PER_METER, BASE_WIDTH, self.txns[0][0])
+        self.assertEqual(replay.compare(replay.read_csv(EXPECTED), rows, 1e-6), [])
+        # The glitched count is left out. The first straight, 38 samples as two polls failed, ends 40 polls of 300
+        # ticks down the x axis.
+        stamps, x, y, theta = rows[:4]
+        self.assertEqual(len(stamps), POLLS - 3)
+        self.assertAlmostEqual(x[37], 40 * 300 / TICKS_PER_METER, places=9)
+        self.assertEqual((y[37], theta[37]), (0.0, 0.0))
+        self.assertNotEqual(theta[38], 0.0)
+
+    def test_compare_reports_differences(self):
+        rows = list(replay.odometry(self.samples, TICKS_PER_METER, BASE_WIDTH, self.txns[0][0]))
+        rows[1] = np.array(rows[1])
+        rows[1][5] += 0.001
+        differences = replay.compare(replay.read_csv(EXPECTED), rows, 1e-6)
+        self.assertEqual(len(differences), 1)
+        self.assertTrue(differences[0].startswith("sample 5 x "))
+        self.assertEqual(replay.compare(replay.read_csv(EXPECTED), [row[:-1] for row in rows], 1e-6),
+                         ["%d samples, expected %d" % (POLLS - 4, POLLS - 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from roboclaw_driver import roboclaw_driver as roboclaw
+from roboclaw_driver.roboclaw_driver import Cmd
+from roboclaw_driver.shm import TelemetryReader, TelemetrySampler, TelemetryWriter
+
+from fake_roboclaw import CRC, SILENT, FakeRoboclaw, encoder
+
+ADDRESS = 0x80
+
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'telemetry')
+        self.writer = TelemetryWriter(self.path, slots=4)
+        self.reader = TelemetryReader(self.path)
+        self.fake = FakeRoboclaw(ADDRESS)
+        self.fake.reads[Cmd.GETM1SPEED] = encoder(120)
+        self.fake.reads[Cmd.GETM2SPEED] = encoder(-80)
+        self.fake.reads[Cmd.GETCURRENTS] = struct.pack('>hh', 250, 30)
+        self.link = roboclaw.Link()
+        self.link.port = self.fake.port
+        roboclaw.Bind(self.link)
+        self.sampler = TelemetrySampler(self.writer, ADDRESS)
+
+    def tearDown(self):
+        roboclaw.Bind(None)
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def test_sample(self):
+        self.assertTrue(self.sampler.sample(1000, 2000, stamp=5.0))
+        self.assertEqual(self.reader.head(), 1)
+        self.assertEqual(self.reader.latest(), (5.0, 1000, 2000, 120, -80, 250, 30))
+
+    def test_failed_read_is_not_written(self):
+        self.assertTrue(self.sampler.sample(1000, 2000, stamp=5.0))
+        for cmd, fault in ((Cmd.GETM1SPEED, CRC), (Cmd.GETM2SPEED, SILENT), (Cmd.GETCURRENTS, CRC)):
+            # Replies that would be read as a new sample if the failure went unnoticed
+            self.fake.reads[Cmd.GETM1SPEED] = encoder(0)
+            self.fake.reads[Cmd.GETM2SPEED] = encoder(0)
+            self.fake.reads[Cmd.GETCURRENTS] = struct.pack('>hh', 0, 0)
+            self.fake.faults = [None] * self.reads_before(cmd) + [fault] * roboclaw._trystimeout
+            self.assertFalse(self.sampler.sample(1100, 2100, stamp=6.0))
+            self.assertEqual(self.reader.head(), 1)
+            self.assertEqual(self.reader.latest(), (5.0, 1000, 2000, 120, -80, 250, 30))
+        self.assertEqual(self.sampler.skipped, 3)
+
+        self.fake.faults = []
+        self.assertTrue(self.sampler.sample(1100, 2100, stamp=6.0))
+        self.assertEqual(self.reader.latest(), (6.0, 1100, 2100, 0, 0, 0, 0))
+
+    @staticmethod
+    def reads_before(cmd):
+        # How many reads of a sample go out before cmd
+        return (Cmd.GETM1SPEED, Cmd.GETM2SPEED, Cmd.GETCURRENTS).index(cmd)
+
+
+if __name__ == '__main__':
+    unittest.main()